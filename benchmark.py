@@ -0,0 +1,454 @@
+#!/usr/bin/python
+
+"""
+This Python script contains benchmarks for DedupFS. Execute
+"python benchmark.py -h" for a list of the available benchmarks and their
+options. The benchmarks that only exercise the metadata store don't need the
+Python FUSE binding.
+"""
+
+import distutils.spawn
+import optparse
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import compression
+import metastore
+from thread_pool import ThreadPool
+
+def main(): # {{{1
+  parser = optparse.OptionParser(usage="%prog [options] BENCHMARK\n\nAvailable benchmarks: " + ', '.join(sorted(BENCHMARKS)))
+  parser.add_option('--files', type='int', default=20000, help="number of files in the synthetic metadata store")
+  parser.add_option('--blocks', type='int', default=16, help="number of blocks per file in the synthetic metadata store")
+  parser.add_option('--shared', type='float', default=0.5, help="fraction of blocks that are shared with other files")
+  parser.add_option('--samples', type='int', default=2000, help="number of queries to time per workload")
+  parser.add_option('--threads', type='int', default=8, help="number of concurrent clients used by the concurrency benchmark and worker threads used by the compression benchmark")
+  parser.add_option('--entries', type='int', default=1000000, help="number of directory entries created by the bigdir benchmark")
+  parser.add_option('--dedupfs-options', default='', metavar='OPTIONS', help="extra command line options for benchmarks that mount dedupfs.py")
+  parser.add_option('--workdir', help="directory for temporary files (defaults to the system's temporary directory)")
+  options, arguments = parser.parse_args()
+  if len(arguments) != 1 or arguments[0] not in BENCHMARKS:
+    parser.print_help()
+    sys.exit(1)
+  workdir = tempfile.mkdtemp(prefix='dedupfs-benchmark-', dir=options.workdir)
+  try:
+    BENCHMARKS[arguments[0]](options, workdir)
+  finally:
+    shutil.rmtree(workdir)
+
+def timed(function, *args): # {{{1
+  start_time = time.time()
+  function(*args)
+  return time.time() - start_time
+
+def mount(workdir, options, extra=()): # {{{1
+  """
+  Mount a DedupFS file system backed by databases in the given directory.
+  Returns the mount point and the handle of the dedupfs.py process.
+  """
+  mountpoint = os.path.join(workdir, 'mountpoint')
+  if not os.path.isdir(mountpoint):
+    os.mkdir(mountpoint)
+  program = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dedupfs.py')
+  command = [sys.executable, program, '-f', '--nogc',
+             '--metastore=%s' % os.path.join(workdir, 'metastore.sqlite3'),
+             '--datastore=%s' % os.path.join(workdir, 'datastore.db')]
+  command += list(extra) + options.dedupfs_options.split() + [mountpoint]
+  process = subprocess.Popen(command)
+  while not os.path.ismount(mountpoint):
+    if process.poll() is not None:
+      raise Exception, "dedupfs.py exited with status %i!" % process.returncode
+    time.sleep(0.1)
+  return mountpoint, process
+
+def unmount(mountpoint, process): # {{{1
+  subprocess.call(['fusermount', '-u', mountpoint])
+  process.wait()
+
+def report(label, results): # {{{1
+  """
+  Print a table with one row per workload and one column per configuration.
+  Timings are in seconds unless the workload label says otherwise.
+  """
+  columns = [c for c, r in results]
+  print "%s:" % label
+  print "  %-32s" % 'workload' + ''.join('%16s' % c for c in columns)
+  for workload in [w for w, t in results[0][1]]:
+    row = ''.join('%16.3f' % dict(r)[workload] for c, r in results)
+    print "  %-32s%s" % (workload, row)
+
+def populate_metastore(conn, options): # {{{1
+  """
+  Fill the given metadata store with a synthetic file system containing
+  options.files files of options.blocks blocks each.
+  """
+  rng = random.Random(42)
+  nhashes = 0
+  conn.execute('BEGIN')
+  for inode in xrange(1, options.files + 1):
+    conn.execute('INSERT INTO inodes (inode, nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime) VALUES (?, 1, 33188, 0, 0, 0, 0, 0, 0, 0)', (inode,))
+    for block_nr in xrange(options.blocks):
+      if nhashes > 0 and rng.random() < options.shared:
+        hash_id = rng.randint(1, nhashes)
+      else:
+        nhashes += 1
+        hash_id = nhashes
+        conn.execute('INSERT INTO hashes (id, hash) VALUES (?, ?)', (hash_id, sqlite3.Binary(os.urandom(20))))
+      conn.execute('INSERT INTO "index" (inode, hash_id, block_nr) VALUES (?, ?, ?)', (inode, hash_id, block_nr))
+  conn.execute('COMMIT')
+
+def time_metadata_workloads(conn, options): # {{{1
+  """
+  Time the hot queries of dedupfs.py against a metadata store populated by
+  populate_metastore(). Returns a list of (workload, seconds) tuples.
+  """
+  rng = random.Random(7)
+  inodes = [rng.randint(1, options.files) for i in xrange(options.samples)]
+  # The legacy layout doesn't record the compression method per block.
+  columns = [row[1] for row in conn.execute('PRAGMA table_info(hashes)')]
+  scan_query = 'SELECT h.hash%s FROM hashes h, "index" i WHERE i.inode = ? AND h.id = i.hash_id ORDER BY i.block_nr ASC'
+  scan_query %= 'method' in columns and ', h.method' or ''
+  def scan_files():
+    for inode in inodes:
+      conn.execute(scan_query, (inode,)).fetchall()
+  def truncate_files():
+    for inode in inodes:
+      conn.execute('DELETE FROM "index" WHERE inode = ? AND block_nr > ?', (inode, options.blocks / 2))
+  def collect_inodes():
+    conn.execute('UPDATE inodes SET nlinks = 0 WHERE inode % 10 = 0')
+    conn.execute('DELETE FROM inodes WHERE nlinks = 0')
+  def collect_indices():
+    conn.execute('DELETE FROM "index" WHERE NOT EXISTS (SELECT 1 FROM inodes WHERE inodes.inode = "index".inode)')
+  def collect_blocks():
+    conn.execute('SELECT hash FROM hashes h WHERE NOT EXISTS (SELECT 1 FROM "index" i WHERE i.hash_id = h.id)').fetchall()
+  timings = []
+  for label, function in [('block ordered file scans', scan_files),
+                          ('truncates', truncate_files),
+                          ('collecting inodes', collect_inodes),
+                          ('collecting index entries', collect_indices),
+                          ('collecting data blocks', collect_blocks)]:
+    conn.execute('BEGIN')
+    timings.append((label, timed(function)))
+    conn.execute('COMMIT')
+  return timings
+
+def benchmark_schema(options, workdir): # {{{1
+  """
+  Compare the hot queries of dedupfs.py on the legacy and current layouts
+  of the metadata store and check the query plans of the current layout.
+  """
+  layouts = [('legacy', metastore.LEGACY_SCHEMA),
+             ('current', metastore.schema() + metastore.indexes())]
+  results = []
+  for name, script in layouts:
+    pathname = os.path.join(workdir, name + '.sqlite3')
+    conn = sqlite3.connect(pathname, isolation_level=None)
+    conn.executescript(script)
+    populate_metastore(conn, options)
+    timings = time_metadata_workloads(conn, options)
+    if name == 'current':
+      for description, plan in metastore.check_query_plans(conn):
+        print "Warning: %s doesn't use the expected indexes: %s" % (description, '; '.join(plan))
+    conn.close()
+    timings.append(('database size (MB)', os.path.getsize(pathname) / 1024.0 ** 2))
+    results.append((name, timings))
+  report("Metadata store layouts (%i files of %i blocks)" % (options.files, options.blocks), results)
+
+def benchmark_sqlite(options, workdir): # {{{1
+  """
+  Run the metadata workloads on the current layout under different SQLite
+  settings (see the --sqlite-* options of dedupfs.py). Populating the store
+  is timed as well because that's where the journal mode matters most.
+  """
+  configurations = [('default', None, {}),
+                    ('cache 64M', None, {'cache_size': -1024 * 64}),
+                    ('mmap 256M', None, {'mmap_size': 1024 ** 2 * 256}),
+                    ('temp memory', None, {'temp_store': 'memory'}),
+                    ('wal', None, {'journal_mode': 'wal'}),
+                    ('pages 16K', 1024 * 16, {})]
+  results = []
+  for name, page_size, settings in configurations:
+    pathname = os.path.join(workdir, name.replace(' ', '-') + '.sqlite3')
+    conn = sqlite3.connect(pathname, isolation_level=None)
+    conn.execute('PRAGMA locking_mode = EXCLUSIVE')
+    if page_size:
+      conn.execute('PRAGMA page_size = %i' % page_size)
+    for pragma, requested, effective in metastore.tune(conn, settings):
+      print "Warning: SQLite didn't accept %s = %s, using %s instead." % (pragma, requested, effective)
+    conn.executescript(metastore.schema() + metastore.indexes())
+    timings = [('populating', timed(populate_metastore, conn, options))]
+    timings += time_metadata_workloads(conn, options)
+    conn.close()
+    results.append((name, timings))
+  report("SQLite settings (%i files of %i blocks)" % (options.files, options.blocks), results)
+
+def benchmark_bigdir(options, workdir): # {{{1
+  """
+  Create options.entries empty files in a single directory of a mounted
+  file system and then stat them all in random order.
+  """
+  mountpoint, process = mount(workdir, options)
+  try:
+    directory = os.path.join(mountpoint, 'bigdir')
+    os.mkdir(directory)
+    names = ['message-%08i' % i for i in xrange(options.entries)]
+    def create_entries():
+      for name in names:
+        os.close(os.open(os.path.join(directory, name), os.O_CREAT | os.O_WRONLY, 0644))
+    def stat_entries():
+      for name in names:
+        os.lstat(os.path.join(directory, name))
+    def stat_missing():
+      for name in names[:options.samples]:
+        try:
+          os.lstat(os.path.join(directory, 'missing-' + name))
+        except OSError:
+          pass
+    timings = [('create', timed(create_entries))]
+    random.Random(42).shuffle(names)
+    timings.append(('stat', timed(stat_entries)))
+    timings.append(('stat (missing)', timed(stat_missing)))
+  finally:
+    unmount(mountpoint, process)
+  print "Directory with %i entries:" % options.entries
+  for label, elapsed in timings:
+    count = label == 'stat (missing)' and options.samples or options.entries
+    print "  %-16s%10.2f seconds (%i entries/s)" % (label, elapsed, count / max(elapsed, 0.001))
+
+def benchmark_smallfiles(options, workdir): # {{{1
+  """
+  Create options.files small files (100 bytes to 4 KB) in a mounted file
+  system and read them back, with and without inline storage.
+  """
+  rng = random.Random(42)
+  contents = [os.urandom(16) * rng.randint(6, 256) for i in xrange(options.files)]
+  results = []
+  for label, extra in [('blocks', ['--inline-threshold=0']), ('inline', [])]:
+    storedir = os.path.join(workdir, label)
+    os.mkdir(storedir)
+    mountpoint, process = mount(storedir, options, extra)
+    try:
+      def create_files():
+        for i, data in enumerate(contents):
+          handle = open(os.path.join(mountpoint, 'file-%i' % i), 'wb')
+          handle.write(data)
+          handle.close()
+      def read_files():
+        for i in xrange(len(contents)):
+          handle = open(os.path.join(mountpoint, 'file-%i' % i), 'rb')
+          handle.read()
+          handle.close()
+      timings = [('create', timed(create_files)), ('read', timed(read_files))]
+    finally:
+      unmount(mountpoint, process)
+    for name in 'metastore.sqlite3', 'datastore.db':
+      size = sum(os.path.getsize(os.path.join(storedir, f)) for f in os.listdir(storedir) if f.startswith(name))
+      timings.append(('%s (MB)' % name, size / 1024.0 ** 2))
+    results.append((label, timings))
+  report("%i small files" % options.files, results)
+
+def benchmark_concurrency(options, workdir): # {{{1
+  """
+  Read files of 1 MB from options.threads concurrent clients, with and
+  without a client that keeps writing new files at the same time, in a file
+  system mounted with and without --multithreaded. Results are the combined
+  read throughput of the clients.
+  """
+  nfiles = min(options.files, 100)
+  contents = [os.urandom(1024 * 64) * 16 for i in xrange(nfiles)]
+  results = []
+  for label, extra in [('single', []), ('multithreaded', ['--multithreaded'])]:
+    storedir = os.path.join(workdir, label)
+    os.mkdir(storedir)
+    mountpoint, process = mount(storedir, options, extra)
+    try:
+      for i, data in enumerate(contents):
+        handle = open(os.path.join(mountpoint, 'file-%i' % i), 'wb')
+        handle.write(data)
+        handle.close()
+      def read_files(seed):
+        order = range(nfiles)
+        random.Random(seed).shuffle(order)
+        for i in order:
+          handle = open(os.path.join(mountpoint, 'file-%i' % i), 'rb')
+          handle.read()
+          handle.close()
+      def write_files(stop):
+        i = 0
+        while not stop.isSet():
+          handle = open(os.path.join(mountpoint, 'new-%i' % i), 'wb')
+          handle.write(os.urandom(1024 * 256))
+          handle.close()
+          i += 1
+      def concurrent_reads(nthreads, writer=False):
+        threads = [threading.Thread(target=read_files, args=(n,)) for n in xrange(nthreads)]
+        stop = threading.Event()
+        background = threading.Thread(target=write_files, args=(stop,))
+        if writer:
+          background.start()
+        def run_clients():
+          for thread in threads:
+            thread.start()
+          for thread in threads:
+            thread.join()
+        elapsed = timed(run_clients)
+        stop.set()
+        if writer:
+          background.join()
+        return nthreads * nfiles / elapsed
+      timings = [('1 client (MB/s)', concurrent_reads(1)),
+                 ('%i clients (MB/s)' % options.threads, concurrent_reads(options.threads)),
+                 ('%i clients + writer (MB/s)' % options.threads, concurrent_reads(options.threads, True))]
+    finally:
+      unmount(mountpoint, process)
+    results.append((label, timings))
+  report("Concurrent reads of %i files of 1 MB" % nfiles, results)
+
+def benchmark_rsync(options, workdir): # {{{1
+  """
+  Copy a tree of options.files small files into a mounted file system the
+  way rsync(1) does (using rsync when it's installed): every file is
+  written under a temporary name and then renamed to its final name. Then
+  rename all of the files once more, half of them to another directory.
+  """
+  rng = random.Random(42)
+  source = os.path.join(workdir, 'source')
+  paths = []
+  for i in xrange(options.files):
+    path = os.path.join('dir-%i' % (i % 100), 'file-%i' % i)
+    if not os.path.isdir(os.path.join(source, os.path.dirname(path))):
+      os.makedirs(os.path.join(source, os.path.dirname(path)))
+    handle = open(os.path.join(source, path), 'wb')
+    handle.write(os.urandom(rng.randint(100, 1024 * 8)))
+    handle.close()
+    paths.append(path)
+  rsync = distutils.spawn.find_executable('rsync')
+  mountpoint, process = mount(workdir, options)
+  try:
+    target = os.path.join(mountpoint, 'target')
+    def copy_tree():
+      if rsync:
+        subprocess.check_call([rsync, '-a', source + '/', target])
+        return
+      for path in paths:
+        directory, name = os.path.split(os.path.join(target, path))
+        if not os.path.isdir(directory):
+          os.makedirs(directory)
+        temporary = os.path.join(directory, '.%s.%06i' % (name, rng.randint(0, 999999)))
+        shutil.copy2(os.path.join(source, path), temporary)
+        os.rename(temporary, os.path.join(directory, name))
+    def rename_files():
+      os.mkdir(os.path.join(target, 'renamed'))
+      for i, path in enumerate(paths):
+        if i % 2:
+          new_path = os.path.join('renamed', os.path.basename(path))
+        else:
+          new_path = path + '.renamed'
+        os.rename(os.path.join(target, path), os.path.join(target, new_path))
+    timings = [(rsync and 'rsync' or 'copy + rename', timed(copy_tree)), ('rename', timed(rename_files))]
+  finally:
+    unmount(mountpoint, process)
+  print "Tree with %i small files:" % options.files
+  for label, elapsed in timings:
+    print "  %-16s%10.2f seconds (%i files/s)" % (label, elapsed, options.files / max(elapsed, 0.001))
+
+def benchmark_compression(options, workdir): # {{{1
+  """
+  Compress and decompress 32 MB of text like data blocks of 128 KB using
+  every available compression method, from a single thread and from a pool
+  of options.threads threads. Results are the combined throughput, which
+  only scales with the number of CPU cores for compression modules that
+  release the global interpreter lock.
+  """
+  rng = random.Random(42)
+  words = [os.urandom(rng.randint(2, 6)).encode('hex') for i in xrange(2000)]
+  text = ' '.join([rng.choice(words) for i in xrange(1024 * 64)])
+  block_size = 1024 * 128
+  blocks = [text[i * 1024 : i * 1024 + block_size] for i in xrange(256)]
+  megabytes = len(blocks) * block_size / 1024.0 ** 2
+  compressors = compression.load_compressors()
+  del compressors['none']
+  def throughput(function, inputs, nthreads):
+    pool = ThreadPool(nthreads)
+    try:
+      def run_jobs():
+        for job in [pool.submit(function, i) for i in inputs]:
+          job.result()
+      return megabytes / timed(run_jobs)
+    finally:
+      pool.close()
+  results = []
+  for nthreads in 1, options.threads:
+    timings = []
+    for method in sorted(compressors):
+      compress, decompress = compressors[method]
+      compressed = map(compress, blocks)
+      timings.append(('%s compress (MB/s)' % method, throughput(compress, blocks, nthreads)))
+      timings.append(('%s decompress (MB/s)' % method, throughput(decompress, compressed, nthreads)))
+    results.append(('%i threads' % nthreads, timings))
+  report("Compression of %i blocks of 128 KB" % len(blocks), results)
+
+def benchmark_lzo(options, workdir): # {{{1
+  """
+  Measure the time per block spent by the LZO binding on 8 MB of text like
+  data in blocks of 4 KB and 128 KB, calling compress() and decompress() once
+  per block and calling compress_many() and decompress_many() once per batch
+  of 64 blocks. The difference for small blocks is the per call overhead of
+  the binding.
+  """
+  try:
+    import lzo
+  except ImportError:
+    print "The LZO binding isn't installed! (see lzo/README)"
+    return
+  rng = random.Random(42)
+  words = [os.urandom(rng.randint(2, 6)).encode('hex') for i in xrange(2000)]
+  text = ' '.join([rng.choice(words) for i in xrange(1024 ** 2)])
+  batch_size = 64
+  def per_block(function, inputs, nblocks):
+    outputs = []
+    elapsed = timed(lambda: outputs.extend(map(function, inputs)))
+    return elapsed / nblocks * 1000000, outputs
+  def compress_best(block):
+    return lzo.compress(block, lzo.LEVEL_BEST)
+  results = []
+  for block_size in 1024 * 4, 1024 * 128:
+    nblocks = 1024 ** 2 * 8 / block_size
+    blocks = [text[i * block_size : (i + 1) * block_size] for i in xrange(nblocks)]
+    batches = [blocks[i : i + batch_size] for i in xrange(0, nblocks, batch_size)]
+    compress_time, compressed = per_block(lzo.compress, blocks, nblocks)
+    compress_many_time, ignored = per_block(lzo.compress_many, batches, nblocks)
+    best_time, best = per_block(compress_best, blocks, nblocks)
+    decompress_time, ignored = per_block(lzo.decompress, compressed, nblocks)
+    batches = [compressed[i : i + batch_size] for i in xrange(0, nblocks, batch_size)]
+    decompress_many_time, ignored = per_block(lzo.decompress_many, batches, nblocks)
+    results.append(('%i KB blocks' % (block_size / 1024), [
+      ('compress (us/block)', compress_time),
+      ('compress_many (us/block)', compress_many_time),
+      ('compress best (us/block)', best_time),
+      ('decompress (us/block)', decompress_time),
+      ('decompress_many (us/block)', decompress_many_time),
+      ('compression ratio fast', float(sum(map(len, blocks))) / sum(map(len, compressed))),
+      ('compression ratio best', float(sum(map(len, blocks))) / sum(map(len, best)))]))
+  report("Time per block spent by the LZO binding (batches of %i blocks)" % batch_size, results)
+
+BENCHMARKS = { 'bigdir': benchmark_bigdir,
+               'compression': benchmark_compression,
+               'concurrency': benchmark_concurrency,
+               'lzo': benchmark_lzo,
+               'rsync': benchmark_rsync,
+               'schema': benchmark_schema,
+               'sqlite': benchmark_sqlite,
+               'smallfiles': benchmark_smallfiles }
+
+if __name__ == '__main__':
+  main()
+
+# vim: ts=2 sw=2 et
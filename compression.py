@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+"""
+The Compressor class in this Python module compresses data blocks using the
+compression method chosen per block and keeps track of the time spent and
+space saved by every method. Blocks are tagged with the method that was used
+to store them, so the method can be changed at any time. Data that doesn't
+compress (media files, archives, encrypted data) is recognized by trying to
+compress a few small samples of every block at a fast zlib level, those
+blocks are stored as is instead of being run through a slow compressor only
+to come out the same size (or larger). Small blocks compress badly on their
+own because every block starts with an empty history, so they're compressed
+using zlib primed with a preset dictionary of strings that are common in the
+file system (see train_dictionary()) when such a dictionary is available.
+"""
+
+import heapq
+import threading
+import time
+import zlib
+
+# The modules that provide compression methods, each defines compress() and
+# decompress() functions.
+MODULES = ['lzo', 'zlib', 'bz2']
+
+# The LZO binding can also compress at a higher ratio (decompression is just
+# as fast), which is offered as a separate method because it's a lot slower.
+HIGH_RATIO_METHODS = { 'lzo': 'lzo-best' }
+
+# Blocks larger than 2 * SAMPLES * SAMPLE_SIZE bytes are probed using SAMPLES
+# samples of SAMPLE_SIZE bytes spread evenly over the block, a block is
+# considered incompressible when the samples don't compress to less than
+# PROBE_RATIO of their size.
+SAMPLES = 4
+SAMPLE_SIZE = 1024
+PROBE_RATIO = 0.95
+
+# Compressed blocks that aren't at least 1 / MIN_SAVING smaller than the
+# original are stored as is, because reading them back is free.
+MIN_SAVING = 32
+
+# Blocks compressed using a preset dictionary are tagged with this prefix
+# followed by the version of the dictionary. Dictionaries are limited to the
+# size of the zlib window, because deflate can't refer back any further.
+DICTIONARY_PREFIX = 'zdict:'
+MAX_DICTIONARY_SIZE = 1024 * 32
+
+# Dictionaries are built from the strings of SEGMENT_SIZE bytes that occur in
+# more than one sample, joined into pieces of at most MAX_PIECE_SIZE bytes.
+SEGMENT_SIZE = 16
+MAX_PIECE_SIZE = 1024
+
+# The amount of sample data used to train a dictionary (a quarter of which
+# is used to evaluate the result instead) and the minimum number of samples.
+TRAINING_BYTES = 1024 ** 2 * 4
+MIN_TRAINING_SAMPLES = 8
+
+def load_compressors(): # {{{1
+  """
+  Get a dictionary with the (compress, decompress) functions of the
+  available compression methods, including the method 'none'.
+  """
+  def noop(s): return s
+  compressors = { 'none': (noop, noop) }
+  for modname in MODULES:
+    try:
+      module = __import__(modname)
+      if hasattr(module, 'compress') and hasattr(module, 'decompress'):
+        compressors[modname] = (module.compress, module.decompress)
+        if modname in HIGH_RATIO_METHODS and hasattr(module, 'LEVEL_BEST'):
+          compressors[HIGH_RATIO_METHODS[modname]] = (high_ratio(module), module.decompress)
+    except ImportError:
+      pass
+  return compressors
+
+def high_ratio(module): # {{{1
+  return lambda block: module.compress(block, module.LEVEL_BEST)
+
+class Compressor: # {{{1
+
+  def __init__(self, compressors, probe=True, dictionary_threshold=0, load_dictionary=None): # {{{2
+    self.compressors = compressors
+    self.probe = probe
+    self.dictionary_threshold = dictionary_threshold
+    # Primed (compressor, decompressor) objects per dictionary version, new
+    # blocks use the latest version. Blocks compressed using a version that
+    # was added elsewhere (after this object was created) are decompressed
+    # using the dictionary returned by load_dictionary(version).
+    self.dictionaries = {}
+    self.load_dictionary = load_dictionary
+    self.dictionary = None
+    self.lock = threading.Lock()
+    # Per method: number of blocks, bytes in, bytes out and seconds spent
+    # compressing. Incompressible blocks are counted as method 'none' and
+    # the time spent probing them as 'probe'.
+    self.statistics = {}
+
+  def compress(self, block, method): # {{{2
+    """
+    Compress a block using the given method unless the block doesn't
+    compress, or using the latest dictionary when the block is smaller than
+    the dictionary threshold. Returns a (method, data) tuple with the method
+    that was actually used. Safe to call from multiple threads.
+    """
+    if method == 'none' or not block:
+      self.__record('none', len(block), len(block), 0)
+      return 'none', block
+    start_time = time.time()
+    if self.probe and not self.is_compressible(block):
+      self.__record('probe', 0, 0, time.time() - start_time)
+      self.__record('none', len(block), len(block), 0)
+      return 'none', block
+    if self.dictionary is not None and len(block) < self.dictionary_threshold:
+      method = DICTIONARY_PREFIX + str(self.dictionary)
+      data = compress_primed(self.dictionaries[self.dictionary][0], block)
+    else:
+      data = self.compressors[method][0](block)
+    elapsed = time.time() - start_time
+    if len(data) > len(block) - len(block) / MIN_SAVING:
+      self.__record(method, 0, 0, elapsed)
+      self.__record('none', len(block), len(block), 0)
+      return 'none', block
+    self.__record(method, len(block), len(data), elapsed)
+    return method, data
+
+  def decompress(self, method, data): # {{{2
+    """
+    Decompress a block that was stored using the given method.
+    """
+    if method.startswith(DICTIONARY_PREFIX):
+      version = int(method[len(DICTIONARY_PREFIX):])
+      if version not in self.dictionaries and self.load_dictionary:
+        dictionary = self.load_dictionary(version)
+        if dictionary is not None:
+          self.add_dictionary(version, dictionary)
+      return decompress_primed(self.dictionaries[version][1], data)
+    return self.compressors[method][1](data)
+
+  def add_dictionary(self, version, dictionary): # {{{2
+    """
+    Make a dictionary available for decompression. The dictionary with the
+    highest version is used to compress small blocks.
+    """
+    primed = prime(dictionary)
+    self.lock.acquire()
+    try:
+      self.dictionaries[version] = primed
+      if version > self.dictionary:
+        self.dictionary = version
+    finally:
+      self.lock.release()
+
+  def is_compressible(self, block): # {{{2
+    """
+    Guess whether a block is worth compressing by compressing a few samples
+    of it. Small blocks are always considered compressible because probing
+    them would take about as long as compressing them.
+    """
+    if len(block) <= SAMPLES * SAMPLE_SIZE * 2:
+      return True
+    step = (len(block) - SAMPLE_SIZE) / (SAMPLES - 1)
+    sample = ''.join([block[i * step : i * step + SAMPLE_SIZE] for i in xrange(SAMPLES)])
+    return len(zlib.compress(sample, 1)) < len(sample) * PROBE_RATIO
+
+  def snapshot(self): # {{{2
+    """
+    Get the statistics per method as a dictionary of dictionaries with the
+    number of blocks, the bytes before and after compression, the ratio and
+    the throughput in bytes per second.
+    """
+    self.lock.acquire()
+    try:
+      statistics = dict([(m, list(s)) for m, s in self.statistics.items()])
+    finally:
+      self.lock.release()
+    result = {}
+    for method, (blocks, raw_bytes, stored_bytes, seconds) in statistics.items():
+      result[method] = dict(blocks=blocks, raw_bytes=raw_bytes, stored_bytes=stored_bytes, seconds=seconds,
+          ratio=stored_bytes > 0 and float(raw_bytes) / stored_bytes or None,
+          throughput=seconds > 0 and raw_bytes / seconds or None)
+    return result
+
+  def __record(self, method, raw_bytes, stored_bytes, seconds): # {{{2
+    self.lock.acquire()
+    try:
+      statistics = self.statistics.get(method)
+      if statistics is None:
+        statistics = self.statistics[method] = [0, 0, 0, 0.0]
+      if raw_bytes:
+        statistics[0] += 1
+      statistics[1] += raw_bytes
+      statistics[2] += stored_bytes
+      statistics[3] += seconds
+    finally:
+      self.lock.release()
+
+def prime(dictionary): # {{{1
+  """
+  Get a raw deflate compressor and decompressor that have processed the
+  given dictionary, so that the blocks compressed by a copy of the primed
+  compressor can refer back to the strings in the dictionary. This is what
+  the `zdict' argument of zlib in Python 3 does, the zlib module of Python
+  2 doesn't support preset dictionaries. The dictionary is flushed to a
+  byte boundary so that the compressed blocks can be decompressed by a copy
+  of the primed decompressor.
+  """
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+  primer = compressor.compress(dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+  decompressor.decompress(primer)
+  return compressor, decompressor
+
+def compress_primed(compressor, block): # {{{1
+  compressor = compressor.copy()
+  return compressor.compress(block) + compressor.flush()
+
+def decompress_primed(decompressor, data): # {{{1
+  decompressor = decompressor.copy()
+  return decompressor.decompress(data) + decompressor.flush()
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE): # {{{1
+  """
+  Build a preset dictionary of at most `size' bytes from a list of sample
+  blocks. Strings that occur in many samples are worth the most. They're
+  found by counting the number of samples that contain each segment of
+  SEGMENT_SIZE bytes starting at an anchor (see anchors()), because the same
+  string is anchored at the same place in every sample. Overlapping common
+  segments are joined into pieces, which are selected greedily by the value
+  of the segments they add to the dictionary. The most valuable pieces are
+  placed at the end of the dictionary because deflate encodes short
+  distances more compactly.
+  """
+  frequency = {}
+  for sample in samples:
+    for segment in set([sample[o:o + SEGMENT_SIZE] for o in anchors(sample)]):
+      frequency[segment] = frequency.get(segment, 0) + 1
+  candidates = []
+  for sample in samples:
+    start = end = None
+    segments = []
+    for offset in anchors(sample) + [None]:
+      segment = offset is not None and sample[offset:offset + SEGMENT_SIZE]
+      if segment and frequency[segment] > 1 and end is not None and offset <= end \
+          and offset + SEGMENT_SIZE - start <= MAX_PIECE_SIZE:
+        end = offset + SEGMENT_SIZE
+        segments.append(segment)
+        continue
+      if segments:
+        candidates.append((sample[start:end], set(segments)))
+      start = end = None
+      segments = []
+      if segment and frequency[segment] > 1:
+        start, end = offset, offset + SEGMENT_SIZE
+        segments.append(segment)
+  # Lazy greedy selection: the value of a piece only decreases as other
+  # pieces are selected, so it's recomputed when the piece comes up.
+  def value(segments):
+    return sum([frequency[s] - 1 for s in segments]) * SEGMENT_SIZE
+  heap = [(-value(segments), i) for i, (piece, segments) in enumerate(candidates)]
+  heapq.heapify(heap)
+  covered, selected, total = set(), [], 0
+  while heap and total < size:
+    score, i = heapq.heappop(heap)
+    piece, segments = candidates[i]
+    current = value(segments - covered)
+    if current <= 0:
+      continue
+    if heap and current < -heap[0][0]:
+      heapq.heappush(heap, (-current, i))
+      continue
+    selected.append(piece)
+    covered.update(segments)
+    total += len(piece)
+  selected.reverse()
+  return ''.join(selected)[-size:]
+
+def anchors(sample): # {{{1
+  """
+  Get the offsets of the anchors in a sample: the positions where the hash
+  of the next four bytes is a multiple of eight (on average every eight
+  bytes), which depends only on the contents at that position.
+  """
+  return [o for o in xrange(len(sample) - SEGMENT_SIZE + 1) if hash(sample[o:o + 4]) & 7 == 0]
+
+def compare_dictionary(dictionary, samples): # {{{1
+  """
+  Compress the given samples using plain zlib and using zlib with the given
+  preset dictionary. Returns a dictionary with the original size, the
+  compressed sizes (plain_bytes and dictionary_bytes) and the time spent
+  decompressing the samples (plain_seconds and dictionary_seconds).
+  """
+  compressor, decompressor = prime(dictionary)
+  result = dict(raw_bytes=sum(map(len, samples)))
+  for name, compress, decompress in (
+      ('plain', zlib.compress, zlib.decompress),
+      ('dictionary', lambda s: compress_primed(compressor, s), lambda s: decompress_primed(decompressor, s))):
+    compressed = map(compress, samples)
+    start_time = time.time()
+    for data in compressed:
+      decompress(data)
+    result[name + '_seconds'] = time.time() - start_time
+    result[name + '_bytes'] = sum(map(len, compressed))
+  return result
+
+# vim: ts=2 sw=2 et
@@ -9,7 +9,8 @@ which enables it to store virtually unlimited copies of files because data
 is only stored once.
 
 In addition to deduplication the file system also supports transparent
-compression using any of the compression methods lzo, zlib and bz2.
+compression using any of the compression methods lzo, zlib and bz2, chosen
+per data block so that data that doesn't compress is stored as is.
 
 These two properties make the file system ideal for backups: I'm currently
 storing 250 GB worth of backups using only 8 GB of disk space.
@@ -30,14 +31,17 @@ if sys.version_info[:2] != (2, 6):
 
 # Try to load the required modules from Python's standard library.
 try:
+  import collections
   import cStringIO
   import errno
   import hashlib
+  import json
   import logging
   import math
   import os
   import sqlite3
   import stat
+  import threading
   import time
   import traceback
 except ImportError, e:
@@ -54,8 +58,19 @@ except ImportError:
   sys.exit(1)
 
 # Local modules that are mostly useful for debugging.
-from my_formats import format_size, format_timespan
+from my_formats import format_latency, format_size, format_timespan
+import compression
+from export import Export
+from fsck import Checker
 from get_memory_usage import get_memory_usage
+import metastore
+from lru_cache import LRUCache
+from merkle import TreeHasher
+from metrics import Metrics
+from migration import Migration
+from report import Report
+from sql_profiler import SQLProfiler
+from thread_pool import ThreadPool
 
 def main(): # {{{1
   """
@@ -63,6 +78,11 @@ def main(): # {{{1
   mount points. Execute "dedupfs -h" for a list of valid command line options.
   """
 
+  # Commands that work on the databases without mounting the file system.
+  if len(sys.argv) > 1 and sys.argv[1] in OFFLINE_COMMANDS:
+    run_offline_command(sys.argv[1], sys.argv[2:])
+    return
+
   dfs = DedupFS()
 
   # A short usage message with the command line options defined by dedupfs
@@ -89,6 +109,73 @@ def main(): # {{{1
     # binding (which is kind of intimidating at first).
     dfs.main()
 
+# Offline commands: The name of the DedupFS method that implements the
+# command, whether the databases are opened read only and a short usage
+# message describing the positional arguments.
+OFFLINE_COMMANDS = {
+  'migrate': ('migrate', True, "TARGET_METASTORE [TARGET_DATASTORE]"),
+  'recompute-stats': ('recompute_statistics', False, ""),
+  'report': ('report', True, "[PATH]"),
+  'import': ('import_tree', False, "SOURCE TARGET_PATH"),
+  'export': ('export_tree', True, "SOURCE_PATH TARGET"),
+  'fsck': ('check', False, ""),
+  'collapse': ('collapse_subtrees', False, "[PATH]"),
+  'clone': ('clone', False, "SOURCE_PATH TARGET_PATH"),
+  'train-dictionary': ('train_dictionary', False, ""),
+}
+
+# The FUSE API methods whose latency is recorded (see DedupFS.main()).
+FUSE_OPERATIONS = ['access', 'chmod', 'chown', 'create', 'getattr', 'link',
+    'mkdir', 'mknod', 'open', 'read', 'readdir', 'readlink', 'release',
+    'rename', 'rmdir', 'statfs', 'symlink', 'truncate', 'unlink', 'utime',
+    'utimens', 'write']
+
+# The FUSE API methods that change the file system. In multithreaded mode
+# they're serialized by a single lock (SQLite only allows one writer at a
+# time anyway) while the other methods run concurrently (see DedupFS.main()).
+MUTATING_OPERATIONS = ['chmod', 'chown', 'create', 'link', 'mkdir', 'mknod',
+    'rename', 'rmdir', 'symlink', 'truncate', 'unlink', 'utime', 'utimens']
+
+# The number of locks that protect the file buffers (see __buffer_lock()).
+BUFFER_LOCKS = 64
+
+# The virtual directory containing control files. It's hidden from listings
+# of the root directory and its files are generated when they're accessed.
+CONTROL_DIR = '/.dedupfs'
+CONTROL_INODE = 2 ** 62
+
+def get_cpu_count(): # {{{1
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 2
+
+def run_offline_command(name, arguments): # {{{1
+  """
+  Open the databases selected by the command line options without mounting
+  the file system and invoke the method that implements the command with
+  the remaining positional arguments.
+  """
+  method, read_only, usage = OFFLINE_COMMANDS[name]
+  dfs = DedupFS(fetch_mp=False)
+  dfs.parser.set_usage("%%prog %s [options] %s" % (name, usage))
+  dfs.parse(['-o', 'use_ino,default_permissions,fsname=dedupfs'] + arguments)
+  positional = dfs.cmdline[1]
+  required = [a for a in usage.split() if not a.startswith('[')]
+  if len(positional) < len(required):
+    dfs.parse(['-h'])
+    sys.exit(1)
+  dfs.command = name
+  dfs.read_only = read_only
+  dfs.fsinit(silent=True)
+  try:
+    status = getattr(dfs, method)(*positional)
+  finally:
+    dfs.fsdestroy(silent=True)
+  if status is False:
+    sys.exit(1)
+
 class DedupFS(fuse.Fuse): # {{{1
 
   def __init__(self, *args, **kw):  # {{{2
@@ -107,35 +194,55 @@ class DedupFS(fuse.Fuse): # {{{1
 
       # Initialize instance attributes.
       self.block_size = 1024 * 128
+      self.buffer_locks = [threading.RLock() for i in xrange(BUFFER_LOCKS)]
       self.buffers = {}
-      self.bytes_read = 0
-      self.bytes_written = 0
-      self.cache_gc_last_run = time.time()
-      self.cache_requests = 0
-      self.cache_timeout = 60 # TODO Make this a command line option!
-      self.cached_nodes = {}
+      self.cache_lock = threading.Lock()
       self.calls_log_filter = []
+      self.command = None
+      self.control_contents = {}
+      self.connections = None
+      self.control_files = { CONTROL_DIR + '/stats': self.__generate_stats,
+                             CONTROL_DIR + '/clone': lambda: '' }
+      # Control files that accept commands, one per line, when written to.
+      self.control_commands = { CONTROL_DIR + '/clone': self.__clone_command }
+      self.datastore_backend = None
+      self.datastore_lock = threading.Lock()
       self.datastore_file = '~/.dedupfs-datastore.db'
-      self.fs_mounted_at = time.time()
+      self.dentry_cache_bytes = 1024 ** 2 * 64
+      self.dentry_cache_entries = 250000
+      self.dictionary_threshold = 1024 * 16
       self.gc_enabled = True
       self.gc_hook_last_run = time.time()
       self.gc_interval = 60
+      self.gc_state = dict(runs=0, last_run=None, duration=None, results=[])
+      self.garbage_times = {}
+      self.inline_threshold = 1024 * 4
       self.link_mode = stat.S_IFLNK | 0777
       self.memory_usage = 0
+      self.metrics = Metrics()
       self.metastore_file = '~/.dedupfs-metastore.sqlite3'
+      self.negative_cache_entries = 50000
       self.opcount = 0
+      self.page_size = None
       self.read_only = False
       self.root_mode = stat.S_IFDIR | 0755
-      self.time_spent_caching_nodes = 0
-      self.time_spent_hashing = 0
-      self.time_spent_interning = 0
-      self.time_spent_querying_tree = 0
-      self.time_spent_reading = 0
-      self.time_spent_traversing_tree = 0
-      self.time_spent_writing = 0
-      self.time_spent_writing_blocks = 0
-      self.__NODE_KEY_VALUE = 0
-      self.__NODE_KEY_LAST_USED = 1
+      self.shared = False
+      self.snapshot_generation = 0
+      self.snapshot_interval = 60
+      self.snapshot_time = 0
+      self.snapshots = {}
+      self.sql_profiler = None
+      self.string_cache_entries = 100000
+      self.throughput_reported = None
+      self.tree_generation = 0
+      self.usage = None
+      self.usage_dirty = False
+      self.write_lock = threading.RLock()
+      self.__conn = None
+      self.__connections_opened = []
+      # Estimated memory used by a dentry cache entry apart from its name (the
+      # cache entry, its key and value tuples and the integers they contain).
+      self.__DENTRY_OVERHEAD = 250
 
       # Initialize a Logger() object to handle logging.
       self.logger = logging.getLogger('dedupfs')
@@ -151,10 +258,34 @@ class DedupFS(fuse.Fuse): # {{{1
       self.parser.add_option('--log-file', dest='log_file', help="specify log file location")
       self.parser.add_option('--metastore', dest='metastore', metavar='FILE', default=self.metastore_file, help="specify the location of the file in which metadata is stored")
       self.parser.add_option('--datastore', dest='datastore', metavar='FILE', default=self.datastore_file, help="specify the location of the file in which data blocks are stored")
+      self.parser.add_option('--datastore-backend', dest='datastore_backend', metavar='MODULE', type='choice', choices=['gdbm', 'dbhash', 'dbm', 'dumbdbm'], help="specify the dbm module used to create new data stores (existing data stores are always accessed through the module that created them, the default is gdbm when it's available)")
       self.parser.add_option('--block-size', dest='block_size', metavar='BYTES', default=self.block_size, type='int', help="specify the maximum block size in bytes" + option_stored_in_db)
+      self.parser.add_option('--dentry-cache-entries', dest='dentry_cache_entries', metavar='COUNT', default=self.dentry_cache_entries, type='int', help="specify the maximum number of directory entries kept in the path lookup cache")
+      self.parser.add_option('--dentry-cache-bytes', dest='dentry_cache_bytes', metavar='BYTES', default=self.dentry_cache_bytes, type='int', help="specify the (estimated) maximum amount of memory used by the path lookup cache")
+      self.parser.add_option('--negative-cache-entries', dest='negative_cache_entries', metavar='COUNT', default=self.negative_cache_entries, type='int', help="specify the maximum number of nonexistent pathnames remembered by the path lookup cache (0 disables the negative cache)")
+      self.parser.add_option('--string-cache-entries', dest='string_cache_entries', metavar='COUNT', default=self.string_cache_entries, type='int', help="specify the maximum number of interned path segments kept in memory")
+      self.parser.add_option('--inline-threshold', dest='inline_threshold', metavar='BYTES', default=self.inline_threshold, type='int', help="store files up to this size inline in the metadata store instead of splitting them into data blocks (0 disables inline storage)")
+      self.parser.add_option('--read-only', dest='read_only', action='store_true', default=False, help="mount the file system read only, this works while the store is mounted read/write elsewhere with --allow-readers or --multithreaded")
+      self.parser.add_option('--allow-readers', dest='allow_readers', action='store_true', default=False, help="let read only mounts and offline commands like report use the store while it's mounted (the metadata store is switched to SQLite's write-ahead log)")
+      self.parser.add_option('--snapshot-interval', dest='snapshot_interval', metavar='SECONDS', type='int', default=self.snapshot_interval, help="specify how often read only mounts switch to the latest state of the store (changes become visible at this interval); a writer that allows readers keeps unused data blocks for this long before deleting them, so read only mounts shouldn't use a longer interval than the writer")
+      self.parser.add_option('--multithreaded', dest='multithreaded', action='store_true', default=False, help="handle file system operations in multiple threads, each with its own connection to the metadata store, so that reads don't have to wait for slow writes or garbage collection (changes are still applied one at a time, the metadata store is switched to SQLite's write-ahead log)")
       self.parser.add_option('--no-transactions', dest='use_transactions', action='store_false', default=True, help="don't use transactions when making multiple related changes, this might make the file system faster or slower (?)")
       self.parser.add_option('--nosync', dest='synchronous', action='store_false', default=True, help="disable SQLite's normal synchronous behavior which guarantees that data is written to disk immediately, because it slows down the file system too much (this means you might lose data when the mount point isn't cleanly unmounted)")
+      self.parser.add_option('--sqlite-page-size', dest='page_size', metavar='BYTES', type='int', help="specify the page size of the metadata store, a power of two between 512 and 65536" + option_stored_in_db)
+      self.parser.add_option('--sqlite-cache-size', dest='sqlite_cache_size', metavar='N', type='int', help="specify the size of SQLite's page cache in pages, or in KiB when N is negative")
+      self.parser.add_option('--sqlite-mmap-size', dest='sqlite_mmap_size', metavar='BYTES', type='int', help="let SQLite access up to this many bytes of the metadata store through memory mapped I/O")
+      self.parser.add_option('--sqlite-temp-store', dest='sqlite_temp_store', metavar='LOCATION', type='choice', choices=metastore.TEMP_STORE_CHOICES, help="specify where SQLite keeps temporary tables and indexes (one of %s)" % ', '.join(metastore.TEMP_STORE_CHOICES))
+      self.parser.add_option('--sqlite-journal-mode', dest='sqlite_journal_mode', metavar='MODE', type='choice', choices=metastore.JOURNAL_MODE_CHOICES, help="specify SQLite's journal mode (one of %s)" % ', '.join(metastore.JOURNAL_MODE_CHOICES))
       self.parser.add_option('--nogc', dest='gc_enabled', action='store_false', default=True, help="disable the periodic garbage collection because it degrades performance (only do this when you've got disk space to waste or you know that nothing will be be deleted from the file system, which means little to no garbage will be produced)")
+      self.parser.add_option('--no-metrics', dest='metrics_enabled', action='store_false', default=True, help="don't keep track of the number and latency of file system operations (this saves a little bit of CPU time per operation but disables most of the statistics)")
+      self.parser.add_option('--dry-run', dest='dry_run', action='store_true', default=False, help="make the collapse command report what it would change without changing anything")
+      self.parser.add_option('--repair', dest='repair', action='store_true', default=False, help="make the fsck command repair the problems it finds in the metadata store")
+      self.parser.add_option('--dictionary-threshold', dest='dictionary_threshold', metavar='BYTES', default=self.dictionary_threshold, type='int', help="compress data blocks and inline data smaller than this using zlib and the dictionary created by the train-dictionary command, when compression is enabled (0 disables the dictionary)")
+      self.parser.add_option('--worker-threads', dest='worker_threads', metavar='N', type='int', default=get_cpu_count(), help="specify the number of threads used by the import, export and fsck commands to (de)compress and hash data blocks (defaults to the number of CPUs)")
+      self.parser.add_option('--report-depth', dest='report_depth', metavar='N', type='int', help="only list directories up to N levels below the PATH given to the report command")
+      self.parser.add_option('--report-files', dest='report_files', action='store_true', default=False, help="make the report command list files as well as directories")
+      self.parser.add_option('--profile-sql', dest='profile_sql', action='store_true', default=False, help="keep track of the number of calls, time spent and rows per SQL statement and calling method, available as %s/sql and reported with the other statistics" % CONTROL_DIR)
+      self.parser.add_option('--slow-query-threshold', dest='slow_query_threshold', metavar='MS', type='float', default=100, help="with --profile-sql, log the SQL statements that take longer than this many milliseconds in %s/sql" % CONTROL_DIR)
       self.parser.add_option('--verify-writes', dest='verify_writes', action='store_true', default=False, help="after writing a new data block to the database, check that the block was written correctly by reading it back again and checking for differences")
 
       # Dynamically check for supported hashing algorithms.
@@ -163,21 +294,17 @@ class DedupFS(fuse.Fuse): # {{{1
       msg %= ', '.join('%r' % fun for fun in hash_functions)
       self.parser.add_option('--hash', dest='hash_function', metavar='FUNCTION', type='choice', choices=hash_functions, default='sha1', help=msg)
 
-      # Dynamically check for supported compression methods.
-      def noop(s): return s
-      self.compressors = { 'none': (noop, noop) }
-      compression_methods = ['none']
-      for modname in 'lzo', 'zlib', 'bz2':
-        try:
-          module = __import__(modname)
-          if hasattr(module, 'compress') and hasattr(module, 'decompress'):
-            self.compressors[modname] = (module.compress, module.decompress)
-            compression_methods.append(modname)
-        except ImportError:
-          pass
-      msg = "enable compression of data blocks using one of the supported compression methods: one of %s" + option_stored_in_db
-      msg %= ', '.join('%r' % mth for mth in compression_methods[1:])
-      self.parser.add_option('--compress', dest='compression_method', metavar='METHOD', type='choice', choices=compression_methods, default='none', help=msg)
+      # Dynamically check for supported compression methods. Every data block
+      # is tagged with the method used to store it, so (unlike the block size
+      # and hash function) the methods can be changed at any time.
+      self.compressors = compression.load_compressors()
+      compression_methods = sorted(self.compressors.keys())
+      option_remembered = " (your choice is stored in the database and used until you choose another method)"
+      msg = "enable compression of data blocks written through the file system using one of the supported compression methods: one of %s" + option_remembered
+      msg %= ', '.join('%r' % mth for mth in compression_methods)
+      self.parser.add_option('--compress', dest='compression_method', metavar='METHOD', type='choice', choices=compression_methods, help=msg)
+      msg = "specify the compression method used for cold data, i.e. the data blocks stored by the import command (defaults to the method chosen using --compress)" + option_remembered
+      self.parser.add_option('--cold-compress', dest='cold_compression_method', metavar='METHOD', type='choice', choices=compression_methods, help=msg)
 
       # Dynamically check for profiling support.
       try:
@@ -197,6 +324,8 @@ class DedupFS(fuse.Fuse): # {{{1
   def access(self, path, flags): # {{{3
     try:
       self.__log_call('access', 'access(%r, %o)', path, flags)
+      if path in self.control_files or path == CONTROL_DIR:
+        return flags & os.W_OK and path not in self.control_commands and -errno.EACCES or 0
       inode = self.__path2keys(path)[1]
       if flags != os.F_OK and not self.__access(inode, flags):
         return -errno.EACCES
@@ -230,6 +359,7 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('create', 'create(%r, %o, %o)', path, flags, mode)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes()
       try:
         # If the file already exists, just open it.
         status = self.open(path, flags, nested=True)
@@ -254,8 +384,10 @@ class DedupFS(fuse.Fuse): # {{{1
       if not self.read_only:
         self.logger.info("Committing outstanding changes to `%s'.", self.metastore_file)
         self.__dbmcall('sync')
+        self.__save_usage()
         self.conn.commit()
-      self.conn.close()
+      for conn in self.__connections_opened:
+        conn.close()
       self.__dbmcall('close')
       return 0
     except Exception, e:
@@ -265,12 +397,46 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       # Process the custom command line options defined in __init__().
       options = self.cmdline[0]
+      self.read_only = self.read_only or options.read_only
       self.block_size = options.block_size
       self.compression_method = options.compression_method
+      self.cold_compression_method = options.cold_compression_method
+      self.datastore_backend = options.datastore_backend
       self.datastore_file = self.__check_data_file(options.datastore, silent)
+      self.dentries = LRUCache(max(1, options.dentry_cache_entries), max(0, options.dentry_cache_bytes))
+      self.negative_dentries = LRUCache(max(0, options.negative_cache_entries))
+      self.interned_strings = LRUCache(max(1, options.string_cache_entries))
+      self.metrics.enabled = options.metrics_enabled
+      if options.profile_sql:
+        self.sql_profiler = SQLProfiler(options.slow_query_threshold / 1000.0, ['__fetchval'])
+        self.control_files[CONTROL_DIR + '/sql'] = self.__generate_sql_profile
+      self.__register_gauges()
       self.gc_enabled = options.gc_enabled
       self.hash_function = options.hash_function
+      self.inline_threshold = min(options.inline_threshold, options.block_size)
+      self.dictionary_threshold = options.dictionary_threshold
       self.metastore_file = self.__check_data_file(options.metastore, silent)
+      if self.read_only and not os.path.exists(self.metastore_file):
+        # Don't create an empty store that can't be initialized.
+        self.logger.critical("Error: The metadata store %r doesn't exist!", self.metastore_file)
+        sys.exit(1)
+      self.page_size = options.page_size
+      self.sqlite_settings = dict((n, getattr(options, 'sqlite_' + n)) for n in metastore.TUNABLE_PRAGMAS)
+      self.snapshot_interval = options.snapshot_interval
+      # The metadata store can only be shared when it's accessed through
+      # normal (not exclusive) locking.
+      self.shared = options.multithreaded or options.allow_readers or self.read_only
+      if self.read_only:
+        # Readers use the journal mode chosen by the writer.
+        self.sqlite_settings['journal_mode'] = None
+      elif self.shared:
+        # Readers can only continue while another connection writes when
+        # the write-ahead log is used.
+        if self.sqlite_settings['journal_mode'] not in (None, 'wal'):
+          self.logger.warning("Ignoring --sqlite-journal-mode=%s argument, --multithreaded and --allow-readers require the write-ahead log.", self.sqlite_settings['journal_mode'])
+        self.sqlite_settings['journal_mode'] = 'wal'
+      if options.multithreaded:
+        self.connections = threading.local()
       self.synchronous = options.synchronous
       self.use_transactions = options.use_transactions
       self.verify_writes = options.verify_writes
@@ -278,6 +444,7 @@ class DedupFS(fuse.Fuse): # {{{1
       self.__init_logging(options)
       self.__log_call('fsinit', 'fsinit()')
       self.__setup_database_connections(silent)
+      self.__check_schema_version(silent)
       if not self.read_only:
         self.__init_metastore()
       self.__get_opts_from_db(options)
@@ -297,6 +464,7 @@ class DedupFS(fuse.Fuse): # {{{1
       # configured block size that was used to create the database (see the
       # set_block_size() call).
       self.__select_compress_method(options, silent)
+      self.__load_usage()
       return 0
     except Exception, e:
       self.__except_to_status('fsinit', e, errno.EIO)
@@ -308,6 +476,8 @@ class DedupFS(fuse.Fuse): # {{{1
   def getattr(self, path): # {{{3
     try:
       self.__log_call('getattr', 'getattr(%r)', path)
+      if path in self.control_files or path == CONTROL_DIR:
+        return self.__control_getattr(path)
       inode = self.__path2keys(path)[1]
       query = 'SELECT inode, nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime FROM inodes WHERE inode = ?'
       attrs = self.conn.execute(query, (inode,)).fetchone()
@@ -340,16 +510,15 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('link', '%slink(%r -> %r)', nested and ' ' or '', target_path, link_path)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes(nested)
       target_ino = self.__path2keys(target_path)[1]
       link_parent, link_name = os.path.split(link_path)
       link_parent_id, link_parent_ino = self.__path2keys(link_parent)
-      string_id = self.__intern(link_name)
-      self.conn.execute('INSERT INTO tree (parent_id, name, inode) VALUES (?, ?, ?)', (link_parent_id, string_id, target_ino))
-      node_id = self.__fetchval('SELECT last_insert_rowid()')
+      node_id = self.__insert_node(link_parent_id, link_name, target_ino)
       self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (target_ino,))
       if self.__fetchval('SELECT mode FROM inodes WHERE inode = ?', target_ino) & stat.S_IFDIR:
         self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (link_parent_ino,))
-      self.__cache_set(link_path, (node_id, target_ino))
+      self.__cache_set(link_parent_id, link_name, (node_id, target_ino))
       self.__commit_changes(nested)
       self.__gc_hook(nested)
       return 0
@@ -362,6 +531,7 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('mkdir', 'mkdir(%r, %o)', path, mode)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes()
       inode, parent_ino = self.__insert(path, mode | stat.S_IFDIR, 1024 * 4)
       self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (parent_ino,))
       self.__commit_changes()
@@ -375,6 +545,7 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('mknod', 'mknod(%r, %o)', path, mode)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes()
       self.__insert(path, mode, 0, rdev)
       self.__commit_changes()
       self.__gc_hook()
@@ -386,6 +557,18 @@ class DedupFS(fuse.Fuse): # {{{1
   def open(self, path, flags, nested=None, inode=None): # {{{3
     try:
       self.__log_call('open', 'open(%r, %o)', path, flags)
+      if path in self.control_files:
+        if flags & (os.O_WRONLY | os.O_RDWR):
+          if path not in self.control_commands:
+            return -errno.EACCES
+          return self.read_only and -errno.EROFS or 0
+        # Keep the contents generated by getattr() so that they match the
+        # reported file size.
+        if path not in self.control_contents:
+          self.control_contents[path] = self.control_files[path]()
+        return 0
+      if self.read_only and flags & (os.O_WRONLY | os.O_RDWR):
+        return -errno.EROFS
       # Make sure the file exists?
       inode = inode or self.__path2keys(path)[1]
       # Make sure the file is readable and/or writable.
@@ -402,12 +585,17 @@ class DedupFS(fuse.Fuse): # {{{1
   def read(self, path, length, offset): # {{{3
     try:
       self.__log_call('read', 'read(%r, %i, %i)', path, length, offset)
-      start_time = time.time()
-      buf = self.__get_file_buffer(path)
-      buf.seek(offset)
-      data = buf.read(length)
-      self.time_spent_reading += time.time() - start_time
-      self.bytes_read += len(data)
+      if path in self.control_files:
+        return self.control_contents.get(path, '')[offset : offset + length]
+      lock = self.__buffer_lock(path)
+      lock.acquire()
+      try:
+        buf = self.__get_file_buffer(path)
+        buf.seek(offset)
+        data = buf.read(length)
+      finally:
+        lock.release()
+      self.metrics.count('bytes_read', len(data))
       return data
     except Exception, e:
       return self.__except_to_status('read', e, code=errno.EIO)
@@ -417,6 +605,12 @@ class DedupFS(fuse.Fuse): # {{{1
     # an "ino" field, otherwise not a single directory entry will be listed!
     try:
       self.__log_call('readdir', 'readdir(%r, %i)', path, offset)
+      if path == CONTROL_DIR:
+        yield fuse.Direntry('.', ino=CONTROL_INODE)
+        yield fuse.Direntry('..')
+        for pathname in sorted(self.control_files):
+          yield fuse.Direntry(os.path.basename(pathname), ino=self.__control_inode(pathname))
+        return
       node_id, inode = self.__path2keys(path)
       yield fuse.Direntry('.', ino=inode)
       yield fuse.Direntry('..')
@@ -438,32 +632,44 @@ class DedupFS(fuse.Fuse): # {{{1
   def release(self, path, flags): # {{{3
     try:
       self.__log_call('release', 'release(%r, %o)', path, flags)
-      # Flush the write buffer?!
-      if path in self.buffers:
-        buf = self.buffers[path]
-        # Flush the write buffer?
-        if buf.dirty:
-          # Record start time so we can calculate average write speed.
-          start_time = time.time()
-          # Make sure the file exists and get its inode number.
-          inode = self.__path2keys(path)[1]
-          # Save apparent file size before possibly compressing data.
-          apparent_size = len(buf)
-          # Split up that string in the configured block size, hash the
-          # resulting blocks and store any new blocks.
-          try:
-            self.__write_blocks(inode, buf, apparent_size)
-            self.__commit_changes()
-          except Exception, e:
-            self.__rollback_changes()
-            raise
-          # Record the number of bytes written and the elapsed time.
-          self.bytes_written += apparent_size
-          self.time_spent_writing += time.time() - start_time
-          self.__gc_hook()
-        # Delete the buffer.
-        buf.close()
-        del self.buffers[path]
+      if path in self.control_files:
+        return 0
+      lock = self.__buffer_lock(path)
+      lock.acquire()
+      try:
+        # Flush the write buffer?!
+        if path in self.buffers:
+          buf = self.buffers[path]
+          # Flush the write buffer?
+          if buf.dirty:
+            self.write_lock.acquire()
+            try:
+              # Record start time so we can calculate average write speed.
+              start_time = self.metrics.start()
+              # Make sure the file exists and get its inode number.
+              inode = self.__path2keys(path)[1]
+              # Save apparent file size before possibly compressing data.
+              apparent_size = len(buf)
+              # Split up that string in the configured block size, hash the
+              # resulting blocks and store any new blocks.
+              try:
+                self.__begin_changes()
+                self.__write_blocks(inode, buf, apparent_size)
+                self.__commit_changes()
+              except Exception, e:
+                self.__rollback_changes()
+                raise
+              # Record the number of bytes written and the elapsed time.
+              self.metrics.count('bytes_written', apparent_size)
+              self.metrics.stop('flush', start_time)
+              self.__gc_hook()
+            finally:
+              self.write_lock.release()
+          # Delete the buffer.
+          buf.close()
+          del self.buffers[path]
+      finally:
+        lock.release()
       return 0
     except Exception, e:
       return self.__except_to_status('release', e, errno.EIO)
@@ -472,17 +678,46 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('rename', 'rename(%r -> %r)', old_path, new_path)
       if self.read_only: return -errno.EROFS
-      # Try to remove the existing target path (if if exists).
-      # NB: This also makes sure target directories are empty.
+      if old_path == new_path:
+        return 0
+      # A directory can't be moved into its own subtree.
+      if new_path.startswith(old_path.rstrip('/') + '/'):
+        return -errno.EINVAL
+      old_parent, old_name = os.path.split(old_path)
+      new_parent, new_name = os.path.split(new_path)
+      old_parent_id, old_parent_ino = self.__path2keys(old_parent)
+      node_id, inode = self.__path2keys(old_path)
+      new_parent_id, new_parent_ino = self.__path2keys(new_parent)
+      if new_parent_id == 1 and new_name == CONTROL_DIR[1:]:
+        return -errno.EPERM
+      is_dir = stat.S_ISDIR(self.__fetchval('SELECT mode FROM inodes WHERE inode = ?', inode))
+      # Replace the target path if it exists (directories must be empty).
       try:
-        self.__remove(new_path, check_empty=True)
+        target_ino = self.__path2keys(new_path)[1]
       except OSError, e:
-        # Ignore errno.ENOENT, re raise other exceptions.
         if e.errno != errno.ENOENT: raise
-      # Link the new path to the same inode as the old path.
-      self.link(old_path, new_path, nested=True)
-      # Finally unlink the old path.
-      self.unlink(old_path, nested=True)
+        target_ino = None
+      else:
+        if target_ino == inode:
+          # Both paths are links to the same inode.
+          return 0
+        target_is_dir = stat.S_ISDIR(self.__fetchval('SELECT mode FROM inodes WHERE inode = ?', target_ino))
+        if is_dir != target_is_dir:
+          return -(is_dir and errno.ENOTDIR or errno.EISDIR)
+      self.__begin_changes()
+      if target_ino is not None:
+        self.__remove(new_path, check_empty=True)
+      # Move the tree node, its subtree moves along because the nodes below
+      # it refer to it by id (so do the cached directory entries).
+      query = 'UPDATE tree SET parent_id = ?, name = ?, name_hash = ? WHERE id = ?'
+      self.conn.execute(query, (new_parent_id, self.__intern(new_name), metastore.name_hash(new_name), node_id))
+      if is_dir and old_parent_ino != new_parent_ino:
+        self.conn.execute('UPDATE inodes SET nlinks = nlinks - 1 WHERE inode = ?', (old_parent_ino,))
+        self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (new_parent_ino,))
+      self.__cache_set(old_parent_id, old_name, None)
+      self.__cache_set(new_parent_id, new_name, None)
+      self.__cache_set(new_parent_id, new_name, (node_id, inode))
+      self.__rename_buffers(old_path, new_path)
       self.__commit_changes()
       self.__gc_hook()
       return 0
@@ -494,6 +729,7 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('rmdir', 'rmdir(%r)', path)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes()
       self.__remove(path, check_empty=True)
       self.__commit_changes()
       return 0
@@ -504,11 +740,13 @@ class DedupFS(fuse.Fuse): # {{{1
   def statfs(self): # {{{3
     try:
       self.__log_call('statfs', 'statfs()')
-      # Use os.statvfs() to report the host file system's storage capacity.
+      # Use os.statvfs() to report the host file system's free space and the
+      # disk usage counters to report the space used by this file system.
       host_fs = os.statvfs(self.metastore_file)
+      used = self.usage['stored_bytes'] + self.usage['inline_bytes']
       return StatVFS(f_bavail  = (host_fs.f_bsize * host_fs.f_bavail) / self.block_size, # The total number of free blocks available to a non privileged process.
                      f_bfree   = (host_fs.f_frsize * host_fs.f_bfree) / self.block_size, # The total number of free blocks in the file system.
-                     f_blocks  = (host_fs.f_frsize * host_fs.f_blocks) / self.block_size, # The total number of blocks in the file system in terms of f_frsize.
+                     f_blocks  = (used + host_fs.f_frsize * host_fs.f_bfree) / self.block_size, # The total number of blocks in the file system in terms of f_frsize.
                      f_bsize   = self.block_size, # The file system block size in bytes.
                      f_favail  = 0, # The number of free file serial numbers available to a non privileged process.
                      f_ffree   = 0, # The total number of free file serial numbers.
@@ -524,6 +762,7 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('symlink', 'symlink(%r -> %r)', link_path, target_path)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes()
       # Create an inode to hold the symbolic link.
       inode, parent_ino = self.__insert(link_path, self.link_mode, len(target_path))
       # Save the symbolic link's target.
@@ -539,12 +778,23 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('truncate', 'truncate(%r, %i)', path, size)
       if self.read_only: return -errno.EROFS
+      if path in self.control_commands:
+        return 0
+      self.__begin_changes()
       inode = self.__path2keys(path)[1]
-      last_block = size / self.block_size
-      self.conn.execute('DELETE FROM "index" WHERE inode = ? AND block_nr > ?', (inode, last_block))
-      self.conn.execute('UPDATE inodes SET size = ? WHERE inode = ?', (size, inode))
-      self.__gc_hook()
+      data = self.__read_inline(inode)
+      if data is not None:
+        # Inline data is rewritten (and promoted to data blocks if necessary).
+        buf = Buffer()
+        buf.write(data[:size].ljust(size, '\0'))
+        self.__write_blocks(inode, buf, size)
+        buf.close()
+      else:
+        last_block = size / self.block_size
+        self.__release_blocks(inode, last_block + 1)
+        self.__set_size(inode, size)
       self.__commit_changes()
+      self.__gc_hook()
       return 0
     except Exception, e:
       self.__rollback_changes()
@@ -554,6 +804,7 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       self.__log_call('unlink', '%sunlink(%r)', nested and ' ' or '', path)
       if self.read_only: return -errno.EROFS
+      self.__begin_changes(nested)
       self.__remove(path)
       self.__commit_changes(nested)
     except Exception, e:
@@ -590,18 +841,71 @@ class DedupFS(fuse.Fuse): # {{{1
     try:
       length = len(data)
       self.__log_call('write', 'write(%r, %i, %i)', path, offset, length)
-      start_time = time.time()
-      buf = self.__get_file_buffer(path)
-      buf.seek(offset)
-      buf.write(data)
-      self.time_spent_writing += time.time() - start_time
-      # self.bytes_written is incremented from release().
+      if self.read_only: return -errno.EROFS
+      if path in self.control_commands:
+        # Commands are executed right away so that errors are reported to
+        # the writer.
+        for line in data.splitlines():
+          if line.strip():
+            self.control_commands[path](line)
+        return length
+      lock = self.__buffer_lock(path)
+      lock.acquire()
+      try:
+        buf = self.__get_file_buffer(path)
+        buf.seek(offset)
+        buf.write(data)
+      finally:
+        lock.release()
+      # The bytes_written counter is incremented from release().
       return length
     except Exception, e:
       return self.__except_to_status('write', e, errno.EIO)
 
   # Miscellaneous methods: {{{2
 
+  def main(self, *args, **kw): # {{{3
+    # The Python FUSE binding looks up the FUSE API methods when main() is
+    # called, so this is where they're wrapped to serialize changes in
+    # multithreaded mode and to record their latency.
+    if self.cmdline[0].multithreaded:
+      self.multithreaded = 1
+      for name in MUTATING_OPERATIONS:
+        setattr(self, name, self.__serialize(getattr(self, name)))
+    if self.cmdline[0].metrics_enabled:
+      for name in FUSE_OPERATIONS:
+        setattr(self, name, self.metrics.wrap('fuse.' + name, getattr(self, name)))
+    return fuse.Fuse.main(self, *args, **kw)
+
+  def __serialize(self, function): # {{{3
+    lock = self.write_lock
+    def wrapper(*args, **kw):
+      lock.acquire()
+      try:
+        return function(*args, **kw)
+      finally:
+        lock.release()
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+  def __buffer_lock(self, path): # {{{3
+    # The buffers of open files are protected by a fixed number of locks
+    # (selected by hashing the pathname) instead of one lock per file, so
+    # that the locks don't have to be created and cleaned up.
+    return self.buffer_locks[hash(path) % BUFFER_LOCKS]
+
+  def __register_gauges(self): # {{{3
+    metrics = self.metrics
+    metrics.gauge('dentry_cache.entries', lambda: len(self.dentries))
+    metrics.gauge('dentry_cache.bytes', lambda: self.dentries.nbytes)
+    metrics.gauge('dentry_cache.hit_rate', self.dentries.hit_rate)
+    metrics.gauge('negative_cache.entries', lambda: len(self.negative_dentries))
+    metrics.gauge('negative_cache.hit_rate', self.negative_dentries.hit_rate)
+    metrics.gauge('string_cache.entries', lambda: len(self.interned_strings))
+    metrics.gauge('string_cache.hit_rate', self.interned_strings.hit_rate)
+    metrics.gauge('open_buffers', lambda: len(self.buffers))
+    metrics.gauge('memory_usage', get_memory_usage)
+
   def __init_logging(self, options): # {{{3
     # Configure logging of messages to a file.
     if options.log_file:
@@ -623,73 +927,136 @@ class DedupFS(fuse.Fuse): # {{{1
     # fuse.FuseGetContext().
     uid, gid = os.getuid(), os.getgid()
     t = self.__newctime()
+    # New databases are created using the current layout, existing databases
+    # are upgraded in place when possible and get the secondary indexes.
+    if self.__fetchval("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'") == 0:
+      self.conn.executescript(metastore.schema())
+      self.conn.execute("INSERT INTO options (name, value) VALUES ('schema_version', ?)", (metastore.SCHEMA_VERSION,))
+    else:
+      version = metastore.upgrade(self.conn)
+      if version is not None:
+        self.logger.info("Upgraded %r from layout version %i to %i.", self.metastore_file, version, metastore.SCHEMA_VERSION)
+    self.conn.executescript(metastore.indexes())
     self.conn.executescript("""
 
-      -- Create the required tables?
-      CREATE TABLE IF NOT EXISTS tree (id INTEGER PRIMARY KEY, parent_id INTEGER, name INTEGER NOT NULL, inode INTEGER NOT NULL, UNIQUE (parent_id, name));
-      CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value BLOB NOT NULL UNIQUE);
-      CREATE TABLE IF NOT EXISTS inodes (inode INTEGER PRIMARY KEY, nlinks INTEGER NOT NULL, mode INTEGER NOT NULL, uid INTEGER, gid INTEGER, rdev INTEGER, size INTEGER, atime INTEGER, mtime INTEGER, ctime INTEGER);
-      CREATE TABLE IF NOT EXISTS links (inode INTEGER UNIQUE, target BLOB NOT NULL);
-      CREATE TABLE IF NOT EXISTS hashes (id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE);
-      CREATE TABLE IF NOT EXISTS "index" (inode INTEGER, hash_id INTEGER, block_nr INTEGER, PRIMARY KEY (inode, hash_id, block_nr));
-      CREATE TABLE IF NOT EXISTS options (name TEXT PRIMARY KEY, value TEXT NOT NULL);
-
       -- Create the root node of the file system?
       INSERT OR IGNORE INTO strings (id, value) VALUES (1, '');
-      INSERT OR IGNORE INTO tree (id, parent_id, name, inode) VALUES (1, NULL, 1, 1);
-      INSERT OR IGNORE INTO inodes (nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime) VALUES (2, %i, %i, %i, 0, 1024*4, %f, %f, %f);
+      INSERT OR IGNORE INTO tree (id, parent_id, name, inode, name_hash) VALUES (1, NULL, 1, 1, %i);
+      INSERT OR IGNORE INTO inodes (inode, nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime) VALUES (1, 2, %i, %i, %i, 0, 1024*4, %f, %f, %f);
 
       -- Save the command line options used to initialize the database?
       INSERT OR IGNORE INTO options (name, value) VALUES ('synchronous', %i);
       INSERT OR IGNORE INTO options (name, value) VALUES ('block_size', %i);
       INSERT OR IGNORE INTO options (name, value) VALUES ('compression_method', %r);
+      INSERT OR IGNORE INTO options (name, value) VALUES ('cold_compression_method', %r);
       INSERT OR IGNORE INTO options (name, value) VALUES ('hash_function', %r);
+      INSERT OR IGNORE INTO options (name, value) VALUES ('page_size', %i);
 
-    """ % (self.root_mode, uid, gid, t, t, t, self.synchronous and 1 or 0,
-           self.block_size, self.compression_method, self.hash_function))
+    """ % (metastore.name_hash(''), self.root_mode, uid, gid, t, t, t, self.synchronous and 1 or 0,
+           self.block_size, self.compression_method or 'none', self.cold_compression_method or self.compression_method or 'none',
+           self.hash_function, self.__fetchval('PRAGMA page_size')))
+    # Warn about hot queries that don't use the expected indexes.
+    if self.logger.isEnabledFor(logging.DEBUG):
+      for description, plan in metastore.check_query_plans(self.conn):
+        self.logger.debug("%s doesn't use the expected indexes: %s", description, '; '.join(plan))
 
   def __setup_database_connections(self, silent): # {{{3
     if not silent:
       self.logger.info("Using data files %r and %r.", self.metastore_file, self.datastore_file)
     # Open the key/value store containing the data blocks.
-    if not os.path.exists(self.metastore_file):
-      self.blocks = self.__open_datastore(True)
-    else:
-      from whichdb import whichdb
-      created_by_gdbm = whichdb(self.metastore_file) == 'gdbm'
-      self.blocks = self.__open_datastore(created_by_gdbm)
+    self.blocks = self.__open_datastore(self.datastore_file, self.datastore_backend, self.read_only)
+    self.conn = self.__connect()
+
+  def __connect(self): # {{{3
     # Open an SQLite database connection with manual transaction management.
-    self.conn = sqlite3.connect(self.metastore_file, isolation_level=None)
+    # In multithreaded mode connections are closed by the thread that calls
+    # fsdestroy(), so they can't be restricted to the thread that opened them.
+    conn = sqlite3.connect(self.metastore_file, isolation_level=None, timeout=60,
+        check_same_thread=self.connections is None)
+    if self.sql_profiler:
+      conn = self.sql_profiler.wrap(conn)
     # Use the built in row factory to enable named attributes.
-    self.conn.row_factory = sqlite3.Row
+    conn.row_factory = sqlite3.Row
     # Return regular strings instead of Unicode objects.
-    self.conn.text_factory = str
-    # Don't bother releasing any locks since there's currently no point in
-    # having concurrent reading/writing of the file system database.
-    self.conn.execute('PRAGMA locking_mode = EXCLUSIVE')
-
-  def __open_datastore(self, use_gdbm):
+    conn.text_factory = str
+    if not self.shared:
+      # Don't bother releasing any locks since there's no point in having
+      # concurrent reading/writing of the file system database.
+      conn.execute('PRAGMA locking_mode = EXCLUSIVE')
+    if self.read_only:
+      # Make sure nothing is ever written through read only connections.
+      conn.execute('PRAGMA query_only = ON')
+    # The page size can only be chosen before the database is initialized
+    # (the journal mode below can already do that).
+    if self.page_size and conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+      conn.execute('PRAGMA page_size = %i' % self.page_size)
+    for name, requested, effective in metastore.tune(conn, self.sqlite_settings):
+      self.logger.warning("Warning: SQLite didn't accept %s = %s, using %s instead.", name, requested, effective)
+    # Connections opened by other threads (after fsinit()) use the same
+    # synchronous setting as the first connection.
+    if self.__conn is not None and not self.synchronous:
+      conn.execute('PRAGMA synchronous = OFF')
+    self.__connections_opened.append(conn)
+    return conn
+
+  def __get_conn(self): # {{{3
+    # In multithreaded mode every thread uses its own connection to the
+    # metadata store, which is opened the first time the thread needs it.
+    if self.connections is None:
+      return self.__conn
+    conn = getattr(self.connections, 'conn', None)
+    if conn is None:
+      conn = self.connections.conn = self.__connect()
+    return conn
+
+  def __set_conn(self, conn): # {{{3
+    self.__conn = conn
+    if self.connections is not None:
+      self.connections.conn = conn
+
+  conn = property(__get_conn, __set_conn)
+
+  def __open_datastore(self, pathname, backend=None, read_only=False): # {{{3
     # gdbm is preferred over other dbm implementations because it supports fast
     # vs. synchronous modes, however any other dedicated key/value store should
     # work just fine (albeit not as fast). Note though that existing key/value
     # stores are always accessed through the library that created them.
-    mode = self.read_only and 'r' or 'c'
-    if use_gdbm:
+    from whichdb import whichdb
+    existing_backend = whichdb(pathname)
+    if read_only and existing_backend is None:
+      raise IOError, (errno.ENOENT, "The data store doesn't exist", pathname)
+    backend = existing_backend or backend
+    if not backend:
       try:
-        import gdbm
-        mode += self.synchronous and 's' or 'f'
-        return gdbm.open(self.datastore_file, mode)
+        __import__('gdbm')
+        backend = 'gdbm'
       except ImportError:
-        pass
-    import anydbm
-    return anydbm.open(self.datastore_file, mode)
+        backend = 'anydbm'
+    mode = read_only and 'r' or 'c'
+    if backend == 'gdbm':
+      # gdbm locks the whole file, readers skip that so that they can use the
+      # data store while it's open for writing (see __read_block()).
+      mode += read_only and 'u' or self.synchronous and 's' or 'f'
+    return __import__(backend).open(pathname, mode)
+
+  def __reopen_datastore(self): # {{{3
+    self.datastore_lock.acquire()
+    try:
+      self.blocks.close()
+      self.blocks = self.__open_datastore(self.datastore_file, self.datastore_backend, self.read_only)
+    finally:
+      self.datastore_lock.release()
 
   def __dbmcall(self, fun): # {{{3
     # I simply cannot find any freakin' documentation on the type of objects
     # returned by anydbm and gdbm, so cannot verify that any single method will
     # always be there, although most seem to...
     if hasattr(self.blocks, fun):
-      getattr(self.blocks, fun)()
+      self.datastore_lock.acquire()
+      try:
+        getattr(self.blocks, fun)()
+      finally:
+        self.datastore_lock.release()
 
   def __check_data_file(self, pathname, silent): # {{{3
     pathname = os.path.expanduser(pathname)
@@ -725,74 +1092,297 @@ class DedupFS(fuse.Fuse): # {{{1
       elif name == 'block_size' and int(value) != self.block_size:
         self.logger.warning("Ignoring --block-size=%i argument, using previously chosen block size %i instead", self.block_size, int(value))
         self.block_size = int(value)
-      elif name == 'compression_method' and value != self.compression_method:
-        if self.compression_method != 'none':
-          self.logger.warning("Ignoring --compress=%s argument, using previously chosen compression method %r instead", self.compression_method, value)
-        self.compression_method = value
+      elif name in ('compression_method', 'cold_compression_method'):
+        self.__update_compress_method(name, value)
+      elif name == 'page_size' and self.page_size and int(value) != self.page_size:
+        self.logger.warning("Ignoring --sqlite-page-size=%i argument, using previously chosen page size %i instead", self.page_size, int(value))
+        self.page_size = int(value)
       elif name == 'hash_function' and value != self.hash_function:
         self.logger.warning("Ignoring --hash=%s argument, using previously chosen hash function %r instead", self.hash_function, value)
         self.hash_function = value
 
+  def __check_schema_version(self, silent): # {{{3
+    # Migrations in progress and layouts this version can't use are fatal,
+    # except for the command that fixes them. New databases are created
+    # using the current layout by __init_metastore().
+    query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'options'"
+    if self.command == 'migrate' or self.__fetchval(query) == 0:
+      return
+    version = metastore.get_schema_version(self.conn)
+    if self.conn.execute("SELECT 1 FROM options WHERE name = 'migration_source'").fetchone():
+      self.logger.critical("Error: %r is the target of an unfinished migration!", self.metastore_file)
+      os._exit(1)
+    elif version < metastore.MIN_SCHEMA_VERSION:
+      self.logger.critical("Error: %r uses layout version %i which is no longer supported, please run `dedupfs.py migrate' to convert it to version %i.", self.metastore_file, version, metastore.SCHEMA_VERSION)
+      os._exit(1)
+    elif version < metastore.SCHEMA_VERSION and self.read_only:
+      # Layouts that can be upgraded in place are only upgraded by writers.
+      self.logger.critical("Error: %r uses layout version %i, please mount it for writing once to upgrade it to version %i.", self.metastore_file, version, metastore.SCHEMA_VERSION)
+      os._exit(1)
+    elif version < metastore.SCHEMA_VERSION and not silent and not metastore.can_upgrade(version):
+      self.logger.warning("%r uses layout version %i, run `dedupfs.py migrate' to convert it to the faster version %i.", self.metastore_file, version, metastore.SCHEMA_VERSION)
+
+  def __update_compress_method(self, name, value): # {{{3
+    # The compression methods stored in the database are used unless another
+    # method is given on the command line, which then replaces the stored one
+    # (existing data blocks keep the method they were stored with).
+    selected = getattr(self, name)
+    if selected is None:
+      setattr(self, name, value)
+    elif selected != value and not self.read_only:
+      self.logger.info("Switching from the %s to the %s compression method for %s data.", value, selected,
+          name == 'compression_method' and 'new' or 'cold')
+      self.conn.execute('UPDATE options SET value = ? WHERE name = ?', (selected, name))
+
   def __select_compress_method(self, options, silent): # {{{3
-    valid_formats = self.compressors.keys()
-    selected_format = self.compression_method.lower()
-    if selected_format not in valid_formats:
-      self.logger.warning("Invalid compression format `%s' selected!", selected_format)
-      selected_format = 'none'
-    if selected_format != 'none':
-      if not silent:
-        self.logger.debug("Using the %s compression method.", selected_format)
-      # My custom LZO binding defines set_block_size() which enables
-      # optimizations like preallocating a buffer that can be reused for
-      # every call to compress() and decompress().
-      if selected_format == 'lzo':
-        module = __import__('lzo')
-        if hasattr(module, 'set_block_size'):
-          module.set_block_size(self.block_size)
-    self.compress, self.decompress = self.compressors[selected_format]
+    # Metadata stores created before the cold compression method existed
+    # use the regular method for cold data as well.
+    self.compression_method = self.compression_method or 'none'
+    self.cold_compression_method = self.cold_compression_method or self.compression_method
+    for name in 'compression_method', 'cold_compression_method':
+      selected_format = getattr(self, name).lower()
+      if selected_format not in self.compressors:
+        self.logger.warning("Invalid compression format `%s' selected!", selected_format)
+        selected_format = 'none'
+      setattr(self, name, selected_format)
+    if not silent:
+      self.logger.debug("Using the %s compression method (%s for cold data).", self.compression_method, self.cold_compression_method)
+    # My custom LZO binding defines set_block_size() which makes it omit the
+    # length header of compressed blocks (the block size bounds their size
+    # instead). Blocks stored using LZO can be read whatever the current
+    # compression method is.
+    if 'lzo' in self.compressors:
+      module = __import__('lzo')
+      if hasattr(module, 'set_block_size'):
+        module.set_block_size(self.block_size)
+    self.compressor = compression.Compressor(self.compressors, dictionary_threshold=self.dictionary_threshold,
+        load_dictionary=self.__load_dictionary)
+    if self.__fetchval("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'dictionaries'"):
+      for version, dictionary in self.conn.execute('SELECT id, data FROM dictionaries'):
+        self.compressor.add_dictionary(version, str(dictionary))
+    self.compress = self.metrics.wrap('compress', self.compressor.compress)
+    self.decompress = self.metrics.wrap('decompress', self.compressor.decompress)
+
+  def __load_dictionary(self, version): # {{{3
+    # Dictionaries trained after the store was opened (by the writer that a
+    # read only mount runs next to, or by a remount) are loaded when the
+    # first block compressed using them is read.
+    row = self.conn.execute('SELECT data FROM dictionaries WHERE id = ?', (version,)).fetchone()
+    if row:
+      self.logger.debug("Loaded version %i of the compression dictionary.", version)
+      return str(row[0])
+
+  def __load_usage(self): # {{{3
+    # Load the disk usage counters, computing them when they're missing (in
+    # new databases and databases converted from older layouts).
+    query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'statistics'"
+    if self.__fetchval(query) == 0:
+      return
+    self.usage = dict(self.conn.execute('SELECT name, value FROM statistics'))
+    if [n for n in metastore.USAGE_COUNTERS if n not in self.usage]:
+      self.usage = self.__compute_usage()
+      self.usage_dirty = True
+      self.__save_usage()
+
+  def __compute_usage(self): # {{{3
+    # Determine the size of data blocks whose size isn't known yet (after
+    # migrating from an older layout) and compute the counters from scratch.
+    if not self.read_only:
+      count = 0
+      last_id = 0
+      query = 'SELECT id, hash, method FROM hashes WHERE raw_size = 0 AND id > ? ORDER BY id LIMIT 1000'
+      while True:
+        rows = self.conn.execute(query, (last_id,)).fetchall()
+        if not rows:
+          break
+        sizes = []
+        for hash_id, digest, method in rows:
+          try:
+            block = self.__get_block(str(digest))
+            sizes.append((len(block), len(self.decompress(method, block)), hash_id))
+          except KeyError:
+            self.logger.error("Data block #%i is missing from the data store!", hash_id)
+        self.conn.execute('BEGIN')
+        self.conn.executemany('UPDATE hashes SET size = ?, raw_size = ? WHERE id = ?', sizes)
+        self.conn.execute('COMMIT')
+        last_id = rows[-1][0]
+        count += len(rows)
+      if count > 0:
+        self.logger.info("Determined the size of %i data blocks.", count)
+    return metastore.compute_usage(self.conn)
+
+  def __save_usage(self): # {{{3
+    if self.usage_dirty and not self.read_only:
+      names = metastore.USAGE_COUNTERS
+      query = 'INSERT OR REPLACE INTO statistics (name, value) VALUES ' + ', '.join(['(?, ?)'] * len(names))
+      values = []
+      for name in names:
+        values.extend((name, self.usage[name]))
+      self.conn.execute(query, values)
+      self.usage_dirty = False
+
+  def __account(self, name, delta): # {{{3
+    if delta:
+      self.usage[name] += delta
+      self.usage_dirty = True
 
   def __write_blocks(self, inode, buf, apparent_size): # {{{3
-    start_time = time.time()
+    start_time = self.metrics.start()
     # Delete existing index entries for file.
-    self.conn.execute('DELETE FROM "index" WHERE inode = ?', (inode,))
-    # Store any changed blocks and rebuild the file index.
-    storage_size = len(buf)
-    for block_nr in xrange(int(math.ceil(storage_size / float(self.block_size)))):
-      buf.seek(self.block_size * block_nr, os.SEEK_SET)
-      new_block = buf.read(self.block_size)
-      digest = self.__hash(new_block)
-      encoded_digest = sqlite3.Binary(digest)
-      row = self.conn.execute('SELECT id FROM hashes WHERE hash = ?', (encoded_digest,)).fetchone()
-      if row:
-        hash_id = row[0]
-        existing_block = self.decompress(self.blocks[digest])
-        # Check for hash collisions.
-        if new_block != existing_block:
-          # Found a hash collision: dump debugging info and exit.
-          dumpfile_collision = '/tmp/dedupfs-collision-%i' % time.time()
-          handle = open(dumpfile_collision, 'w')
-          handle.write('Content of existing block is %r.\n' % existing_block)
-          handle.write('Content of new block is %r.\n' % new_block)
-          handle.close()
-          self.logger.critical(
-              "Found a hash collision on block number %i of inode %i!\n" + \
-              "The existing block is %i bytes and hashes to %s.\n"   + \
-              "The new block is %i bytes and hashes to %s.\n"        + \
-              "Saved existing and conflicting data blocks to %r.",
-              block_nr, inode, len(existing_block), digest,
-              len(new_block), digest, dumpfile_collision)
-          os._exit(1)
-        self.conn.execute('INSERT INTO "index" (inode, hash_id, block_nr) VALUES (?, ?, ?)', (inode, hash_id, block_nr))
-      else:
-        self.blocks[digest] = self.compress(new_block)
-        self.conn.execute('INSERT INTO hashes (id, hash) VALUES (NULL, ?)', (encoded_digest,))
-        self.conn.execute('INSERT INTO "index" (inode, hash_id, block_nr) VALUES (?, last_insert_rowid(), ?)', (inode, block_nr))
-        # Check that the data was properly stored in the database?
-        self.__verify_write(new_block, digest, block_nr, inode)
-      block_nr += 1
+    self.__release_blocks(inode)
+    if 0 < apparent_size <= self.inline_threshold:
+      # Small files are stored inline, next to their inode.
+      self.__write_inline(inode, buf.getvalue())
+    else:
+      # Files that grew beyond the threshold are promoted to data blocks.
+      self.__delete_inline(inode)
+      # Store any changed blocks and rebuild the file index.
+      storage_size = len(buf)
+      for block_nr in xrange(int(math.ceil(storage_size / float(self.block_size)))):
+        buf.seek(self.block_size * block_nr, os.SEEK_SET)
+        self.__store_block(inode, block_nr, buf.read(self.block_size))
     # Update file size and last modified time.
-    self.conn.execute('UPDATE inodes SET size = ?, mtime = ? WHERE inode = ?', (apparent_size, self.__newctime(), inode))
-    self.time_spent_writing_blocks += time.time() - start_time
+    self.__set_size(inode, apparent_size, self.__newctime())
+    self.metrics.stop('write_blocks', start_time)
+
+  def __set_size(self, inode, size, mtime=None): # {{{3
+    old_size = self.__fetchval('SELECT size FROM inodes WHERE inode = ?', inode)
+    if mtime is None:
+      self.conn.execute('UPDATE inodes SET size = ? WHERE inode = ?', (size, inode))
+    else:
+      self.conn.execute('UPDATE inodes SET size = ?, mtime = ? WHERE inode = ?', (size, mtime, inode))
+    self.__account('apparent_bytes', size - (old_size or 0))
+
+  def __release_blocks(self, inode, first_block_nr=0): # {{{3
+    # Delete the index entries of an inode starting at the given block number
+    # and drop the references they hold. Data blocks that are no longer
+    # referenced become garbage, they're deleted by __collect_blocks().
+    query = 'SELECT hash_id, COUNT(*) FROM "index" WHERE inode = ? AND block_nr >= ? GROUP BY hash_id'
+    references = self.conn.execute(query, (inode, first_block_nr)).fetchall()
+    if not references:
+      return 0
+    self.conn.executemany('UPDATE hashes SET refs = refs - ? WHERE id = ?', [(n, h) for h, n in references])
+    count = self.conn.execute('DELETE FROM "index" WHERE inode = ? AND block_nr >= ?', (inode, first_block_nr)).rowcount
+    hash_ids = [h for h, n in references]
+    for i in xrange(0, len(hash_ids), 500):
+      batch = hash_ids[i : i + 500]
+      query = 'SELECT COALESCE(SUM(size), 0) FROM hashes WHERE refs = 0 AND id IN (%s)' % ', '.join(['?'] * len(batch))
+      self.__account('garbage_bytes', self.__fetchval(query, *batch))
+      if self.shared:
+        # Remember when the blocks became garbage (see __collect_blocks()).
+        query = 'SELECT id FROM hashes WHERE refs = 0 AND id IN (%s)' % ', '.join(['?'] * len(batch))
+        time_now = time.time()
+        for row in self.conn.execute(query, batch):
+          self.garbage_times[row[0]] = time_now
+    return count
+
+  def __store_block(self, inode, block_nr, new_block, digest=None, encoded=None): # {{{3
+    # The digest and the (method, compressed block) pair can be computed up
+    # front (see import_tree()), the compressed block is only used if the
+    # block is new.
+    if digest is None:
+      digest = self.__hash(new_block)
+    encoded_digest = sqlite3.Binary(digest)
+    row = self.conn.execute('SELECT id, size, refs, method FROM hashes WHERE hash = ?', (encoded_digest,)).fetchone()
+    if row:
+      hash_id, size, refs, method = row
+      existing_block = self.decompress(method, self.__get_block(digest))
+      # Check for hash collisions.
+      if new_block != existing_block:
+        # Found a hash collision: dump debugging info and exit.
+        dumpfile_collision = '/tmp/dedupfs-collision-%i' % time.time()
+        handle = open(dumpfile_collision, 'w')
+        handle.write('Content of existing block is %r.\n' % existing_block)
+        handle.write('Content of new block is %r.\n' % new_block)
+        handle.close()
+        self.logger.critical(
+            "Found a hash collision on block number %i of inode %i!\n" + \
+            "The existing block is %i bytes and hashes to %s.\n"   + \
+            "The new block is %i bytes and hashes to %s.\n"        + \
+            "Saved existing and conflicting data blocks to %r.",
+            block_nr, inode, len(existing_block), digest,
+            len(new_block), digest, dumpfile_collision)
+        os._exit(1)
+      self.conn.execute('INSERT INTO "index" (inode, hash_id, block_nr) VALUES (?, ?, ?)', (inode, hash_id, block_nr))
+      self.conn.execute('UPDATE hashes SET refs = refs + 1 WHERE id = ?', (hash_id,))
+      if refs == 0:
+        # The block was garbage waiting to be collected.
+        self.__account('garbage_bytes', -size)
+      self.metrics.count('blocks_deduplicated')
+    else:
+      method, stored_block = encoded or self.compress(new_block, self.compression_method)
+      self.__put_block(digest, stored_block)
+      self.metrics.count('blocks_stored')
+      self.metrics.count('bytes_stored', len(stored_block))
+      query = 'INSERT INTO hashes (id, hash, size, raw_size, refs, method) VALUES (NULL, ?, ?, ?, 1, ?)'
+      self.conn.execute(query, (encoded_digest, len(stored_block), len(new_block), method))
+      self.__account('blocks', 1)
+      self.__account('stored_bytes', len(stored_block))
+      self.__account('unique_bytes', len(new_block))
+      self.conn.execute('INSERT INTO "index" (inode, hash_id, block_nr) VALUES (?, last_insert_rowid(), ?)', (inode, block_nr))
+      # Check that the data was properly stored in the database?
+      self.__verify_write(new_block, digest, method, block_nr, inode)
+
+  def __read_block(self, digest, method): # {{{3
+    # Get the uncompressed contents of a data block. A read only mount shares
+    # the data store with a writer that may have reorganized it (or deleted
+    # and reused the space of garbage blocks) since the data store was
+    # opened, so blocks are checked against their digest and the data store
+    # is reopened once when a block is missing or doesn't match.
+    if not self.read_only:
+      return self.decompress(method, self.__get_block(digest))
+    try:
+      block = self.decompress(method, self.__get_block(digest))
+      if self.__hash(block) == digest:
+        return block
+    except Exception:
+      pass
+    self.__reopen_datastore()
+    block = self.decompress(method, self.__get_block(digest))
+    if self.__hash(block) != digest:
+      raise IOError, (errno.EIO, "Data block doesn't match its digest", digest.encode('hex'))
+    return block
+
+  def __get_block(self, digest): # {{{3
+    start_time = self.metrics.start()
+    self.datastore_lock.acquire()
+    try:
+      block = self.blocks[digest]
+    finally:
+      self.datastore_lock.release()
+    self.metrics.stop('datastore_get', start_time)
+    return block
+
+  def __put_block(self, digest, block): # {{{3
+    start_time = self.metrics.start()
+    self.datastore_lock.acquire()
+    try:
+      self.blocks[digest] = block
+    finally:
+      self.datastore_lock.release()
+    self.metrics.stop('datastore_put', start_time)
+
+  def __write_inline(self, inode, data): # {{{3
+    # Compress inline data using the configured method, but only if that
+    # actually makes it smaller.
+    method, stored = self.compress(data, self.compression_method)
+    old_size = self.conn.execute('SELECT LENGTH(data) FROM inline_data WHERE inode = ?', (inode,)).fetchone()
+    query = 'INSERT OR REPLACE INTO inline_data (inode, method, data) VALUES (?, ?, ?)'
+    self.conn.execute(query, (inode, method, sqlite3.Binary(stored)))
+    self.metrics.count('bytes_stored', len(stored))
+    self.__account('inline_bytes', len(stored) - (old_size and old_size[0] or 0))
+
+  def __delete_inline(self, inode): # {{{3
+    row = self.conn.execute('SELECT LENGTH(data) FROM inline_data WHERE inode = ?', (inode,)).fetchone()
+    if row:
+      self.conn.execute('DELETE FROM inline_data WHERE inode = ?', (inode,))
+      self.__account('inline_bytes', -row[0])
+
+  def __read_inline(self, inode): # {{{3
+    # Returns None when the file isn't stored inline.
+    row = self.conn.execute('SELECT method, data FROM inline_data WHERE inode = ?', (inode,)).fetchone()
+    if row:
+      return self.compressor.decompress(row[0], str(row[1]))
 
   def __insert(self, path, mode, size, rdev=0): # {{{3
     parent, name = os.path.split(path)
@@ -800,43 +1390,73 @@ class DedupFS(fuse.Fuse): # {{{1
     nlinks = mode & stat.S_IFDIR and 2 or 1
     t = self.__newctime()
     uid, gid = self.__getctx()
-    self.conn.execute('INSERT INTO inodes (nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (nlinks, mode, uid, gid, rdev, size, t, t, t))
-    inode = self.__fetchval('SELECT last_insert_rowid()')
-    string_id = self.__intern(name)
-    self.conn.execute('INSERT INTO tree (parent_id, name, inode) VALUES (?, ?, ?)', (parent_id, string_id, inode))
-    node_id = self.__fetchval('SELECT last_insert_rowid()')
-    self.__cache_set(path, (node_id, inode))
+    query = 'INSERT INTO inodes (nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    inode = self.conn.execute(query, (nlinks, mode, uid, gid, rdev, size, t, t, t)).lastrowid
+    node_id = self.__insert_node(parent_id, name, inode)
+    self.__cache_set(parent_id, name, (node_id, inode))
     return inode, parent_ino
 
+  def __insert_node(self, parent_id, name, inode): # {{{3
+    if parent_id == 1 and name == CONTROL_DIR[1:]:
+      raise OSError, (errno.EEXIST, os.strerror(errno.EEXIST), CONTROL_DIR)
+    # The name hash is stored next to the interned name so that lookups in
+    # huge directories are a single index probe (see __path2keys()).
+    query = 'INSERT INTO tree (parent_id, name, inode, name_hash) VALUES (?, ?, ?, ?)'
+    values = (parent_id, self.__intern(name), inode, metastore.name_hash(name))
+    node_id = self.conn.execute(query, values).lastrowid
+    self.__cache_set(parent_id, name, None)
+    return node_id
+
   def __intern(self, string): # {{{3
-    start_time = time.time()
-    args = (sqlite3.Binary(string),)
-    result = self.conn.execute('SELECT id FROM strings WHERE value = ?', args).fetchone()
-    if not result:
-      self.conn.execute('INSERT INTO strings (id, value) VALUES (NULL, ?)', args)
-      result = self.conn.execute('SELECT last_insert_rowid()').fetchone()
-    self.time_spent_interning += time.time() - start_time
-    return int(result[0])
+    start_time = self.metrics.start()
+    string_id = self.interned_strings.get(string)
+    if string_id is None:
+      args = (sqlite3.Binary(string),)
+      result = self.conn.execute('SELECT id FROM strings WHERE value = ?', args).fetchone()
+      if result:
+        string_id = int(result[0])
+      else:
+        string_id = int(self.conn.execute('INSERT INTO strings (id, value) VALUES (NULL, ?)', args).lastrowid)
+      self.interned_strings.set(string, string_id)
+      self.metrics.stop('intern_query', start_time)
+    self.metrics.stop('intern', start_time)
+    return string_id
 
   def __remove(self, path, check_empty=False): # {{{3
+    parent, name = os.path.split(path)
+    parent_id, parent_ino = self.__path2keys(parent)
     node_id, inode = self.__path2keys(path)
     # Make sure directories are empty before deleting them to avoid orphaned inodes.
     query = """ SELECT COUNT(t.id) FROM tree t, inodes i WHERE
                 t.parent_id = ? AND i.inode = t.inode AND i.nlinks > 0 """
     if check_empty and self.__fetchval(query, node_id) > 0:
       raise OSError, (errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
-    self.__cache_set(path, None)
     self.conn.execute('DELETE FROM tree WHERE id = ?', (node_id,))
-    self.conn.execute('UPDATE inodes SET nlinks = nlinks - 1 WHERE inode = ?', (inode,))
-    # Inodes with nlinks = 0 are purged periodically from __collect_garbage() so
-    # we don't have to do that here.
-    if self.__fetchval('SELECT mode FROM inodes where inode = ?', inode) & stat.S_IFDIR:
-      parent_id, parent_ino = self.__path2keys(os.path.split(path)[0])
+    self.__cache_set(parent_id, name, None)
+    if stat.S_ISDIR(self.__fetchval('SELECT mode FROM inodes WHERE inode = ?', inode)):
+      # The `.' entry of the directory disappears together with it.
+      self.conn.execute('UPDATE inodes SET nlinks = 0 WHERE inode = ?', (inode,))
       self.conn.execute('UPDATE inodes SET nlinks = nlinks - 1 WHERE inode = ?', (parent_ino,))
-
-  def __verify_write(self, block, digest, block_nr, inode): # {{{3
+    else:
+      self.__drop_link(inode)
+
+  def __drop_link(self, inode): # {{{3
+    # Decrement the link count of a non-directory inode. Inodes with nlinks =
+    # 0 are purged periodically from __collect_garbage() so we don't have to
+    # do that here, but the contents of regular files are released right
+    # away to keep the disk usage counters accurate. Returns True when the
+    # last link was dropped.
+    self.conn.execute('UPDATE inodes SET nlinks = nlinks - 1 WHERE inode = ?', (inode,))
+    mode, nlinks, size = self.conn.execute('SELECT mode, nlinks, size FROM inodes where inode = ?', (inode,)).fetchone()
+    if stat.S_ISREG(mode) and nlinks == 0:
+      self.__account('apparent_bytes', -size)
+      self.__release_blocks(inode)
+      self.__delete_inline(inode)
+    return nlinks == 0
+
+  def __verify_write(self, block, digest, method, block_nr, inode): # {{{3
     if self.verify_writes:
-      saved_value = self.decompress(self.blocks[digest])
+      saved_value = self.decompress(method, self.__get_block(digest))
       if saved_value != block:
         # The data block was corrupted when it was written or read.
         dumpfile_corruption = '/tmp/dedupfs-corruption-%i' % time.time()
@@ -870,83 +1490,113 @@ class DedupFS(fuse.Fuse): # {{{1
        and (not (flags & os.X_OK) or ((o and (m & 0100)) or (g and (m & 0010)) or (w and (m & 0001))))
 
   def __path2keys(self, path): # {{{3
+    if self.read_only:
+      self.__refresh_snapshot()
     node_id, inode = 1, 1
     if path == '/':
       return node_id, inode
-    start_time = time.time()
-    node = self.cached_nodes
-    parent_id = node_id
+    if path.startswith(CONTROL_DIR) and (path == CONTROL_DIR or path.startswith(CONTROL_DIR + '/')):
+      # The control files can only be read (see __control_getattr()).
+      code = (path == CONTROL_DIR or path in self.control_files) and errno.EPERM or errno.ENOENT
+      raise OSError, (code, os.strerror(code), path)
+    start_time = self.metrics.start()
     for segment in self.__split_segments(path):
-      if segment in node:
-        node = node[segment]
-        node[self.__NODE_KEY_LAST_USED] = start_time
-        node_id, inode = node[self.__NODE_KEY_VALUE]
-      else:
-        query_start_time = time.time()
-        query = 'SELECT t.id, t.inode FROM tree t, strings s WHERE t.parent_id = ? AND t.name = s.id AND s.value = ? LIMIT 1'
-        result = self.conn.execute(query, (parent_id, sqlite3.Binary(segment))).fetchone()
-        self.time_spent_querying_tree += time.time() - query_start_time
+      parent_id = node_id
+      self.cache_lock.acquire()
+      try:
+        keys = self.dentries.get((parent_id, segment))
+        missing = keys is None and self.negative_dentries.get((parent_id, segment))
+        generation = self.tree_generation
+      finally:
+        self.cache_lock.release()
+      if keys is None:
+        if missing:
+          # Don't query the tree for names that are known not to exist.
+          self.metrics.stop('tree_lookup', start_time)
+          raise OSError, (errno.ENOENT, os.strerror(errno.ENOENT), path)
+        query_start_time = self.metrics.start()
+        # Probe the (parent_id, name_hash) index and confirm the name through
+        # the primary key of the strings table (in case of hash collisions).
+        query = """ SELECT t.id, t.inode FROM tree t INDEXED BY tree_by_name_hash
+                    CROSS JOIN strings s ON s.id = t.name
+                    WHERE t.parent_id = ? AND t.name_hash = ? AND s.value = ? LIMIT 1 """
+        values = (parent_id, metastore.name_hash(segment), sqlite3.Binary(segment))
+        result = self.conn.execute(query, values).fetchone()
+        self.metrics.stop('tree_query', query_start_time)
         if result == None:
-          self.__cache_check_gc()
-          self.time_spent_traversing_tree += time.time() - start_time
+          if self.negative_dentries.max_entries > 0:
+            self.__cache_set(parent_id, segment, False, generation)
+          self.metrics.stop('tree_lookup', start_time)
           raise OSError, (errno.ENOENT, os.strerror(errno.ENOENT), path)
-        node_id, inode = result
-        new_node = { self.__NODE_KEY_VALUE: (node_id, inode), self.__NODE_KEY_LAST_USED: start_time }
-        node[segment] = new_node
-        node = new_node
-      parent_id = node_id
-    self.__cache_check_gc()
-    self.time_spent_traversing_tree += time.time() - start_time
+        keys = (result[0], result[1])
+        self.__cache_set(parent_id, segment, keys, generation)
+      node_id, inode = keys
+    self.metrics.stop('tree_lookup', start_time)
     return node_id, inode
 
-  def __cache_set(self, key, value): # {{{3
-    segments = self.__split_segments(key)
-    last_segment = segments.pop(-1)
-    node = self.cached_nodes
+  def __refresh_snapshot(self): # {{{3
+    # Read only mounts keep a read transaction open on each connection, so
+    # that they see a consistent snapshot of the metadata store even while
+    # it's being written elsewhere (the write-ahead log keeps the snapshot
+    # intact). Every snapshot_interval seconds the connections move on to the
+    # latest state of the store (this also lets the writer checkpoint the
+    # log). The caches are cleared because they describe the old snapshot.
     time_now = time.time()
-    for segment in segments:
-      # Check that the keys of the sub path have been cached.
-      if segment not in node:
-        self.time_spent_caching_nodes += time.time() - time_now
-        return False
-      # Resolve the next path segment.
-      node = node[segment]
-      # Update the last used time of the sub path.
-      node[self.__NODE_KEY_LAST_USED] = time_now
-    if not value:
-      # Delete the path's keys.
-      if last_segment in node:
-        del node[last_segment]
-    elif last_segment not in node:
-      # Create the path's keys.
-      node[last_segment] = { self.__NODE_KEY_VALUE: value, self.__NODE_KEY_LAST_USED: time_now }
-    else:
-      # Update the path's keys.
-      node = node[last_segment]
-      node[self.__NODE_KEY_VALUE] = value
-      node[self.__NODE_KEY_LAST_USED] = time_now
-    self.__cache_check_gc()
-    self.time_spent_caching_nodes += time.time() - time_now
-    return True
-
-  def __cache_check_gc(self): # {{{3
-    self.cache_requests += 1
-    if self.cache_requests >= 2500:
-      time_now = time.time()
-      if time_now - self.cache_gc_last_run >= self.cache_timeout:
-        self.__cache_do_gc(self.cached_nodes, time_now)
-        self.cache_gc_last_run = time_now
-      self.cache_requests = 0
-
-  def __cache_do_gc(self, node, time_now): # {{{3
-    for key in node.keys():
-      child = node[key]
-      if isinstance(child, dict):
-        last_used = time_now - child[self.__NODE_KEY_LAST_USED]
-        if last_used > self.cache_timeout:
-          del node[key]
+    if time_now - self.snapshot_time >= self.snapshot_interval:
+      self.cache_lock.acquire()
+      try:
+        if time_now - self.snapshot_time >= self.snapshot_interval:
+          self.snapshot_time = time_now
+          self.snapshot_generation += 1
+          self.tree_generation += 1
+          self.dentries.clear()
+          self.negative_dentries.clear()
+      finally:
+        self.cache_lock.release()
+    conn = self.conn
+    if self.snapshots.get(id(conn)) != self.snapshot_generation:
+      if id(conn) in self.snapshots:
+        conn.execute('COMMIT')
+      conn.execute('BEGIN')
+      self.snapshots[id(conn)] = self.snapshot_generation
+      self.usage = dict(conn.execute('SELECT name, value FROM statistics'))
+
+  def __cache_set(self, parent_id, name, value, generation=None): # {{{3
+    # The dentry cache maps (parent node id, name) pairs to (node id, inode)
+    # pairs. Keying entries on the parent node instead of on full pathnames
+    # means that entries don't have to be invalidated when a directory
+    # higher up in the tree changes. A value of None removes the entry from
+    # both caches and False marks the name as nonexistent. Changes to the
+    # tree remove entries after the change was made and bump the generation,
+    # so that lookups that started before the change (in other threads)
+    # don't cache what they found.
+    key = (parent_id, name)
+    self.cache_lock.acquire()
+    try:
+      if value is None:
+        self.tree_generation += 1
+        self.dentries.delete(key)
+        self.negative_dentries.delete(key)
+      elif generation is None or generation == self.tree_generation:
+        if value is False:
+          self.negative_dentries.set(key, True)
         else:
-          self.__cache_do_gc(child, time_now)
+          self.dentries.set(key, value, len(name) + self.__DENTRY_OVERHEAD)
+    finally:
+      self.cache_lock.release()
+
+  def __rename_buffers(self, old_path, new_path): # {{{3
+    # Open files keep their buffers when they (or a directory above them)
+    # are renamed, release() is called with the new path. The buffers of a
+    # replaced target that's still open are discarded, like its contents.
+    new_prefix = new_path.rstrip('/') + '/'
+    for path in self.buffers.keys():
+      if path == new_path or path.startswith(new_prefix):
+        self.buffers.pop(path).close()
+    prefix = old_path.rstrip('/') + '/'
+    for path in self.buffers.keys():
+      if path == old_path or path.startswith(prefix):
+        self.buffers[new_path + path[len(old_path):]] = self.buffers.pop(path)
 
   def __split_segments(self, key): # {{{3
     return filter(None, key.split('/'))
@@ -959,45 +1609,594 @@ class DedupFS(fuse.Fuse): # {{{1
     return (c['uid'], c['gid'])
 
   def __hash(self, data): # {{{3
-    start_time = time.time()
+    start_time = self.metrics.start()
     context = self.hash_function_impl()
     context.update(data)
     digest = context.digest()
-    self.time_spent_hashing += time.time() - start_time
+    self.metrics.stop('hash', start_time)
     return digest
 
+  def __control_inode(self, path): # {{{3
+    return CONTROL_INODE + 1 + sorted(self.control_files).index(path)
+
+  def __control_getattr(self, path): # {{{3
+    t = time.time()
+    if path == CONTROL_DIR:
+      mode, nlinks, size, inode = stat.S_IFDIR | 0555, 2, 0, CONTROL_INODE
+    else:
+      # Generate the contents now so that the size is known.
+      contents = self.control_files[path]()
+      self.control_contents[path] = contents
+      mode = path in self.control_commands and 0644 or 0444
+      mode, nlinks, size, inode = stat.S_IFREG | mode, 1, len(contents), self.__control_inode(path)
+    return Stat(st_ino = inode, st_nlink = nlinks, st_mode = mode,
+                st_uid = os.getuid(), st_gid = os.getgid(), st_rdev = 0,
+                st_size = size, st_atime = t, st_mtime = t, st_ctime = t,
+                st_blksize = self.block_size, st_blocks = size / 512, st_dev = 0)
+
+  def __generate_stats(self): # {{{3
+    # The contents of /.dedupfs/stats: a JSON snapshot of the metrics
+    # together with throughput, deduplication and garbage collection details.
+    snapshot = self.metrics.snapshot()
+    counters = snapshot['counters']
+    histograms = snapshot['histograms']
+    def speed(nbytes, *operations):
+      nseconds = sum([histograms.get(o, {}).get('total', 0) for o in operations])
+      return nseconds > 0 and nbytes / nseconds or None
+    written = counters.get('bytes_written', 0)
+    stored = counters.get('bytes_stored', 0)
+    snapshot['throughput'] = dict(
+        read = speed(counters.get('bytes_read', 0), 'fuse.read'),
+        write = speed(written, 'fuse.write', 'fuse.release'))
+    snapshot['deduplication'] = dict(
+        bytes_written = written,
+        bytes_stored = stored,
+        ratio = stored > 0 and float(written) / stored or None)
+    snapshot['gc'] = dict(self.gc_state, enabled = self.gc_enabled, interval = self.gc_interval)
+    snapshot['usage'] = dict(self.usage)
+    snapshot['compression'] = self.compressor.snapshot()
+    snapshot['time'] = time.time()
+    return json.dumps(snapshot, indent=2, sort_keys=True) + '\n'
+
+  def __generate_sql_profile(self): # {{{3
+    # The contents of /.dedupfs/sql: the aggregates per SQL statement and
+    # calling method followed by the slow query log.
+    return json.dumps(self.sql_profiler.snapshot(), indent=2, sort_keys=True) + '\n'
+
   def __print_stats(self): # {{{3
     self.logger.info('-' * 79)
     self.__report_memory_usage()
+    self.report_disk_usage()
+    self.__report_cache_usage()
+    self.__report_interning()
     self.__report_throughput()
+    self.__report_compression()
     self.__report_timings()
+    self.__report_sql_profile()
 
   def __report_timings(self): # {{{3
     if self.logger.isEnabledFor(logging.DEBUG):
-      timings = [(self.time_spent_traversing_tree, 'Traversing the tree'),
-                 (self.time_spent_caching_nodes, 'Caching tree nodes'),
-                 (self.time_spent_interning, 'Interning path components'),
-                 (self.time_spent_writing_blocks, 'Writing data blocks'),
-                 (self.time_spent_hashing, 'Hashing data blocks'),
-                 (self.time_spent_querying_tree, 'Querying the tree')]
-      maxdescwidth = max([len(l) for t, l in timings]) + 3
+      # FUSE operations are recorded as fuse.<name>, the stages they consist
+      # of (tree_lookup, intern, hash, compress, datastore_get, commit, etc.)
+      # by their own name, so the timings of stages overlap those of the
+      # operations they're part of.
+      timings = [(h.total, n, h) for n, h in self.metrics.histograms.items()]
+      if not timings:
+        return
+      maxdescwidth = max([len(n) for t, n, h in timings]) + 3
       timings.sort(reverse=True)
-      uptime = time.time() - self.fs_mounted_at
+      uptime = self.metrics.uptime()
       printed_heading = False
-      for timespan, description in timings:
+      for timespan, name, histogram in timings:
         percentage = timespan / (uptime / 100)
         if percentage >= 1:
           if not printed_heading:
             self.logger.debug("Cumulative timings of slowest operations:")
             printed_heading = True
-          self.logger.debug(" - %-*s%s (%i%%)" % (maxdescwidth, description + ':', format_timespan(timespan), percentage))
+          self.logger.debug(" - %-*s%s (%i%%) in %i calls, 99%% took less than %s" % (maxdescwidth, name + ':',
+              timespan < 1 and format_latency(timespan) or format_timespan(timespan), percentage, histogram.count, format_latency(histogram.percentile(99))))
+
+  def __report_sql_profile(self): # {{{3
+    if self.sql_profiler:
+      top = self.sql_profiler.top(10)
+      if top:
+        self.logger.info("SQL statements that took the most time:")
+      for sql, caller, statement in top:
+        self.logger.info(" - %s in %i calls from %s (max %s, %i rows): %s", format_latency(statement.total),
+            statement.calls, caller, format_latency(statement.maximum), statement.rows, sql[:120])
+
+  def migrate(self, target_metastore, target_datastore=None): # {{{3
+    # Copy the metadata store (and the data store when a new location is
+    # given) into databases using the current layout.
+    target_metastore = os.path.expanduser(target_metastore)
+    target_blocks = None
+    if target_datastore:
+      target_datastore = os.path.expanduser(target_datastore)
+      target_blocks = self.__open_datastore(target_datastore, self.datastore_backend)
+    migration = Migration(self.metastore_file, target_metastore, self.logger)
+    try:
+      return migration.run(self.blocks, target_blocks)
+    finally:
+      if target_blocks is not None:
+        target_blocks.close()
 
   def report_disk_usage(self): # {{{3
+    # This only uses the disk usage counters and the sizes of the database
+    # files, so it's cheap enough to be part of the regular statistics.
+    usage = self.usage
     disk_usage = self.__fetchval('PRAGMA page_size') * self.__fetchval('PRAGMA page_count')
-    disk_usage += os.stat(self.datastore_file).st_size
-    apparent_size = self.__fetchval('SELECT SUM(inodes.size) FROM tree, inodes WHERE tree.inode = inodes.inode')
+    # Some dbm modules add a suffix to the pathname or use two files.
+    for suffix in '', '.db', '.dat', '.dir', '.pag':
+      if os.path.exists(self.datastore_file + suffix):
+        disk_usage += os.stat(self.datastore_file + suffix).st_size
+    apparent_size = usage['apparent_bytes']
     self.logger.info("The total apparent size is %s while the databases take up %s (that's %.2f%%).",
-        format_size(apparent_size), format_size(disk_usage), float(disk_usage) / (apparent_size / 100))
+        format_size(apparent_size), format_size(disk_usage), float(disk_usage) / max(1, apparent_size) * 100)
+    self.logger.info("There are %i unique data blocks of %s, stored as %s (plus %s of inline data).",
+        usage['blocks'], format_size(usage['unique_bytes']), format_size(usage['stored_bytes']), format_size(usage['inline_bytes']))
+    if usage['garbage_bytes'] > 0:
+      self.logger.info("%s of data blocks will be freed by the next garbage collection.", format_size(usage['garbage_bytes']))
+
+  def recompute_statistics(self): # {{{3
+    # Recount the references to data blocks and the disk usage counters from
+    # scratch, report any differences with the incrementally maintained
+    # values and save the new values.
+    self.conn.execute('BEGIN')
+    query = 'UPDATE hashes SET refs = (SELECT COUNT(*) FROM "index" i WHERE i.hash_id = hashes.id) WHERE refs != (SELECT COUNT(*) FROM "index" i WHERE i.hash_id = hashes.id)'
+    count = self.conn.execute(query).rowcount
+    self.conn.execute('COMMIT')
+    if count > 0:
+      self.logger.warning("Corrected the reference counts of %i data blocks.", count)
+    usage = self.__compute_usage()
+    differences = 0
+    for name in metastore.USAGE_COUNTERS:
+      if usage[name] != self.usage.get(name):
+        self.logger.warning("The %s counter was %s, the actual value is %s.", name, self.usage.get(name), usage[name])
+        differences += 1
+    if differences == 0 and count == 0:
+      self.logger.info("The disk usage counters are correct.")
+    self.usage = usage
+    self.usage_dirty = True
+    self.__save_usage()
+    self.report_disk_usage()
+    return True
+
+  def train_dictionary(self): # {{{3
+    # Train a new version of the preset dictionary used to compress small
+    # data blocks and inline data (see compression.py) on a random sample of
+    # them and compare it with plain zlib on the samples that weren't used
+    # for training. The dictionary is only saved when it's an improvement.
+    # Existing blocks keep the method they were stored with.
+    threshold = self.dictionary_threshold
+    if threshold <= 0:
+      self.logger.critical("Error: The dictionary is disabled by --dictionary-threshold=%i!", threshold)
+      return False
+    samples, nbytes = [], 0
+    for method, data in self.conn.execute('SELECT method, data FROM inline_data WHERE LENGTH(data) < ? ORDER BY RANDOM()', (threshold,)):
+      if nbytes >= compression.TRAINING_BYTES / 2:
+        break
+      samples.append(self.compressor.decompress(method, str(data)))
+      nbytes += len(samples[-1])
+    for method, digest in self.conn.execute('SELECT method, hash FROM hashes WHERE raw_size BETWEEN 1 AND ? ORDER BY RANDOM()', (threshold - 1,)):
+      if nbytes >= compression.TRAINING_BYTES:
+        break
+      try:
+        samples.append(self.__read_block(str(digest), method))
+        nbytes += len(samples[-1])
+      except KeyError:
+        self.logger.warning("Data block %s is missing from the data store!", str(digest).encode('hex'))
+    if len(samples) < compression.MIN_TRAINING_SAMPLES:
+      self.logger.critical("Error: There are only %i data blocks and files smaller than %s!", len(samples), format_size(threshold))
+      return False
+    # Every fourth sample is kept apart to measure the result.
+    evaluation = samples[::4]
+    training = [s for i, s in enumerate(samples) if i % 4]
+    start_time = time.time()
+    dictionary = compression.train_dictionary(training)
+    self.logger.info("Trained a dictionary of %s on %i samples (%s) in %s.", format_size(len(dictionary)),
+        len(training), format_size(sum(map(len, training))), format_timespan(time.time() - start_time))
+    result = compression.compare_dictionary(dictionary, evaluation)
+    for label, name in (("Plain zlib", 'plain'), ("Zlib using the dictionary", 'dictionary')):
+      self.logger.info("%s compresses %i other samples (%s) to %s (ratio %.2f) and decompresses them at %s/s.",
+          label, len(evaluation), format_size(result['raw_bytes']), format_size(result[name + '_bytes']),
+          float(result['raw_bytes']) / max(1, result[name + '_bytes']),
+          format_size(result['raw_bytes'] / max(result[name + '_seconds'], 0.000001)))
+    if not dictionary or result['dictionary_bytes'] >= result['plain_bytes']:
+      self.logger.warning("The dictionary doesn't improve compression, it wasn't saved.")
+      return True
+    self.conn.execute('BEGIN')
+    query = 'INSERT INTO dictionaries (data, samples, created) VALUES (?, ?, ?)'
+    version = self.conn.execute(query, (sqlite3.Binary(dictionary), len(training), time.time())).lastrowid
+    self.conn.execute('COMMIT')
+    self.logger.info("Saved dictionary version %i, it's used for data blocks and files smaller than %s stored from now on.",
+        version, format_size(threshold))
+    return True
+
+  def report(self, path='/'): # {{{3
+    # Report the size and deduplication of the subtrees below the given path
+    # and the popularity of data blocks (see report.py).
+    try:
+      node_id, inode = self.__path2keys(path)
+    except OSError, e:
+      self.logger.critical("Error: %s: %r", e.strerror, path)
+      return False
+    options = self.cmdline[0]
+    report = Report(self.conn, sys.stdout, options.report_depth, options.report_files)
+    report.run(node_id, path)
+    return True
+
+  def import_tree(self, source, target): # {{{3
+    # Copy a local directory tree (or a single file) to the new path `target'
+    # in the file system without going through FUSE. Files are read
+    # sequentially while a pool of threads hashes and compresses their
+    # blocks, the blocks are stored in order by this thread and the changes
+    # are committed in large transactions.
+    source = os.path.expanduser(source)
+    target = '/' + '/'.join(self.__split_segments(target))
+    parent, name = os.path.split(target)
+    try:
+      parent_id, parent_ino = self.__path2keys(parent)
+      if not name:
+        raise OSError, (errno.EEXIST, os.strerror(errno.EEXIST), target)
+      try:
+        self.__path2keys(target)
+        raise OSError, (errno.EEXIST, os.strerror(errno.EEXIST), target)
+      except OSError, e:
+        if e.errno != errno.ENOENT: raise
+    except OSError, e:
+      self.logger.critical("Error: %s: %r", e.strerror, e.filename)
+      return False
+    pool = ThreadPool(self.cmdline[0].worker_threads)
+    max_pending = len(pool.threads) * 4
+    pending = collections.deque()
+    hard_links = {}
+    totals = dict(files=0, directories=0, other=0, bytes=0, errors=0)
+    batch = [0, 0]
+    # Imported data is considered cold, it's compressed using the cold
+    # compression method.
+    compress, method = self.compressor.compress, self.cold_compression_method
+    hash_function = self.hash_function_impl
+    def encode(block):
+      return hash_function(block).digest(), compress(block, method)
+    def drain(limit):
+      while len(pending) > limit:
+        inode, block_nr, block, job = pending.popleft()
+        digest, encoded = job.result()
+        self.__store_block(inode, block_nr, block, digest, encoded)
+    def commit():
+      drain(0)
+      self.__save_usage()
+      # Make sure the data blocks are on disk before they're referenced.
+      self.__dbmcall('sync')
+      self.conn.execute('COMMIT')
+      self.conn.execute('BEGIN')
+      batch[:] = [0, 0]
+    def import_file(path, inode):
+      size = 0
+      handle = open(path, 'rb')
+      try:
+        block = handle.read(self.block_size)
+        next_block = block and handle.read(self.block_size)
+        if 0 < len(block) <= self.inline_threshold and not next_block:
+          self.__write_inline(inode, block)
+          size = len(block)
+        else:
+          block_nr = 0
+          while block:
+            pending.append((inode, block_nr, block, pool.submit(encode, block)))
+            drain(max_pending)
+            size += len(block)
+            block_nr += 1
+            block, next_block = next_block, next_block and handle.read(self.block_size)
+      finally:
+        handle.close()
+      self.__set_size(inode, size)
+      totals['bytes'] += size
+      batch[0] += size
+    start_time = last_report = time.time()
+    query = 'INSERT INTO inodes (nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    stack = [(source, parent_id, parent_ino, name)]
+    self.conn.execute('BEGIN')
+    try:
+      while stack:
+        path, parent_id, parent_ino, name = stack.pop()
+        try:
+          st = os.lstat(path)
+          is_dir = stat.S_ISDIR(st.st_mode)
+          key = (st.st_dev, st.st_ino)
+          if not is_dir and key in hard_links:
+            self.__insert_node(parent_id, name, hard_links[key])
+            self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (hard_links[key],))
+            continue
+          size = is_dir and 1024 * 4 or 0
+          values = (is_dir and 2 or 1, st.st_mode, st.st_uid, st.st_gid, st.st_rdev, size, st.st_atime, st.st_mtime, st.st_ctime)
+          inode = self.conn.execute(query, values).lastrowid
+          node_id = self.__insert_node(parent_id, name, inode)
+          batch[1] += 1
+          if is_dir:
+            self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (parent_ino,))
+            for child in sorted(os.listdir(path), reverse=True):
+              stack.append((os.path.join(path, child), node_id, inode, child))
+            totals['directories'] += 1
+          elif stat.S_ISLNK(st.st_mode):
+            link_target = os.readlink(path)
+            self.conn.execute('INSERT INTO links (inode, target) VALUES (?, ?)', (inode, sqlite3.Binary(link_target)))
+            self.conn.execute('UPDATE inodes SET size = ? WHERE inode = ?', (len(link_target), inode))
+            totals['other'] += 1
+          elif stat.S_ISREG(st.st_mode):
+            try:
+              import_file(path, inode)
+            except (IOError, OSError):
+              # Don't leave an empty or truncated copy of the file behind
+              # (its pending blocks are stored first so they're released).
+              drain(0)
+              self.conn.execute('DELETE FROM tree WHERE id = ?', (node_id,))
+              self.__cache_set(parent_id, name, None)
+              self.__drop_link(inode)
+              raise
+            totals['files'] += 1
+          else:
+            totals['other'] += 1
+          if not is_dir and st.st_nlink > 1:
+            hard_links[key] = inode
+        except (IOError, OSError), e:
+          self.logger.error("Failed to import %r: %s", path, e)
+          totals['errors'] += 1
+        if batch[0] >= 1024 ** 2 * 256 or batch[1] >= 10000:
+          commit()
+        time_now = time.time()
+        if time_now - last_report >= 10:
+          self.logger.info("Imported %i files (%s) at %s/s ..", totals['files'],
+              format_size(totals['bytes']), format_size(totals['bytes'] / (time_now - start_time)))
+          last_report = time_now
+      drain(0)
+      self.__save_usage()
+      self.__dbmcall('sync')
+      self.conn.execute('COMMIT')
+    except Exception, e:
+      # Forget about the changes of the current transaction (committed
+      # batches are kept) including the cached tree nodes and strings.
+      self.conn.execute('ROLLBACK')
+      self.tree_generation += 1
+      self.dentries.clear()
+      self.negative_dentries.clear()
+      self.interned_strings.clear()
+      self.usage = dict(self.conn.execute('SELECT name, value FROM statistics'))
+      self.usage_dirty = False
+      raise
+    finally:
+      pool.close()
+    elapsed = time.time() - start_time
+    self.logger.info("Imported %i files, %i directories and %i other entries (%s) in %s (%s/s).",
+        totals['files'], totals['directories'], totals['other'], format_size(totals['bytes']),
+        format_timespan(elapsed), format_size(totals['bytes'] / max(elapsed, 0.001)))
+    self.__report_compression()
+    if totals['errors'] > 0:
+      self.logger.warning("Failed to import %i entries!", totals['errors'])
+    return totals['errors'] == 0
+
+  def export_tree(self, source, target): # {{{3
+    # Copy the subtree at `source' to the new local path `target' or, when
+    # `target' is a dash, write it to standard output as a tar archive (see
+    # export.py).
+    try:
+      node_id, inode = self.__path2keys(source)
+    except OSError, e:
+      self.logger.critical("Error: %s: %r", e.strerror, source)
+      return False
+    export = Export(self.conn, self.metastore_file, self.logger, self.block_size,
+        self.__get_block, self.__read_block, self.__read_inline,
+        self.compressor.decompress, self.hash_function_impl,
+        self.cmdline[0].worker_threads)
+    if target == '-':
+      name = os.path.basename(source.rstrip('/')) or '.'
+      errors = export.to_tar(node_id, inode, name, sys.stdout)
+    else:
+      target = os.path.expanduser(target)
+      if os.path.lexists(target):
+        self.logger.critical("Error: %r already exists!", target)
+        return False
+      errors = export.to_directory(node_id, inode, target)
+    return errors == 0
+
+  def check(self): # {{{3
+    # Check the consistency of the metadata store and the data store (see
+    # fsck.py), then compare the disk usage counters with their actual
+    # values. Returns False when problems remain.
+    options = self.cmdline[0]
+    checker = Checker(self.conn, self.blocks, self.logger, self.compressor.decompress,
+        self.hash_function_impl, options.worker_threads, options.repair)
+    remaining = checker.run()
+    usage = metastore.compute_usage(self.conn)
+    for name in metastore.USAGE_COUNTERS:
+      if usage[name] != self.usage.get(name):
+        self.logger.warning("The %s counter is %s, the actual value is %s.", name, self.usage.get(name), usage[name])
+        if not options.repair:
+          remaining += 1
+    if options.repair:
+      self.usage = usage
+      self.usage_dirty = True
+      self.__save_usage()
+    return remaining == 0
+
+  def collapse_subtrees(self, path='/'): # {{{3
+    # Find the directories below the given path whose contents are identical
+    # using Merkle digests (see merkle.py) and turn the files in every copy
+    # but the first into hard links to the files in the first copy. The
+    # directories themselves are kept because FUSE doesn't support hard
+    # linked directories.
+    try:
+      node_id, inode = self.__path2keys(path)
+    except OSError, e:
+      self.logger.critical("Error: %s: %r", e.strerror, path)
+      return False
+    dry_run = self.cmdline[0].dry_run
+    start_time = time.time()
+    hasher = TreeHasher(self.conn, self.compressor.decompress)
+    groups = directories = linked = released = 0
+    self.conn.execute('BEGIN')
+    try:
+      hasher.run(node_id)
+      self.logger.info("Computed the digests of the directories below %r in %s.", path, format_timespan(time.time() - start_time))
+      # The largest subtrees come first, identical subtrees nested inside
+      # them are already shared by the time their own group comes up.
+      for files, node_ids in hasher.duplicates():
+        groups += 1
+        for duplicate_id in node_ids[1:]:
+          count, freed = self.__collapse_subtree(node_ids[0], duplicate_id)
+          if count > 0:
+            directories += 1
+            linked += count
+            released += freed
+      if dry_run:
+        self.conn.execute('ROLLBACK')
+        self.usage = dict(self.conn.execute('SELECT name, value FROM statistics'))
+        self.usage_dirty = False
+      else:
+        self.__save_usage()
+        self.conn.execute('COMMIT')
+    except:
+      self.conn.execute('ROLLBACK')
+      raise
+    finally:
+      self.conn.execute('DROP TABLE IF EXISTS temp.merkle')
+    self.tree_generation += 1
+    self.dentries.clear()
+    self.negative_dentries.clear()
+    self.logger.info("%s %i files in %i copies of %i groups of identical directories into hard links, releasing %i inodes (in %s).",
+        dry_run and "Would turn" or "Turned", linked, directories, groups, released, format_timespan(time.time() - start_time))
+    return True
+
+  def __collapse_subtree(self, original_id, duplicate_id): # {{{3
+    # Walk two identical subtrees side by side and point the directory
+    # entries of the files in the duplicate to the inodes of the original.
+    linked = released = 0
+    query = """ SELECT s.value, t.id, t.inode, i.mode FROM tree t, strings s, inodes i
+                WHERE t.parent_id = ? AND s.id = t.name AND i.inode = t.inode """
+    stack = [(original_id, duplicate_id)]
+    while stack:
+      original_id, duplicate_id = stack.pop()
+      originals = dict((str(r[0]), (r[1], r[2])) for r in self.conn.execute(query, (original_id,)))
+      for name, node_id, inode, mode in self.conn.execute(query, (duplicate_id,)).fetchall():
+        original = originals.get(str(name))
+        if original is None:
+          continue
+        if stat.S_ISDIR(mode):
+          stack.append((original[0], node_id))
+        elif inode != original[1]:
+          self.conn.execute('UPDATE tree SET inode = ? WHERE id = ?', (original[1], node_id))
+          self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (original[1],))
+          if self.__drop_link(inode):
+            released += 1
+          linked += 1
+    return linked, released
+
+  def clone(self, source, target): # {{{3
+    # Copy the subtree at `source' to the new path `target' without copying
+    # any data (see __clone_subtree()).
+    start_time = time.time()
+    try:
+      count = self.__clone_subtree(source, target)
+    except OSError, e:
+      self.logger.critical("Error: %s: %r", e.strerror, e.filename)
+      return False
+    self.logger.info("Cloned %r to %r (%i entries) in %s.", source, target, count, format_timespan(time.time() - start_time))
+    return True
+
+  def __clone_command(self, line): # {{{3
+    # Writing "SOURCE_PATH TARGET_PATH" to /.dedupfs/clone clones the source
+    # path (use a tab to separate paths that contain spaces).
+    paths = '\t' in line and line.split('\t') or line.split()
+    if len(paths) != 2:
+      raise OSError, (errno.EINVAL, os.strerror(errno.EINVAL), line)
+    self.__clone_subtree(paths[0].strip(), paths[1].strip())
+
+  def __clone_subtree(self, source, target): # {{{3
+    # Copy the subtree at `source' to the new path `target' by duplicating
+    # its rows in the tree, inodes, links, inline_data and index tables with
+    # a handful of INSERT ... SELECT statements. The copy shares all of its
+    # data blocks with the original (only their reference counts change) so
+    # the data store isn't touched and the time taken only depends on the
+    # number of files and blocks. Returns the number of copied entries.
+    source = '/' + '/'.join(self.__split_segments(source))
+    target = '/' + '/'.join(self.__split_segments(target))
+    if target == '/' or target == source or target.startswith(source.rstrip('/') + '/'):
+      raise OSError, (errno.EINVAL, os.strerror(errno.EINVAL), target)
+    parent, name = os.path.split(target)
+    self.write_lock.acquire()
+    try:
+      root_id, root_ino = self.__path2keys(source)
+      parent_id, parent_ino = self.__path2keys(parent)
+      try:
+        self.__path2keys(target)
+        raise OSError, (errno.EEXIST, os.strerror(errno.EEXIST), target)
+      except OSError, e:
+        if e.errno != errno.ENOENT: raise
+      if not stat.S_ISDIR(self.__fetchval('SELECT mode FROM inodes WHERE inode = ?', parent_ino)):
+        raise OSError, (errno.ENOTDIR, os.strerror(errno.ENOTDIR), parent)
+      self.conn.execute('BEGIN')
+      try:
+        count = self.__copy_subtree_rows(root_id, root_ino, parent_id, parent_ino, name)
+        self.__save_usage()
+        self.conn.execute('COMMIT')
+      except:
+        self.conn.execute('ROLLBACK')
+        self.usage = dict(self.conn.execute('SELECT name, value FROM statistics'))
+        self.usage_dirty = False
+        self.interned_strings.clear()
+        raise
+      finally:
+        for table in 'clone_nodes', 'clone_inodes', 'clone_refs':
+          self.conn.execute('DROP TABLE IF EXISTS temp.%s' % table)
+      self.__cache_set(parent_id, name, None)
+      return count
+    finally:
+      self.write_lock.release()
+
+  def __copy_subtree_rows(self, root_id, root_ino, parent_id, parent_ino, name): # {{{3
+    # Collect the tree nodes of the subtree and the inodes they refer to
+    # (with the number of links from inside the subtree, which becomes the
+    # link count of the copies of files that have hard links elsewhere).
+    # SQLite numbers the collected rows 1, 2, 3 .. in their `seq' column,
+    # the copies get these numbers shifted past the highest id in use so
+    # that repeated clones don't leave gaps in the ids.
+    self.conn.execute('CREATE TEMP TABLE clone_nodes (seq INTEGER PRIMARY KEY, id INTEGER NOT NULL UNIQUE)')
+    self.conn.execute('CREATE TEMP TABLE clone_inodes (seq INTEGER PRIMARY KEY, inode INTEGER NOT NULL UNIQUE, links INTEGER NOT NULL)')
+    self.conn.execute('CREATE TEMP TABLE clone_refs (hash_id INTEGER PRIMARY KEY, refs INTEGER NOT NULL)')
+    self.conn.execute(""" INSERT INTO temp.clone_nodes (id)
+                          WITH RECURSIVE subtree (id) AS (SELECT ? UNION ALL SELECT t.id FROM tree t, subtree s WHERE t.parent_id = s.id)
+                          SELECT id FROM subtree """, (root_id,))
+    self.conn.execute('INSERT INTO temp.clone_inodes (inode, links) SELECT t.inode, COUNT(*) FROM tree t, temp.clone_nodes c WHERE t.id = c.id GROUP BY t.inode')
+    self.conn.execute('INSERT INTO temp.clone_refs (hash_id, refs) SELECT i.hash_id, COUNT(*) FROM "index" i, temp.clone_inodes c WHERE i.inode = c.inode GROUP BY i.hash_id')
+    # The references between the copied rows are translated by joining the
+    # old ids to their sequence numbers.
+    count = self.__fetchval('SELECT COUNT(*) FROM temp.clone_nodes')
+    node_offset = self.__fetchval('SELECT MAX(id) FROM tree')
+    inode_offset = self.__fetchval('SELECT MAX(inode) FROM inodes')
+    self.conn.execute(""" INSERT INTO tree (id, parent_id, name, inode, name_hash)
+                          SELECT c.seq + ?, p.seq + ?, t.name, n.seq + ?, t.name_hash
+                          FROM tree t, temp.clone_nodes c, temp.clone_nodes p, temp.clone_inodes n
+                          WHERE t.id = c.id AND t.id != ? AND p.id = t.parent_id AND n.inode = t.inode """,
+                      (node_offset, node_offset, inode_offset, root_id))
+    self.conn.execute(""" INSERT INTO tree (id, parent_id, name, inode, name_hash)
+                          SELECT c.seq + ?, ?, ?, n.seq + ?, ? FROM temp.clone_nodes c, temp.clone_inodes n
+                          WHERE c.id = ? AND n.inode = ? """,
+                      (node_offset, parent_id, self.__intern(name), inode_offset, metastore.name_hash(name), root_id, root_ino))
+    self.conn.execute(""" INSERT INTO inodes (inode, nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime)
+                          SELECT c.seq + ?, CASE WHEN (i.mode & %i) = %i THEN i.nlinks ELSE c.links END,
+                                 i.mode, i.uid, i.gid, i.rdev, i.size, i.atime, i.mtime, ?
+                          FROM inodes i, temp.clone_inodes c WHERE i.inode = c.inode """ % (0170000, stat.S_IFDIR),
+                      (inode_offset, self.__newctime()))
+    self.conn.execute('INSERT INTO links (inode, target) SELECT c.seq + ?, l.target FROM links l, temp.clone_inodes c WHERE l.inode = c.inode', (inode_offset,))
+    self.conn.execute('INSERT INTO inline_data (inode, method, data) SELECT c.seq + ?, d.method, d.data FROM inline_data d, temp.clone_inodes c WHERE d.inode = c.inode', (inode_offset,))
+    self.conn.execute('INSERT INTO "index" (inode, block_nr, hash_id) SELECT c.seq + ?, i.block_nr, i.hash_id FROM "index" i, temp.clone_inodes c WHERE i.inode = c.inode', (inode_offset,))
+    self.conn.execute('UPDATE hashes SET refs = refs + (SELECT r.refs FROM temp.clone_refs r WHERE r.hash_id = hashes.id) WHERE id IN (SELECT hash_id FROM temp.clone_refs)')
+    if stat.S_ISDIR(self.__fetchval('SELECT mode FROM inodes WHERE inode = ?', root_ino)):
+      self.conn.execute('UPDATE inodes SET nlinks = nlinks + 1 WHERE inode = ?', (parent_ino,))
+    query = 'SELECT COALESCE(SUM(i.size), 0) FROM inodes i, temp.clone_inodes c WHERE i.inode = c.inode AND (i.mode & %i) = %i' % (0170000, stat.S_IFREG)
+    self.__account('apparent_bytes', self.__fetchval(query))
+    self.__account('inline_bytes', self.__fetchval('SELECT COALESCE(SUM(LENGTH(d.data)), 0) FROM inline_data d, temp.clone_inodes c WHERE d.inode = c.inode'))
+    return count
 
   def __report_memory_usage(self): # {{{3
     memory_usage = get_memory_usage()
@@ -1009,45 +2208,52 @@ class DedupFS(fuse.Fuse): # {{{1
     self.logger.info(msg + '.')
     self.memory_usage = memory_usage
 
-  def __report_throughput(self, nbytes=None, nseconds=None, label=None): # {{{3
-    if nbytes == None:
-      self.bytes_read, self.time_spent_reading = \
-          self.__report_throughput(self.bytes_read, self.time_spent_reading, "read")
-      self.bytes_written, self.time_spent_writing = \
-          self.__report_throughput(self.bytes_written, self.time_spent_writing, "write")
-    else:
-      if nbytes > 0:
-        average = format_size(nbytes / max(1, nseconds))
-        self.logger.info("Average %s speed is %s/s.", label, average)
-        # Decrease the influence of previous measurements over time?
-        if nseconds > 60 and nbytes > 1024**2:
-          return nbytes / 2, nseconds / 2
-      return nbytes, nseconds
-
-  def __report_top_blocks(self): # {{{3
-    query = """
-      SELECT * FROM (
-        SELECT *, COUNT(*) AS "count" FROM "index"
-        GROUP BY hash_id ORDER BY "count" DESC
-      ), hashes WHERE
-        "count" > 1 AND
-        hash_id = hashes.id
-        LIMIT 10 """
-    if self.logger.isEnabledFor(logging.DEBUG):
-      printed_header = False
-      for row in self.conn.execute(query):
-        if not printed_header:
-          self.logger.debug("A listing of the most used blocks follows:")
-          printed_header = True
-        msg = "Block #%s of %s has been used %i times: %r"
-        preview = row['value']
-        max_length = 60
-        if len(preview) < max_length:
-          preview = str(preview)
-        else:
-          preview = preview[0 : max_length] + '...'
-        nbytes = format_size(len(row['value']))
-        self.logger.debug(msg, row['hash_id'], nbytes, row['count'], preview)
+  def __report_cache_usage(self): # {{{3
+    cache = self.dentries
+    self.logger.info("The dentry cache contains %i entries (%s) with a hit rate of %.1f%% (%i hits, %i misses, %i evictions).",
+        len(cache), format_size(cache.nbytes), cache.hit_rate(), cache.hits, cache.misses, cache.evictions)
+    cache = self.negative_dentries
+    if cache.max_entries > 0:
+      self.logger.info("The negative dentry cache contains %i entries with a hit rate of %.1f%% (%i hits, %i misses, %i evictions).",
+          len(cache), cache.hit_rate(), cache.hits, cache.misses, cache.evictions)
+
+  def __report_interning(self): # {{{3
+    cache = self.interned_strings
+    queries = self.metrics.histograms.get('intern_query')
+    if cache.hits > 0 and queries and queries.count > 0:
+      # Estimate the time saved using the average cost of a cache miss.
+      saved = cache.hits * queries.total / queries.count
+      self.logger.info("Interned %i path segments from memory (%.1f%% hit rate), saving about %s of queries.",
+          cache.hits, cache.hit_rate(), format_timespan(saved))
+
+  def __report_throughput(self): # {{{3
+    # Report the average read and write speeds since the previous report,
+    # based on the time spent in the FUSE operations that move the data.
+    metrics = self.metrics
+    current = (metrics.counters.get('bytes_read', 0), metrics.total('fuse.read'),
+               metrics.counters.get('bytes_written', 0), metrics.total('fuse.write') + metrics.total('fuse.release'))
+    previous = self.throughput_reported or (0, 0.0, 0, 0.0)
+    self.throughput_reported = current
+    for label, nbytes, nseconds in (('read', current[0] - previous[0], current[1] - previous[1]),
+                                    ('write', current[2] - previous[2], current[3] - previous[3])):
+      if nbytes > 0 and nseconds > 0:
+        self.logger.info("Average %s speed is %s/s.", label, format_size(nbytes / nseconds))
+
+  def __report_compression(self): # {{{3
+    # Report the number of data blocks stored using every compression method
+    # (and as is, because they didn't compress) since the file system was
+    # mounted, the compression ratio and the speed of compression.
+    statistics = self.compressor.snapshot()
+    for method in sorted(statistics.keys()):
+      s = statistics[method]
+      if s['blocks'] > 0 and method != 'none':
+        self.logger.info("Compressed %i data blocks using %s: %s to %s (ratio %.2f) at %s/s.", s['blocks'], method,
+            format_size(s['raw_bytes']), format_size(s['stored_bytes']), s['ratio'] or 0, format_size(s['throughput'] or 0))
+    if 'none' in statistics and statistics['none']['blocks'] > 0:
+      s = statistics['none']
+      self.logger.info("Stored %i data blocks (%s) without compression.", s['blocks'], format_size(s['raw_bytes']))
+    if 'probe' in statistics:
+      self.logger.info("Spent %s recognizing incompressible data blocks.", format_timespan(statistics['probe']['seconds']))
 
   def __gc_hook(self, nested=False): # {{{3
     # Don't collect any garbage for nested calls.
@@ -1064,62 +2270,145 @@ class DedupFS(fuse.Fuse): # {{{1
 
   def __collect_garbage(self): # {{{3
     if self.gc_enabled and not self.read_only:
-      start_time = time.time()
-      self.logger.info("Performing garbage collection (this might take a while) ..")
-      self.should_vacuum = False
-      for method in self.__collect_strings, self.__collect_inodes, \
-          self.__collect_indices, self.__collect_blocks, self.__vacuum_metastore:
-        sub_start_time = time.time()
-        msg = method()
-        if msg:
-          elapsed_time = time.time() - sub_start_time
-          self.logger.info(msg, format_timespan(elapsed_time))
-      elapsed_time = time.time() - start_time
-      self.logger.info("Finished garbage collection in %s.", format_timespan(elapsed_time))
+      self.write_lock.acquire()
+      try:
+        start_time = time.time()
+        self.logger.info("Performing garbage collection (this might take a while) ..")
+        self.should_vacuum = False
+        results = []
+        for method in self.__collect_strings, self.__collect_inodes, \
+            self.__collect_indices, self.__collect_inline_data, \
+            self.__collect_blocks, self.__vacuum_metastore:
+          sub_start_time = time.time()
+          msg = method()
+          if msg:
+            elapsed_time = time.time() - sub_start_time
+            results.append(msg % format_timespan(elapsed_time))
+            self.logger.info(results[-1])
+        elapsed_time = time.time() - start_time
+        self.logger.info("Finished garbage collection in %s.", format_timespan(elapsed_time))
+        self.gc_state.update(runs = self.gc_state['runs'] + 1, last_run = start_time,
+            duration = elapsed_time, results = results)
+        self.__save_usage()
+      finally:
+        self.write_lock.release()
 
   def __collect_strings(self): # {{{4
     count = self.conn.execute('DELETE FROM strings WHERE id NOT IN (SELECT name FROM tree)').rowcount
     if count > 0:
+      # The ids of deleted strings can be reused by new strings.
+      self.interned_strings.clear()
       self.should_vacuum = True
       return "Cleaned up %i unused path segment%s in %%s." % (count, count != 1 and 's' or '')
 
   def __collect_inodes(self): # {{{4
+    # The contents of regular files are normally released by __remove().
+    for row in self.conn.execute('SELECT inode FROM inodes WHERE nlinks = 0').fetchall():
+      self.__release_blocks(row[0])
+      self.__delete_inline(row[0])
+    self.conn.execute('DELETE FROM links WHERE inode IN (SELECT inode FROM inodes WHERE nlinks = 0)')
     count = self.conn.execute('DELETE FROM inodes WHERE nlinks = 0').rowcount
     if count > 0:
       self.should_vacuum = True
       return "Cleaned up %i unused inode%s in %%s." % (count, count != 1 and 's' or '')
 
   def __collect_indices(self): # {{{4
-    count = self.conn.execute('DELETE FROM "index" WHERE inode NOT IN (SELECT inode FROM inodes)').rowcount
+    count = 0
+    query = 'SELECT DISTINCT inode FROM "index" WHERE NOT EXISTS (SELECT 1 FROM inodes WHERE inodes.inode = "index".inode)'
+    for row in self.conn.execute(query).fetchall():
+      count += self.__release_blocks(row[0])
     if count > 0:
       self.should_vacuum = True
       return "Cleaned up %i unused index entr%s in %%s." % (count, count != 1 and 'ies' or 'y')
 
+  def __collect_inline_data(self): # {{{4
+    count = 0
+    query = 'SELECT inode FROM inline_data WHERE NOT EXISTS (SELECT 1 FROM inodes WHERE inodes.inode = inline_data.inode)'
+    for row in self.conn.execute(query).fetchall():
+      self.__delete_inline(row[0])
+      count += 1
+    if count > 0:
+      self.should_vacuum = True
+      return "Cleaned up %i unused inline file%s in %%s." % (count, count != 1 and 's' or '')
+
   def __collect_blocks(self): # {{{4
-    should_reorganize = False
-    for row in self.conn.execute('SELECT hash FROM hashes WHERE id NOT IN (SELECT hash_id FROM "index")'):
-      del self.blocks[str(row[0])]
-      should_reorganize = True
-    if should_reorganize:
+    # Blocks without references are found through a partial index, the NOT
+    # EXISTS check makes sure a wrong reference count never loses data.
+    query = 'SELECT id, hash, size, raw_size FROM hashes WHERE refs = 0 AND NOT EXISTS (SELECT 1 FROM "index" i WHERE i.hash_id = hashes.id)'
+    rows = self.conn.execute(query).fetchall()
+    if self.shared:
+      rows = self.__expired_garbage(rows)
+    self.datastore_lock.acquire()
+    try:
+      for hash_id, digest, size, raw_size in rows:
+        del self.blocks[str(digest)]
+    finally:
+      self.datastore_lock.release()
+    if rows:
       self.__dbmcall('reorganize')
-    count = self.conn.execute('DELETE FROM hashes WHERE id NOT IN (SELECT hash_id FROM "index")').rowcount
+    self.conn.executemany('DELETE FROM hashes WHERE id = ?', [(r[0],) for r in rows])
+    self.__account('blocks', -len(rows))
+    self.__account('stored_bytes', -sum([r[2] for r in rows]))
+    self.__account('unique_bytes', -sum([r[3] for r in rows]))
+    self.__account('garbage_bytes', -sum([r[2] for r in rows]))
+    count = len(rows)
     if count > 0:
       self.should_vacuum = True
       return "Cleaned up %i unused data block%s in %%s." % (count, count != 1 and 's' or '')
 
+  def __expired_garbage(self, rows): # {{{4
+    # Read only mounts keep their snapshot of the metadata store for up to
+    # snapshot_interval seconds and that snapshot can still refer to blocks
+    # that became garbage in the meantime, so those blocks are only deleted
+    # once they've been garbage for a whole interval. Blocks that became
+    # garbage before the file system was mounted are timed from the first
+    # garbage collection that finds them.
+    time_now = time.time()
+    garbage_times = dict((r[0], self.garbage_times.get(r[0], time_now)) for r in rows)
+    expired = [r for r in rows if time_now - garbage_times[r[0]] >= self.snapshot_interval]
+    for row in expired:
+      del garbage_times[row[0]]
+    # Blocks that are referenced again are forgotten.
+    self.garbage_times = garbage_times
+    return expired
+
   def __vacuum_metastore(self): # {{{4
     if self.should_vacuum:
       self.conn.execute('VACUUM')
       return "Vacuumed SQLite metadata store in %s."
 
+  def __begin_changes(self, nested=False): # {{{3
+    # The connections run in autocommit mode, so the statements that make up
+    # a change are only grouped in a transaction when one is started here.
+    # That's needed when the metadata store is shared, otherwise read only
+    # mounts could take their snapshot halfway through a change (e.g. after
+    # release() dropped the index of a file but before it stored the new
+    # blocks) and see a truncated file.
+    if self.shared and self.use_transactions and not nested:
+      self.conn.execute('BEGIN IMMEDIATE')
+
   def __commit_changes(self, nested=False): # {{{3
+    if not nested:
+      self.__save_usage()
     if self.use_transactions and not nested:
+      start_time = self.metrics.start()
       self.conn.commit()
+      self.metrics.stop('commit', start_time)
 
   def __rollback_changes(self, nested=False): # {{{3
     if self.use_transactions and not nested:
       self.logger.info('Rolling back changes')
       self.conn.rollback()
+      # The caches may refer to tree nodes and strings that no longer exist
+      # or miss tree nodes that exist again.
+      self.cache_lock.acquire()
+      try:
+        self.tree_generation += 1
+        self.dentries.clear()
+        self.negative_dentries.clear()
+      finally:
+        self.cache_lock.release()
+      self.interned_strings.clear()
 
   def __get_file_buffer(self, path): # {{{3
     if path in self.buffers:
@@ -1127,13 +2416,24 @@ class DedupFS(fuse.Fuse): # {{{1
     else:
       buf = Buffer()
       inode = self.__path2keys(path)[1]
-      query = """ SELECT h.hash FROM hashes h, "index" i
-                  WHERE i.inode = ? AND h.id = i.hash_id
-                  ORDER BY i.block_nr ASC """
-      for row in self.conn.execute(query, (inode,)).fetchall():
-        # TODO Make the file system more robust against failure by doing
-        # something sensible when self.blocks.has_key(digest) is false.
-        buf.write(self.decompress(self.blocks[str(row[0])]))
+      data = self.__read_inline(inode)
+      if data is not None:
+        buf.write(data)
+      else:
+        query = """ SELECT h.hash, h.method FROM hashes h, "index" i
+                    WHERE i.inode = ? AND h.id = i.hash_id
+                    ORDER BY i.block_nr ASC """
+        for row in self.conn.execute(query, (inode,)).fetchall():
+          # TODO Make the file system more robust against failure by doing
+          # something sensible when self.blocks.has_key(digest) is false
+          # (`dedupfs.py fsck' reports the files affected by missing blocks).
+          buf.write(self.__read_block(str(row[0]), row[1]))
+        # Drop any data beyond the apparent size (left behind by truncate()).
+        buf.seek(self.__fetchval('SELECT size FROM inodes WHERE inode = ?', inode))
+        buf.truncate()
+      # Loading the file's contents doesn't make the buffer dirty, otherwise
+      # every file that's read would be rewritten by release().
+      buf.dirty = False
       self.buffers[path] = buf
       return buf
 
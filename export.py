@@ -0,0 +1,358 @@
+#!/usr/bin/python
+
+"""
+The Export class in this Python module copies a subtree of a DedupFS store
+to a local directory or to a tar archive without going through FUSE. A
+directory export first recreates the tree (with empty files) and records
+which file offsets reference which data block in a scratch database, then
+fetches every distinct data block once, in the order the blocks were added
+to the data store, decompresses the blocks in a pool of threads and writes
+each block to all of the offsets that reference it. Tar archives have to be
+written file by file, there the blocks of each file are decompressed ahead
+of the archive writer instead.
+"""
+
+import collections
+import errno
+import os
+import sqlite3
+import stat
+import tarfile
+import time
+
+from my_formats import format_size, format_timespan
+from thread_pool import ThreadPool
+
+class Export: # {{{1
+
+  def __init__(self, conn, metastore_file, logger, block_size, get_block, read_block, read_inline, decompress, hash_function, threads=2, report_interval=10): # {{{2
+    # get_block() returns the stored (compressed) contents of a data block,
+    # it's only called by the thread that created the Export object.
+    # decompress() (given the compression method of a block and its stored
+    # contents) and hash_function() are called by the worker threads to
+    # decode and verify blocks, blocks that can't be decoded or don't match
+    # their digest are read again using read_block().
+    self.conn = conn
+    self.metastore_file = metastore_file
+    self.logger = logger
+    self.block_size = block_size
+    self.get_block = get_block
+    self.read_block = read_block
+    self.read_inline = read_inline
+    self.decompress = decompress
+    self.hash_function = hash_function
+    self.threads = threads
+    self.report_interval = report_interval
+
+  def to_directory(self, node_id, inode, target): # {{{2
+    """
+    Recreate the subtree rooted at the given node as the local path `target'
+    (which must not exist yet). Returns the number of entries that couldn't
+    be exported.
+    """
+    self.__start()
+    self.scratch = sqlite3.connect('', isolation_level=None)
+    self.scratch.text_factory = str
+    try:
+      self.scratch.executescript("""
+        CREATE TABLE entries (id INTEGER PRIMARY KEY, path BLOB, mode INTEGER, uid INTEGER, gid INTEGER, size INTEGER, atime INTEGER, mtime INTEGER);
+        CREATE TABLE files (inode INTEGER PRIMARY KEY, path BLOB); """)
+      self.scratch.execute('BEGIN')
+      self.__create_tree(node_id, inode, target)
+      self.scratch.execute('COMMIT')
+      self.__copy_blocks()
+      self.__set_attributes()
+    finally:
+      self.pool.close()
+      self.scratch.close()
+    self.__finish()
+    return self.errors
+
+  def to_tar(self, node_id, inode, name, output): # {{{2
+    """
+    Write the subtree rooted at the given node as a tar archive to the file
+    like object `output', using `name' as the top level name. Returns the
+    number of entries that couldn't be exported.
+    """
+    self.__start()
+    archive = tarfile.open(fileobj=output, mode='w|', format=tarfile.GNU_FORMAT)
+    links = {}
+    try:
+      for path, entry in self.__walk(node_id, inode, name):
+        inode, mode, uid, gid, rdev, size, atime, mtime, nlinks = entry
+        info = tarfile.TarInfo(path)
+        info.mode, info.uid, info.gid, info.mtime = stat.S_IMODE(mode), uid, gid, int(mtime)
+        fileobj = None
+        if stat.S_ISREG(mode) and inode in links:
+          info.type, info.linkname = tarfile.LNKTYPE, links[inode]
+        elif stat.S_ISREG(mode):
+          if nlinks > 1:
+            links[inode] = path
+          info.size = size
+          fileobj = self.__open_file(inode, size)
+          self.files += 1
+          self.bytes += size
+        elif stat.S_ISDIR(mode):
+          info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+          info.type, info.linkname = tarfile.SYMTYPE, self.__readlink(inode)
+        elif stat.S_ISFIFO(mode):
+          info.type = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+          info.type = stat.S_ISCHR(mode) and tarfile.CHRTYPE or tarfile.BLKTYPE
+          info.devmajor, info.devminor = os.major(rdev), os.minor(rdev)
+        else:
+          self.logger.error("Skipping %r because its type isn't supported!", path)
+          self.errors += 1
+          continue
+        archive.addfile(info, fileobj)
+        self.__report_progress()
+      archive.close()
+    finally:
+      self.pool.close()
+    self.__finish()
+    return self.errors
+
+  def __start(self): # {{{2
+    self.pool = ThreadPool(self.threads)
+    self.max_pending = len(self.pool.threads) * 4
+    self.files = self.bytes = self.blocks = self.errors = 0
+    self.start_time = self.last_report = time.time()
+
+  def __walk(self, node_id, inode, path): # {{{2
+    # Generate the (path, attributes) pairs of the subtree in pre-order. The
+    # tree is streamed using a stack of open cursors, one per directory.
+    query = 'SELECT inode, mode, uid, gid, rdev, size, atime, mtime, nlinks FROM inodes WHERE inode = ?'
+    entry = self.conn.execute(query, (inode,)).fetchone()
+    yield path, entry
+    if not stat.S_ISDIR(entry[1]):
+      return
+    query = """ SELECT t.id, s.value, i.inode, i.mode, i.uid, i.gid, i.rdev, i.size, i.atime, i.mtime, i.nlinks
+                FROM tree t, strings s, inodes i
+                WHERE t.parent_id = ? AND s.id = t.name AND i.inode = t.inode """
+    stack = [(path, self.conn.execute(query, (node_id,)))]
+    while stack:
+      path, children = stack[-1]
+      row = children.fetchone()
+      if row is None:
+        stack.pop()
+        continue
+      child_path = path.rstrip('/') + '/' + str(row[1])
+      yield child_path, tuple(row)[2:]
+      if stat.S_ISDIR(row[3]):
+        stack.append((child_path, self.conn.execute(query, (row[0],))))
+
+  def __create_tree(self, node_id, inode, target): # {{{2
+    # Create the directories, links and (empty) files of the subtree and
+    # record the offsets where the data blocks should be written.
+    links = {}
+    query = 'INSERT INTO entries (path, mode, uid, gid, size, atime, mtime) VALUES (?, ?, ?, ?, ?, ?, ?)'
+    for path, entry in self.__walk(node_id, inode, target):
+      inode, mode, uid, gid, rdev, size, atime, mtime, nlinks = entry
+      try:
+        if inode in links:
+          os.link(links[inode], path)
+          continue
+        if stat.S_ISDIR(mode):
+          # Directories stay writable until their contents are complete.
+          os.mkdir(path, 0700)
+        elif stat.S_ISLNK(mode):
+          os.symlink(self.__readlink(inode), path)
+        elif stat.S_ISREG(mode):
+          handle = open(path, 'wb')
+          try:
+            data = self.read_inline(inode)
+            if data is not None:
+              handle.write(data)
+            elif size > 0:
+              self.scratch.execute('INSERT INTO files (inode, path) VALUES (?, ?)', (inode, sqlite3.Binary(path)))
+          finally:
+            handle.close()
+          self.files += 1
+          self.bytes += size
+        else:
+          os.mknod(path, mode, rdev)
+        if nlinks > 1 and not stat.S_ISDIR(mode):
+          links[inode] = path
+        self.scratch.execute(query, (sqlite3.Binary(path), mode, uid, gid, size, atime, mtime))
+      except (IOError, OSError), e:
+        self.logger.error("Failed to create %r: %s", path, e)
+        self.errors += 1
+
+  def __copy_blocks(self): # {{{2
+    # Fetch the distinct data blocks in the order of their row ids (the order
+    # in which they were added to the data store) and write every block to
+    # all of the places that reference it.
+    self.scratch.execute('ATTACH DATABASE ? AS store', (self.metastore_file,))
+    query = """ SELECT i.hash_id, h.hash, h.method, f.path, i.block_nr
+                FROM files f, store."index" i, store.hashes h
+                WHERE i.inode = f.inode AND h.id = i.hash_id
+                ORDER BY i.hash_id """
+    pending = collections.deque()
+    try:
+      current, digest, method, targets = None, None, None, []
+      for hash_id, next_digest, next_method, path, block_nr in self.scratch.execute(query):
+        if hash_id != current:
+          if targets:
+            pending.append(self.__fetch(str(digest), method, targets))
+            self.__drain(pending, self.max_pending)
+          current, digest, method, targets = hash_id, next_digest, next_method, []
+        targets.append((str(path), block_nr))
+      if targets:
+        pending.append(self.__fetch(str(digest), method, targets))
+      self.__drain(pending, 0)
+    finally:
+      self.scratch.execute('DETACH DATABASE store')
+
+  def __fetch(self, digest, method, targets): # {{{2
+    try:
+      job = self.pool.submit(self.__decode, digest, method, self.get_block(digest))
+    except Exception:
+      job = None
+    return digest, method, targets, job
+
+  def __decode(self, digest, method, data): # {{{2
+    # Runs in a worker thread.
+    block = self.decompress(method, data)
+    if self.hash_function(block).digest() == digest:
+      return block
+
+  def __drain(self, pending, limit): # {{{2
+    while len(pending) > limit:
+      digest, method, targets, job = pending.popleft()
+      try:
+        block = None
+        if job is not None:
+          try:
+            block = job.result()
+          except Exception:
+            pass
+        if block is None:
+          block = self.read_block(digest, method)
+      except Exception, e:
+        self.logger.error("Failed to read data block %s: %s", digest.encode('hex'), e)
+        self.errors += 1
+        continue
+      for path, block_nr in targets:
+        try:
+          handle = open(path, 'r+b')
+          try:
+            handle.seek(block_nr * self.block_size)
+            handle.write(block)
+          finally:
+            handle.close()
+        except IOError, e:
+          self.logger.error("Failed to write %r: %s", path, e)
+          self.errors += 1
+      self.blocks += 1
+      self.__report_progress()
+
+  def __set_attributes(self): # {{{2
+    # Contents are complete, now drop any data beyond the apparent size of
+    # files (left behind by truncate()) and restore ownership, permissions
+    # and times. Children are handled before their parent directories, so
+    # that setting their attributes doesn't change the directory times.
+    query = 'SELECT path, mode, uid, gid, size, atime, mtime FROM entries ORDER BY id DESC'
+    for path, mode, uid, gid, size, atime, mtime in self.scratch.execute(query):
+      path = str(path)
+      try:
+        if stat.S_ISREG(mode) and os.path.getsize(path) != size:
+          handle = open(path, 'r+b')
+          try:
+            handle.truncate(size)
+          finally:
+            handle.close()
+        try:
+          os.lchown(path, uid, gid)
+        except OSError, e:
+          # Only the super user can give files away.
+          if e.errno != errno.EPERM: raise
+        if not stat.S_ISLNK(mode):
+          os.chmod(path, stat.S_IMODE(mode))
+          os.utime(path, (atime, mtime))
+      except (IOError, OSError), e:
+        self.logger.error("Failed to set the attributes of %r: %s", path, e)
+        self.errors += 1
+
+  def __open_file(self, inode, size): # {{{2
+    data = self.read_inline(inode)
+    if data is not None:
+      return FileReader(iter([data]), size)
+    query = """ SELECT h.hash, h.method FROM hashes h, "index" i
+                WHERE i.inode = ? AND h.id = i.hash_id
+                ORDER BY i.block_nr ASC """
+    blocks = [(str(row[0]), row[1]) for row in self.conn.execute(query, (inode,))]
+    return FileReader(self.__read_ahead(blocks), size)
+
+  def __read_ahead(self, blocks): # {{{2
+    # Generate the contents of the given (digest, method) blocks while the
+    # worker threads decompress the next few blocks.
+    pending = collections.deque()
+    for digest, method in blocks:
+      pending.append(self.__fetch(digest, method, None))
+      if len(pending) > self.max_pending:
+        yield self.__result(pending.popleft())
+    while pending:
+      yield self.__result(pending.popleft())
+
+  def __result(self, fetched): # {{{2
+    digest, method, targets, job = fetched
+    block = None
+    if job is not None:
+      try:
+        block = job.result()
+      except Exception:
+        pass
+    if block is None:
+      block = self.read_block(digest, method)
+    self.blocks += 1
+    return block
+
+  def __readlink(self, inode): # {{{2
+    return str(self.conn.execute('SELECT target FROM links WHERE inode = ?', (inode,)).fetchone()[0])
+
+  def __report_progress(self): # {{{2
+    time_now = time.time()
+    if time_now - self.last_report >= self.report_interval:
+      self.logger.info("Exported %i data blocks at %s/s ..", self.blocks,
+          format_size(self.blocks * self.block_size / (time_now - self.start_time)))
+      self.last_report = time_now
+
+  def __finish(self): # {{{2
+    elapsed = time.time() - self.start_time
+    self.logger.info("Exported %i files (%s) reading %i data blocks in %s (%s/s).",
+        self.files, format_size(self.bytes), self.blocks, format_timespan(elapsed),
+        format_size(self.bytes / max(elapsed, 0.001)))
+    if self.errors > 0:
+      self.logger.warning("Failed to export %i entries!", self.errors)
+
+class FileReader: # {{{1
+
+  """
+  A file like object that concatenates the blocks generated by an iterator,
+  truncated or padded with NUL bytes to the apparent size of the file.
+  """
+
+  def __init__(self, blocks, size):
+    self.blocks = blocks
+    self.remaining = size
+    self.block = ''
+    self.offset = 0
+
+  def read(self, size=-1):
+    if size < 0 or size > self.remaining:
+      size = self.remaining
+    chunks = []
+    while size > 0:
+      if self.offset >= len(self.block):
+        self.block = next(self.blocks, None) or '\0' * min(size, 1024 * 64)
+        self.offset = 0
+      chunk = self.block[self.offset:self.offset + size]
+      self.offset += len(chunk)
+      size -= len(chunk)
+      chunks.append(chunk)
+    data = ''.join(chunks)
+    self.remaining -= len(data)
+    return data
+
+# vim: ts=2 sw=2 et
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+"""
+The Checker class in this Python module checks the consistency of a DedupFS
+metadata store and its data store. The metadata checks are a handful of
+queries that each scan a table once (directory entries, link counts, index
+entries, reference counts). The data store check reads every data block once
+in the order the blocks were added to the data store while a pool of threads
+decompresses the blocks and compares them to their digest, followed by a
+scan of the keys of the data store for blocks that aren't referenced by the
+metadata store. Problems in the metadata can optionally be repaired, data
+blocks that are missing or corrupt can't be repaired but the affected files
+are reported.
+"""
+
+import collections
+import sqlite3
+
+from migration import Progress
+from my_formats import format_size
+from thread_pool import ThreadPool
+
+# The maximum number of files reported as affected by missing or corrupt
+# data blocks.
+MAX_AFFECTED_FILES = 100
+
+class Checker: # {{{1
+
+  def __init__(self, conn, blocks, logger, decompress, hash_function, threads=2, repair=False, report_interval=10): # {{{2
+    self.conn = conn
+    self.blocks = blocks
+    self.logger = logger
+    self.decompress = decompress
+    self.hash_function = hash_function
+    self.threads = threads
+    self.repair = repair
+    self.report_interval = report_interval
+
+  def run(self): # {{{2
+    """
+    Run all checks, repairing what can be repaired when requested. Returns
+    the number of problems that remain.
+    """
+    self.problems = self.repaired = self.unrepairable = 0
+    self.conn.execute('BEGIN')
+    try:
+      self.check_tree()
+      self.check_links()
+      self.check_contents()
+      self.check_references()
+      self.check_blocks()
+      self.check_datastore()
+      self.conn.execute('COMMIT')
+    except:
+      self.conn.execute('ROLLBACK')
+      raise
+    if self.problems == 0:
+      self.logger.info("No problems found.")
+    elif self.repair:
+      self.logger.warning("Found %i problems, repaired %i of them.", self.problems, self.repaired)
+    else:
+      self.logger.warning("Found %i problems, %i of them can be repaired using --repair.", self.problems, self.problems - self.unrepairable)
+    return self.problems - self.repaired
+
+  def check_tree(self): # {{{2
+    """
+    Check that the root directory exists and that all directory entries
+    refer to an existing inode and parent directory.
+    """
+    if not self.conn.execute('SELECT 1 FROM tree WHERE id = 1 AND parent_id IS NULL').fetchone():
+      self.__found(1, "The root directory is missing!", False)
+    query = 'SELECT id FROM tree t WHERE NOT EXISTS (SELECT 1 FROM inodes i WHERE i.inode = t.inode)'
+    self.__check_rows("Directory entries that refer to a missing inode", query, 'DELETE FROM tree WHERE id = ?')
+    # Removing an entry orphans its children, so this is repeated until
+    # the subtrees below missing directories are gone.
+    query = 'SELECT id FROM tree t WHERE parent_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM tree p WHERE p.id = t.parent_id)'
+    while self.__check_rows("Directory entries whose parent directory is missing", query, 'DELETE FROM tree WHERE id = ?'):
+      if not self.repair:
+        break
+
+  def check_links(self): # {{{2
+    """
+    Check the link count of every inode: the number of directory entries
+    that refer to it, plus the `.' entry and the `..' entries of the
+    subdirectories for directories. Inodes that are no longer referenced by
+    any directory entry but have a positive link count are never garbage
+    collected, their link count is repaired to zero so that the next
+    garbage collection deletes them (and releases their contents).
+    """
+    query = """ SELECT i.inode, i.mode, i.nlinks, COALESCE(l.links, 0), COALESCE(d.subdirs, 0) FROM inodes i
+                LEFT JOIN (SELECT inode, COUNT(*) AS links FROM tree GROUP BY inode) l ON l.inode = i.inode
+                LEFT JOIN (SELECT p.inode AS inode, COUNT(*) AS subdirs FROM tree c, inodes ci, tree p
+                           WHERE ci.inode = c.inode AND p.id = c.parent_id AND (ci.mode & %i) = %i
+                           GROUP BY p.inode) d ON d.inode = i.inode """ % (0170000, 0040000)
+    orphans, wrong = [], []
+    for inode, mode, nlinks, links, subdirs in self.conn.execute(query):
+      expected = links
+      if links > 0 and (mode & 0170000) == 0040000:
+        expected += 1 + subdirs
+      if expected == 0 and nlinks > 0:
+        orphans.append((0, inode))
+      elif expected != nlinks:
+        wrong.append((expected, inode))
+    for description, rows in (("Inodes that aren't referenced by any directory entry", orphans),
+                              ("Inodes with the wrong link count", wrong)):
+      self.__found(len(rows), description)
+      if rows and self.repair:
+        self.conn.executemany('UPDATE inodes SET nlinks = ? WHERE inode = ?', rows)
+        self.repaired += len(rows)
+
+  def check_contents(self): # {{{2
+    """
+    Check that index entries refer to an existing inode and data block and
+    that inline data and symbolic link targets belong to an existing inode.
+    """
+    query = 'SELECT inode, block_nr FROM "index" i WHERE NOT EXISTS (SELECT 1 FROM hashes h WHERE h.id = i.hash_id)'
+    rows = self.conn.execute(query).fetchall()
+    self.__report_files(set([r[0] for r in rows]), "referring to missing data blocks")
+    self.__check_rows("Index entries that refer to a missing data block", rows, 'DELETE FROM "index" WHERE inode = ? AND block_nr = ?')
+    query = 'SELECT inode, block_nr FROM "index" i WHERE NOT EXISTS (SELECT 1 FROM inodes n WHERE n.inode = i.inode)'
+    self.__check_rows("Index entries of a missing inode", query, 'DELETE FROM "index" WHERE inode = ? AND block_nr = ?')
+    query = 'SELECT inode FROM inline_data d WHERE NOT EXISTS (SELECT 1 FROM inodes n WHERE n.inode = d.inode)'
+    self.__check_rows("Inline data of a missing inode", query, 'DELETE FROM inline_data WHERE inode = ?')
+    query = 'SELECT inode FROM links l WHERE NOT EXISTS (SELECT 1 FROM inodes n WHERE n.inode = l.inode)'
+    self.__check_rows("Symbolic link targets of a missing inode", query, 'DELETE FROM links WHERE inode = ?')
+
+  def check_references(self): # {{{2
+    """
+    Check the reference counts of data blocks (used by the garbage collector
+    to find unused blocks) against the index.
+    """
+    query = """ SELECT actual, id FROM (SELECT id, refs, (SELECT COUNT(*) FROM "index" i WHERE i.hash_id = hashes.id) AS actual
+                FROM hashes) WHERE refs != actual """
+    self.__check_rows("Data blocks with the wrong reference count", query,
+        'UPDATE hashes SET refs = ? WHERE id = ?')
+
+  def check_blocks(self): # {{{2
+    """
+    Read every data block in the metadata store, check that it decompresses
+    (using the compression method it was stored with) to data that matches
+    its digest and check the recorded sizes.
+    """
+    first, last = self.conn.execute('SELECT MIN(id), MAX(id) FROM hashes').fetchone()
+    if first is None:
+      return
+    self.missing, self.corrupt, self.sizes = [], [], []
+    pool = ThreadPool(self.threads)
+    max_pending = len(pool.threads) * 4
+    pending = collections.deque()
+    self.progress = Progress(self.logger, "Verifying data blocks", first - 1, last, self.report_interval, format_size, 'verified')
+    try:
+      for hash_id, digest, size, raw_size, method in self.conn.execute('SELECT id, hash, size, raw_size, method FROM hashes ORDER BY id'):
+        digest = str(digest)
+        try:
+          data = self.blocks[digest]
+        except KeyError:
+          self.missing.append(hash_id)
+          continue
+        pending.append((hash_id, digest, size, raw_size, len(data), pool.submit(self.__decode, method, data)))
+        self.__drain(pending, max_pending)
+      self.__drain(pending, 0)
+    finally:
+      pool.close()
+    self.progress.finish()
+    for description, ids in (("Data blocks missing from the data store", self.missing),
+                             ("Data blocks that don't match their digest", self.corrupt)):
+      self.__found(len(ids), description, False)
+      if ids:
+        query = 'SELECT DISTINCT inode FROM "index" WHERE hash_id IN (%s)' % ', '.join(map(str, ids))
+        self.__report_files(set([r[0] for r in self.conn.execute(query)]), "containing these blocks")
+    self.__found(len(self.sizes), "Data blocks with the wrong recorded size")
+    if self.sizes and self.repair:
+      self.conn.executemany('UPDATE hashes SET size = ?, raw_size = ? WHERE id = ?', self.sizes)
+      self.repaired += len(self.sizes)
+
+  def check_datastore(self): # {{{2
+    """
+    Find data blocks in the data store that the metadata store doesn't know
+    about (they're never garbage collected).
+    """
+    orphans = []
+    query = 'SELECT 1 FROM hashes WHERE hash = ?'
+    for digest in iterkeys(self.blocks):
+      if not self.conn.execute(query, (sqlite3.Binary(digest),)).fetchone():
+        orphans.append(digest)
+    self.__found(len(orphans), "Data blocks that aren't referenced by the metadata store")
+    if orphans and self.repair:
+      # The keys are deleted after the scan because modifying a dbm while
+      # iterating over its keys is unsafe.
+      for digest in orphans:
+        del self.blocks[digest]
+      self.repaired += len(orphans)
+
+  def __decode(self, method, data): # {{{2
+    # Runs in a worker thread.
+    block = self.decompress(method, data)
+    return self.hash_function(block).digest(), len(block)
+
+  def __drain(self, pending, limit): # {{{2
+    while len(pending) > limit:
+      hash_id, digest, size, raw_size, stored_size, job = pending.popleft()
+      try:
+        actual_digest, actual_raw_size = job.result()
+      except Exception:
+        actual_digest = actual_raw_size = None
+      if actual_digest != digest:
+        self.corrupt.append(hash_id)
+      elif size != stored_size or raw_size != actual_raw_size:
+        self.sizes.append((stored_size, actual_raw_size, hash_id))
+      self.progress.update(hash_id, stored_size)
+
+  def __check_rows(self, description, rows, repair): # {{{2
+    # Report the rows returned by a query (or a list of rows) and repair
+    # them by executing the given statement for every row.
+    if isinstance(rows, basestring):
+      rows = self.conn.execute(rows).fetchall()
+    self.__found(len(rows), description)
+    if rows and self.repair:
+      self.conn.executemany(repair, [tuple(r) for r in rows])
+      self.repaired += len(rows)
+    return len(rows)
+
+  def __found(self, count, description, repairable=True): # {{{2
+    if count > 0:
+      self.logger.warning("%s: %i", description, count)
+      self.problems += count
+      if not repairable:
+        self.unrepairable += count
+
+  def __report_files(self, inodes, description): # {{{2
+    if inodes:
+      self.logger.warning("Files %s:", description)
+      for inode in sorted(inodes)[:MAX_AFFECTED_FILES]:
+        self.logger.warning(" - %s (inode %i)", self.__path(inode) or '(unreachable)', inode)
+      if len(inodes) > MAX_AFFECTED_FILES:
+        self.logger.warning(" - and %i more ..", len(inodes) - MAX_AFFECTED_FILES)
+
+  def __path(self, inode): # {{{2
+    # Find a path of the given inode by walking up the tree.
+    query = 'SELECT t.parent_id, s.value FROM tree t, strings s WHERE %s AND s.id = t.name LIMIT 1'
+    row = self.conn.execute(query % 't.inode = ?', (inode,)).fetchone()
+    segments = []
+    while row and row[0] is not None:
+      segments.insert(0, str(row[1]))
+      row = self.conn.execute(query % 't.id = ?', (row[0],)).fetchone()
+    if row:
+      return '/' + '/'.join(segments)
+
+def iterkeys(blocks): # {{{1
+  """
+  Generate the keys of a dbm object without loading all of them at once
+  when the dbm module supports that.
+  """
+  if hasattr(blocks, 'firstkey'):
+    key = blocks.firstkey()
+    while key is not None:
+      yield key
+      key = blocks.nextkey(key)
+  else:
+    for key in blocks.keys():
+      yield key
+
+# vim: ts=2 sw=2 et
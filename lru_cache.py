@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+"""
+The LRUCache class in this Python module is a dictionary with a limited
+number of entries and a limited (estimated) size in bytes. When either limit
+is exceeded the least recently used entries are evicted. Lookups, updates
+and evictions are O(1): the entries are kept in a circular doubly linked
+list ordered by last use, next to a dictionary that maps keys to entries.
+"""
+
+class Entry(object): # {{{1
+
+  __slots__ = ('key', 'value', 'size', 'prev', 'next')
+
+  def __init__(self, key=None, value=None, size=0):
+    self.key = key
+    self.value = value
+    self.size = size
+    self.prev = self.next = self
+
+class LRUCache(object): # {{{1
+
+  def __init__(self, max_entries, max_bytes=None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.entries = {}
+    # The sentinel's successor is the most recently used entry.
+    self.sentinel = Entry()
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key, default=None):
+    """
+    Get the value of the given key and mark it as most recently used.
+    """
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    if entry.prev is not self.sentinel:
+      self.__unlink(entry)
+      self.__link(entry)
+    return entry.value
+
+  def set(self, key, value, size=0):
+    """
+    Add or update an entry whose memory footprint is estimated at `size'
+    bytes, evicting the least recently used entries when necessary.
+    """
+    entry = self.entries.get(key)
+    if entry is None:
+      entry = Entry(key, value, size)
+      self.entries[key] = entry
+    else:
+      self.__unlink(entry)
+      self.nbytes -= entry.size
+      entry.value = value
+      entry.size = size
+    self.__link(entry)
+    self.nbytes += size
+    while len(self.entries) > self.max_entries or \
+        (self.max_bytes is not None and self.nbytes > self.max_bytes):
+      self.__evict(self.sentinel.prev)
+      self.evictions += 1
+
+  def delete(self, key):
+    entry = self.entries.get(key)
+    if entry is not None:
+      self.__evict(entry)
+
+  def clear(self):
+    self.entries.clear()
+    self.sentinel.prev = self.sentinel.next = self.sentinel
+    self.nbytes = 0
+
+  def hit_rate(self):
+    """
+    Get the percentage of lookups answered from the cache.
+    """
+    lookups = self.hits + self.misses
+    return lookups and self.hits * 100.0 / lookups or 0.0
+
+  def __link(self, entry):
+    entry.prev = self.sentinel
+    entry.next = self.sentinel.next
+    self.sentinel.next.prev = entry
+    self.sentinel.next = entry
+
+  def __unlink(self, entry):
+    entry.prev.next = entry.next
+    entry.next.prev = entry.prev
+
+  def __evict(self, entry):
+    self.__unlink(entry)
+    del self.entries[entry.key]
+    self.nbytes -= entry.size
+
+# vim: ts=2 sw=2 et
@@ -1,38 +1,48 @@
-#define BLOCK_SIZE (1024 * 128)
-
-#include <python2.6/Python.h>
+#include <Python.h>
 #include <lzo/lzo1x.h>
-#include <stdio.h>
+#include <pthread.h>
+#include <stdlib.h>
 
 /* The following formula gives the worst possible compressed size. */
 #define lzo1x_worst_compress(x) ((x) + ((x) / 16) + 64 + 3)
 
-/* The size of and pointer to the shared buffer. */
-static int block_size, buffer_size = 0;
-static unsigned char *shared_buffer = NULL;
+/* The compression levels: LEVEL_FAST uses lzo1x_1_15_compress(), LEVEL_BEST
+ * uses lzo1x_999_compress(). Both produce the LZO1X format, so the level
+ * doesn't matter for decompression. The numbers match those of zlib. */
+#define LEVEL_FAST 1
+#define LEVEL_BEST 9
+
+/* The working memory must be large enough for both levels. */
+#define WORKING_MEMORY_SIZE (LZO1X_999_MEM_COMPRESS > LZO1X_1_15_MEM_COMPRESS ? LZO1X_999_MEM_COMPRESS : LZO1X_1_15_MEM_COMPRESS)
+
+/* The maximum size of uncompressed blocks, set by set_block_size(). */
+static int block_size = 0;
 
 /* Don't store the size of compressed blocks in headers and trust the user to
  * configure the correct block size? */
 static int omit_headers = 0;
 
-/* Working memory required by LZO library, allocated on first use. */
-static char *working_memory = NULL;
+/* The working memory required by the LZO library can't be shared between
+ * threads that compress at the same time, so every thread gets its own
+ * (allocated on first use and freed when the thread exits). */
+static pthread_key_t working_memory_key;
 
 #define ADD_SIZE(p) (omit_headers ? (p) : ((p) + sizeof(int)))
 #define SUB_SIZE(p) (omit_headers ? (p) : ((p) - sizeof(int)))
 
-static unsigned char *
-get_buffer(int length)
+static void *
+get_working_memory(void)
 {
-  if (omit_headers) {
-    if (!shared_buffer)
-      shared_buffer = malloc(buffer_size);
-  } else if (!shared_buffer || buffer_size < length) {
-    free(shared_buffer);
-    shared_buffer = malloc(length);
-    buffer_size = length;
+  void *working_memory = pthread_getspecific(working_memory_key);
+
+  if (!working_memory) {
+    working_memory = malloc(WORKING_MEMORY_SIZE);
+    if (working_memory && pthread_setspecific(working_memory_key, working_memory) != 0) {
+      free(working_memory);
+      working_memory = NULL;
+    }
   }
-  return shared_buffer;
+  return working_memory;
 }
 
 static PyObject *
@@ -40,12 +50,10 @@ set_block_size(PyObject *self, PyObject *args)
 {
   int new_block_size;
 
+  /* This changes the format of compressed blocks, so it should be called
+   * once before the module is used (by any thread). */
   if (PyArg_ParseTuple(args, "i", &new_block_size)) {
-    if (shared_buffer)
-      free(shared_buffer);
     block_size = new_block_size;
-    buffer_size = lzo1x_worst_compress(block_size);
-    shared_buffer = malloc(buffer_size);
     omit_headers = 1;
   }
 
@@ -53,97 +61,272 @@ set_block_size(PyObject *self, PyObject *args)
   return Py_True;
 }
 
+/* The state of a single compression or decompression, split into a part
+ * that runs while holding the global interpreter lock (allocating the output
+ * string) and a part that doesn't (running LZO), so that a batch of blocks
+ * can be processed without reacquiring the lock for every block. */
+struct job {
+  Py_buffer input;
+  PyObject *output;
+  lzo_uint outlen;
+  int expected;
+  int status;
+};
+
+static int
+prepare_compress(struct job *job)
+{
+  /* Make sure the output fits in the size of blocks without headers. */
+  if (omit_headers && job->input.len > block_size) {
+    PyErr_Format(PyExc_ValueError, "The given input of %i bytes is larger than the configured block size of %i bytes!", (int)job->input.len, block_size);
+    return 0;
+  }
+
+  /* Compress directly into a new string of the worst possible size, which
+   * is shrunk to the actual size afterwards. */
+  job->outlen = lzo1x_worst_compress(job->input.len);
+  if (!(job->output = PyString_FromStringAndSize(NULL, ADD_SIZE(job->outlen))))
+    return 0;
+
+  /* Store the input size in the header of the compressed block? */
+  if (!omit_headers)
+    *((int*)PyString_AS_STRING(job->output)) = (int)job->input.len;
+
+  return 1;
+}
+
+static void
+run_compress(struct job *job, int level, void *working_memory)
+{
+  /* This runs without holding the global interpreter lock: the input is kept
+   * alive by the buffer view and nothing else can see the new string yet.
+   * The default LZO compression function is lzo1x_1_compress(). There's also
+   * variants like lzo1x_1_15_compress() which is faster and
+   * lzo1x_999_compress() which achieves higher compression. */
+  unsigned char *output = (unsigned char*)PyString_AS_STRING(job->output);
+
+  if (level == LEVEL_BEST)
+    job->status = lzo1x_999_compress(job->input.buf, job->input.len, ADD_SIZE(output), &job->outlen, working_memory);
+  else
+    job->status = lzo1x_1_15_compress(job->input.buf, job->input.len, ADD_SIZE(output), &job->outlen, working_memory);
+  job->outlen = ADD_SIZE(job->outlen);
+}
+
+static int
+prepare_decompress(struct job *job)
+{
+  /* Get the length of the uncompressed string from the header, or use the
+   * configured block size as an upper bound. */
+  if (omit_headers) {
+    job->outlen = block_size;
+  } else if (job->input.len < (Py_ssize_t)sizeof(int) || (job->expected = *((int*)job->input.buf)) < 0) {
+    PyErr_Format(PyExc_Exception, "The compressed string doesn't have a valid header!");
+    return 0;
+  } else {
+    job->outlen = job->expected;
+  }
+
+  /* Allocate the output string, the actual size of blocks without headers
+   * is known after decompressing them. */
+  return (job->output = PyString_FromStringAndSize(NULL, job->outlen)) != NULL;
+}
+
+static void
+run_decompress(struct job *job)
+{
+  /* This runs without holding the global interpreter lock (see
+   * run_compress()). The safe decompressor never writes beyond the output
+   * string, even when the compressed data is corrupt. */
+  const unsigned char *compressed = job->input.buf;
+
+  job->status = lzo1x_decompress_safe(ADD_SIZE(compressed), SUB_SIZE(job->input.len), (unsigned char*)PyString_AS_STRING(job->output), &job->outlen, NULL);
+  if (job->status == LZO_E_OK && !omit_headers && job->expected != job->outlen)
+    job->status = LZO_E_ERROR;
+}
+
 static PyObject *
-lzo_compress(PyObject *self, PyObject *args)
+finish_job(struct job *job, const char *function)
 {
-  const unsigned char *input;
-  unsigned char *output;
-  unsigned int inlen, status;
-  lzo_uint outlen;
+  /* Release the input and return the output (shrunk to its actual size) or
+   * raise an exception when (de)compression failed. */
+  PyObject *result = job->output;
 
-  /* Get the uncompressed string and its length. */
-  if (!PyArg_ParseTuple(args, "s#", &input, &inlen))
+  PyBuffer_Release(&job->input);
+  job->output = NULL;
+  if (job->status != LZO_E_OK) {
+    Py_DECREF(result);
+    return PyErr_Format(PyExc_Exception, "%s() failed with error code %i!", function, job->status);
+  }
+  if (job->outlen != PyString_GET_SIZE(result) && _PyString_Resize(&result, job->outlen) < 0)
     return NULL;
+  return result;
+}
 
-  /* Make sure never to touch unallocated memory. */
-  if (omit_headers && inlen > block_size)
-    return PyErr_Format(PyExc_ValueError, "The given input of %i bytes is larger than the configured block size of %i bytes!", block_size, inlen);
+static int
+check_level(int level)
+{
+  if (level != LEVEL_FAST && level != LEVEL_BEST) {
+    PyErr_Format(PyExc_ValueError, "Unsupported compression level %i, use %i (fast) or %i (best)!", level, LEVEL_FAST, LEVEL_BEST);
+    return 0;
+  }
+  return 1;
+}
 
-  /* Allocate the working memory on first use? */
-  if (!working_memory && !(working_memory = malloc(LZO1X_999_MEM_COMPRESS)))
-    return PyErr_NoMemory();
+static PyObject *
+lzo_compress(PyObject *self, PyObject *args)
+{
+  struct job job = { .output = NULL, .expected = 0, .status = LZO_E_OK };
+  int level = LEVEL_FAST;
+  void *working_memory;
 
-  /* Allocate the output buffer. */
-  outlen = lzo1x_worst_compress(inlen);
-  output = get_buffer(ADD_SIZE(outlen));
-  if (!output)
-    return PyErr_NoMemory();
+  /* Get the uncompressed data: a string or any object that supports the
+   * buffer protocol (like bytearray and memoryview), without copying it. */
+  if (!PyArg_ParseTuple(args, "s*|i", &job.input, &level))
+    return NULL;
 
-  /* Store the input size in the header of the compressed block? */
-  if (!omit_headers)
-    *((int*)output) = inlen;
+  if (!check_level(level) || !(working_memory = get_working_memory()) || !prepare_compress(&job)) {
+    if (!PyErr_Occurred())
+      PyErr_NoMemory();
+    PyBuffer_Release(&job.input);
+    return NULL;
+  }
 
-  /* Compress the input string. The default LZO compression function is
-   * lzo1x_1_compress(). There's also variants like lzo1x_1_15_compress() which
-   * is faster and lzo1x_999_compress() which achieves higher compression. */
-  status = lzo1x_1_15_compress(input, inlen, ADD_SIZE(output), &outlen, working_memory);
-  if (status != LZO_E_OK)
-    return PyErr_Format(PyExc_Exception, "lzo_compress() failed with error code %i!", status);
+  Py_BEGIN_ALLOW_THREADS
+  run_compress(&job, level, working_memory);
+  Py_END_ALLOW_THREADS
 
   /* Return the compressed string. */
-  return Py_BuildValue("s#", output, ADD_SIZE(outlen));
+  return finish_job(&job, "lzo_compress");
 }
 
 static PyObject *
 lzo_decompress(PyObject *self, PyObject *args)
 {
-  const unsigned char *input;
-  unsigned char *output;
-  int inlen, outlen_expected = 0, status;
-  lzo_uint outlen_actual;
+  struct job job = { .output = NULL, .expected = 0, .status = LZO_E_OK };
 
-  /* Get the compressed string and its length. */
-  if (!PyArg_ParseTuple(args, "s#", &input, &inlen))
+  /* Get the compressed data (see lzo_compress()). */
+  if (!PyArg_ParseTuple(args, "s*", &job.input))
     return NULL;
 
-  /* Get the length of the uncompressed string? */
-  if (!omit_headers)
-    outlen_expected = *((int*)input);
+  if (!prepare_decompress(&job)) {
+    PyBuffer_Release(&job.input);
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  run_decompress(&job);
+  Py_END_ALLOW_THREADS
+
+  /* Return the decompressed string. */
+  return finish_job(&job, "lzo_decompress");
+}
+
+static PyObject *
+process_many(PyObject *args, int compressing)
+{
+  PyObject *sequence, *items, *results = NULL;
+  struct job *jobs;
+  int level = LEVEL_FAST;
+  Py_ssize_t count, prepared = 0, i;
+  void *working_memory = NULL;
 
-  /* Allocate the output buffer. */
-  output = get_buffer(outlen_expected);
-  if (!output)
+  if (!PyArg_ParseTuple(args, compressing ? "O|i" : "O", &sequence, &level))
+    return NULL;
+  if (compressing && (!check_level(level) || !(working_memory = get_working_memory())))
+    return PyErr_Occurred() ? NULL : PyErr_NoMemory();
+  if (!(items = PySequence_Fast(sequence, "Expected a sequence of strings!")))
+    return NULL;
+  count = PySequence_Fast_GET_SIZE(items);
+  if (!(jobs = PyMem_Malloc(count * sizeof(struct job) + 1))) {
+    Py_DECREF(items);
     return PyErr_NoMemory();
+  }
+
+  /* Get the inputs and allocate all of the outputs up front. */
+  for (; prepared < count; prepared++) {
+    struct job *job = &jobs[prepared];
+    job->output = NULL;
+    job->expected = 0;
+    job->status = LZO_E_OK;
+    if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(items, prepared), &job->input, PyBUF_SIMPLE) < 0)
+      goto cleanup;
+    if (!(compressing ? prepare_compress(job) : prepare_decompress(job))) {
+      PyBuffer_Release(&job->input);
+      goto cleanup;
+    }
+  }
 
-  /* Decompress the compressed string. */
-  status = lzo1x_decompress(ADD_SIZE(input), SUB_SIZE(inlen), output, &outlen_actual, NULL);
-  if (status != LZO_E_OK)
-    return PyErr_Format(PyExc_Exception, "lzo_decompress() failed with error code %i!", status);
+  /* Process the whole batch without holding the global interpreter lock. */
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < count; i++) {
+    if (compressing)
+      run_compress(&jobs[i], level, working_memory);
+    else
+      run_decompress(&jobs[i]);
+  }
+  Py_END_ALLOW_THREADS
 
-  /* Verify the length of the uncompressed data? */
-  if (!omit_headers && outlen_expected != outlen_actual)
-    return PyErr_Format(PyExc_Exception, "The expected length (%i) doesn't match the actual uncompressed length (%i)!", outlen_expected, (int)outlen_actual);
+  /* Collect the results, the jobs are finished even after an error so that
+   * all of the inputs are released. */
+  results = PyList_New(count);
+  for (i = 0; i < count; i++) {
+    PyObject *result = finish_job(&jobs[i], compressing ? "lzo_compress" : "lzo_decompress");
+    if (result && results)
+      PyList_SET_ITEM(results, i, result);
+    else {
+      Py_XDECREF(result);
+      Py_CLEAR(results);
+    }
+  }
+  prepared = 0;
 
-  /* Return the decompressed string. */
-  return Py_BuildValue("s#", output, (int)outlen_actual);
+cleanup:
+  for (i = 0; i < prepared; i++) {
+    PyBuffer_Release(&jobs[i].input);
+    Py_XDECREF(jobs[i].output);
+  }
+  PyMem_Free(jobs);
+  Py_DECREF(items);
+  return results;
+}
+
+static PyObject *
+lzo_compress_many(PyObject *self, PyObject *args)
+{
+  return process_many(args, 1);
+}
+
+static PyObject *
+lzo_decompress_many(PyObject *self, PyObject *args)
+{
+  return process_many(args, 0);
 }
 
 static PyMethodDef functions[] = {
-  { "compress", lzo_compress, METH_VARARGS, "Compress a string using the LZO algorithm." },
-  { "decompress", lzo_decompress, METH_VARARGS, "Decompress a string that was previously compressed using the compress() function of this same module." },
-  { "set_block_size", set_block_size, METH_VARARGS, "Set the max. length of the strings you will be compressing and/or decompressing so that the LZO module can allocate a single buffer shared by all lzo.compress() and lzo.decompress() calls." },
+  { "compress", lzo_compress, METH_VARARGS, "compress(string[, level]) -- Compress a string (or another object supporting the buffer protocol) using the LZO algorithm. The level is either LEVEL_FAST (the default, lzo1x_1_15) or LEVEL_BEST (lzo1x_999, slower but smaller). Releases the global interpreter lock while compressing." },
+  { "decompress", lzo_decompress, METH_VARARGS, "decompress(string) -- Decompress a string that was previously compressed using the compress() function of this same module, at any level. Corrupt input raises an exception. Releases the global interpreter lock while decompressing." },
+  { "compress_many", lzo_compress_many, METH_VARARGS, "compress_many(strings[, level]) -- Compress a sequence of strings like compress() in a single call and return a list of the compressed strings. The global interpreter lock is released once for the whole batch." },
+  { "decompress_many", lzo_decompress_many, METH_VARARGS, "decompress_many(strings) -- Decompress a sequence of strings like decompress() in a single call and return a list of the decompressed strings." },
+  { "set_block_size", set_block_size, METH_VARARGS, "Set the max. length of the strings you will be compressing and/or decompressing so that the LZO module can omit the length headers of compressed strings. This changes the format of compressed strings, so call it once before using the module." },
   { NULL, NULL, 0, NULL }
 };
 
 PyMODINIT_FUNC
 initlzo(void)
 {
+  PyObject *module;
   int status;
 
   if ((status = lzo_init()) != LZO_E_OK)
     PyErr_Format(PyExc_Exception, "Failed to initialize the LZO library! (lzo_init() failed with error code %i)", status);
-  else if (!Py_InitModule("lzo", functions))
+  else if ((status = pthread_key_create(&working_memory_key, free)) != 0)
+    PyErr_Format(PyExc_Exception, "Failed to create the key of the per thread working memory! (pthread_key_create() failed with error code %i)", status);
+  else if (!(module = Py_InitModule("lzo", functions)))
     PyErr_Format(PyExc_Exception, "Failed to register module functions!");
+  else {
+    PyModule_AddIntConstant(module, "LEVEL_FAST", LEVEL_FAST);
+    PyModule_AddIntConstant(module, "LEVEL_BEST", LEVEL_BEST);
+  }
 }
 
 /* vim: set ts=2 sw=2 et : */
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+"""
+The TreeHasher class in this Python module computes a Merkle digest for
+every directory in a subtree of a DedupFS metadata store, in a single
+post-order walk of the tree. The digest of a file covers its attributes and
+the digests of its data blocks (or its decompressed inline data or link
+target), the digest of a directory covers the names and digests of its
+entries. The attributes of directories themselves aren't included because
+identical subtrees are only used to share the files in them. The digests
+are stored in a temporary table so that identical subtrees can be found
+with a single grouping query instead of comparing subtrees pairwise.
+"""
+
+import hashlib
+import sqlite3
+import stat
+
+class TreeHasher: # {{{1
+
+  def __init__(self, conn, decompress, hash_function=hashlib.sha1): # {{{2
+    # Inline data is decompressed using decompress(method, data), because the
+    # same contents can be stored using different methods.
+    self.conn = conn
+    self.decompress = decompress
+    self.hash_function = hash_function
+
+  def run(self, node_id): # {{{2
+    """
+    Compute the digests of the directories in the subtree rooted at the
+    given node. Returns the digest of the root of the subtree.
+    """
+    self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS merkle (node_id INTEGER PRIMARY KEY, digest BLOB NOT NULL, files INTEGER NOT NULL)')
+    self.conn.execute('DELETE FROM temp.merkle')
+    query = """ SELECT t.id, s.value, i.inode, i.mode, i.uid, i.gid, i.rdev, i.size, i.mtime
+                FROM tree t, strings s, inodes i
+                WHERE t.parent_id = ? AND s.id = t.name AND i.inode = t.inode """
+    # Every open directory on the stack has a cursor over its entries, the
+    # (name, digest) pairs of the entries seen so far and a file count.
+    stack = [(node_id, '', self.conn.execute(query, (node_id,)), [], [0])]
+    while stack:
+      node_id, name, children, entries, files = stack[-1]
+      row = children.fetchone()
+      if row is None:
+        stack.pop()
+        entries.sort()
+        context = self.hash_function('directory')
+        for entry_name, entry_digest in entries:
+          context.update('%i:%s%s' % (len(entry_name), entry_name, entry_digest))
+        digest = context.digest()
+        self.conn.execute('INSERT INTO temp.merkle (node_id, digest, files) VALUES (?, ?, ?)',
+            (node_id, sqlite3.Binary(digest), files[0]))
+        if stack:
+          stack[-1][3].append((name, digest))
+          stack[-1][4][0] += files[0]
+        continue
+      child_id, child_name, inode, mode = row[0], str(row[1]), row[2], row[3]
+      if stat.S_ISDIR(mode):
+        stack.append((child_id, child_name, self.conn.execute(query, (child_id,)), [], [0]))
+      else:
+        entries.append((child_name, self.__file_digest(*tuple(row)[2:])))
+        files[0] += 1
+    return digest
+
+  def duplicates(self): # {{{2
+    """
+    Generate a (number of files, node ids) pair for every group of
+    non-empty directories with identical contents, the largest subtrees
+    first. The node ids of every group are sorted.
+    """
+    query = """ SELECT files, GROUP_CONCAT(node_id) FROM temp.merkle WHERE files > 0
+                GROUP BY digest HAVING COUNT(*) > 1 ORDER BY files DESC """
+    for files, node_ids in self.conn.execute(query).fetchall():
+      yield files, sorted([int(n) for n in node_ids.split(',')])
+
+  def __file_digest(self, inode, mode, uid, gid, rdev, size, mtime): # {{{2
+    context = self.hash_function('%o:%i:%i:%i:%i:%r:' % (mode, uid, gid, rdev or 0, size or 0, mtime))
+    if stat.S_ISREG(mode):
+      row = self.conn.execute('SELECT method, data FROM inline_data WHERE inode = ?', (inode,)).fetchone()
+      if row:
+        context.update('inline:%s' % self.decompress(row[0], str(row[1])))
+      else:
+        query = 'SELECT h.hash FROM "index" i, hashes h WHERE i.inode = ? AND h.id = i.hash_id ORDER BY i.block_nr'
+        for row in self.conn.execute(query, (inode,)):
+          context.update(str(row[0]))
+    elif stat.S_ISLNK(mode):
+      row = self.conn.execute('SELECT target FROM links WHERE inode = ?', (inode,)).fetchone()
+      context.update('link:%s' % (row and row[0] or ''))
+    return context.digest()
+
+# vim: ts=2 sw=2 et
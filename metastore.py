@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+"""
+The definitions in this Python module describe the layout of the SQLite
+database in which DedupFS stores the tree, the inodes and the block index.
+They're kept separate from dedupfs.py so that the schema can be inspected
+and benchmarked without the Python FUSE binding (see benchmark.py).
+"""
+
+import hashlib
+import re
+import sqlite3
+import stat
+import struct
+
+# The version of the layout created by schema() below. It's recorded in the
+# options table of new databases, databases without a recorded version use
+# the original layout (LEGACY_SCHEMA). Databases older than MIN_SCHEMA_VERSION
+# can't be mounted and have to be converted using `dedupfs.py migrate'.
+SCHEMA_VERSION = 7
+MIN_SCHEMA_VERSION = 2
+
+# Layout versions that only add tables and columns ("table.column") to the
+# previous version, together with the names of those tables and columns and
+# the statements that fill them in. Databases using such a previous layout
+# are upgraded in place when they're opened for writing (see upgrade()).
+# Added columns get the default of the current layout, except for the
+# columns in COLUMN_DEFAULTS whose default is the result of a query on the
+# database being upgraded (so that existing rows get the right value without
+# rewriting the table). The statements can use the SQL function
+# dedupfs_name_hash() (see name_hash()). The secondary indexes are created
+# after upgrading (see indexes()). The sizes of data blocks and the disk
+# usage counters added by version 5 are computed by dedupfs.py, because that
+# needs the data store.
+UPGRADES = [
+  (3, ['tree.name_hash'],
+      ['UPDATE tree SET name_hash = (SELECT dedupfs_name_hash(s.value) FROM strings s WHERE s.id = tree.name)']),
+  (4, ['inline_data'], []),
+  (5, ['hashes.size', 'hashes.raw_size', 'hashes.refs', 'statistics'],
+      ['UPDATE hashes SET refs = (SELECT COUNT(*) FROM "index" i WHERE i.hash_id = hashes.id)']),
+  (6, ['hashes.method'], []),
+  (7, ['dictionaries'], []),
+]
+COLUMN_DEFAULTS = {
+  # The name hashes are computed by the statement of version 3, the default
+  # only satisfies the NOT NULL constraint while the column is added.
+  'tree.name_hash': "SELECT 0",
+  # Data blocks of older layouts were all stored using the compression
+  # method in the options table (see DEFAULT_METHOD in migration.py).
+  'hashes.method': "SELECT COALESCE((SELECT value FROM options WHERE name = 'compression_method'), 'none')",
+}
+
+# The original layout. The primary key of the "index" table includes hash_id
+# in the middle, so block ordered scans need a temporary b-tree and range
+# deletes on block_nr can't seek.
+LEGACY_SCHEMA = """
+  CREATE TABLE IF NOT EXISTS tree (id INTEGER PRIMARY KEY, parent_id INTEGER, name INTEGER NOT NULL, inode INTEGER NOT NULL, UNIQUE (parent_id, name));
+  CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value BLOB NOT NULL UNIQUE);
+  CREATE TABLE IF NOT EXISTS inodes (inode INTEGER PRIMARY KEY, nlinks INTEGER NOT NULL, mode INTEGER NOT NULL, uid INTEGER, gid INTEGER, rdev INTEGER, size INTEGER, atime INTEGER, mtime INTEGER, ctime INTEGER);
+  CREATE TABLE IF NOT EXISTS links (inode INTEGER UNIQUE, target BLOB NOT NULL);
+  CREATE TABLE IF NOT EXISTS hashes (id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE);
+  CREATE TABLE IF NOT EXISTS "index" (inode INTEGER, hash_id INTEGER, block_nr INTEGER, PRIMARY KEY (inode, hash_id, block_nr));
+  CREATE TABLE IF NOT EXISTS options (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+# The current layout. Tables whose primary key is the access path are
+# clustered on that key (WITHOUT ROWID) so that lookups don't need a second
+# b-tree probe through a rowid. Directory entries carry a hash of their name
+# (see name_hash()) so that path lookups don't have to go through the
+# strings table by value. The contents of small files are stored inline
+# (compressed using `method' when that helps) instead of as data blocks.
+# Data blocks know their stored and uncompressed size, the compression
+# method used to store them and the number of index entries that refer to
+# them, and the statistics table contains disk usage counters that are kept
+# up to date by dedupfs.py (see USAGE_COUNTERS). The versions of the preset
+# dictionary used to compress small data blocks are kept in the dictionaries
+# table (see compression.py).
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS tree (id INTEGER PRIMARY KEY, parent_id INTEGER, name INTEGER NOT NULL, inode INTEGER NOT NULL, name_hash INTEGER NOT NULL, UNIQUE (parent_id, name));
+  CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value BLOB NOT NULL UNIQUE);
+  CREATE TABLE IF NOT EXISTS inodes (inode INTEGER PRIMARY KEY, nlinks INTEGER NOT NULL, mode INTEGER NOT NULL, uid INTEGER, gid INTEGER, rdev INTEGER, size INTEGER, atime INTEGER, mtime INTEGER, ctime INTEGER);
+  CREATE TABLE IF NOT EXISTS links (inode INTEGER PRIMARY KEY, target BLOB NOT NULL);
+  CREATE TABLE IF NOT EXISTS hashes (id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE, size INTEGER NOT NULL DEFAULT 0, raw_size INTEGER NOT NULL DEFAULT 0, refs INTEGER NOT NULL DEFAULT 0, method TEXT NOT NULL DEFAULT 'none');
+  CREATE TABLE IF NOT EXISTS "index" (inode INTEGER NOT NULL, block_nr INTEGER NOT NULL, hash_id INTEGER NOT NULL, PRIMARY KEY (inode, block_nr)) WITHOUT ROWID;
+  CREATE TABLE IF NOT EXISTS options (name TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+  CREATE TABLE IF NOT EXISTS inline_data (inode INTEGER PRIMARY KEY, method TEXT NOT NULL, data BLOB NOT NULL);
+  CREATE TABLE IF NOT EXISTS statistics (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID;
+  CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, data BLOB NOT NULL, samples INTEGER NOT NULL, created REAL NOT NULL);
+"""
+
+# Secondary indexes used by path lookups and garbage collection.
+INDEXES = """
+  CREATE INDEX IF NOT EXISTS tree_by_name_hash ON tree (parent_id, name_hash, name, inode);
+  CREATE INDEX IF NOT EXISTS index_by_hash ON "index" (hash_id);
+  CREATE INDEX IF NOT EXISTS inodes_unlinked ON inodes (nlinks) WHERE nlinks = 0;
+  CREATE INDEX IF NOT EXISTS hashes_unreferenced ON hashes (refs) WHERE refs = 0;
+"""
+
+# The shapes of the queries on the hot paths of dedupfs.py, together with
+# fragments that should (or shouldn't) appear in their query plans.
+QUERY_PLANS = [
+  ("Path segment lookup",
+   'SELECT t.id, t.inode FROM tree t INDEXED BY tree_by_name_hash CROSS JOIN strings s ON s.id = t.name WHERE t.parent_id = ? AND t.name_hash = ? AND s.value = ? LIMIT 1',
+   ['COVERING INDEX tree_by_name_hash', 'INTEGER PRIMARY KEY'], ['SCAN']),
+  ("Block ordered file scan",
+   'SELECT h.hash, h.method FROM hashes h, "index" i WHERE i.inode = ? AND h.id = i.hash_id ORDER BY i.block_nr ASC',
+   ['PRIMARY KEY (inode=?)'], ['TEMP B-TREE', 'SCAN']),
+  ("Truncating the block index",
+   'DELETE FROM "index" WHERE inode = ? AND block_nr > ?',
+   ['(inode=? AND block_nr>?)'], ['SCAN']),
+  ("Collecting unused inodes",
+   'DELETE FROM inodes WHERE nlinks = 0',
+   ['inodes_unlinked'], ['SCAN']),
+  ("Collecting unused index entries",
+   'DELETE FROM "index" WHERE NOT EXISTS (SELECT 1 FROM inodes WHERE inodes.inode = "index".inode)',
+   ['INTEGER PRIMARY KEY'], []),
+  ("Releasing block references",
+   'SELECT hash_id, COUNT(*) FROM "index" WHERE inode = ? AND block_nr >= ? GROUP BY hash_id',
+   ['PRIMARY KEY (inode=? AND block_nr>?)'], ['SCAN']),
+  ("Collecting unused data blocks",
+   'SELECT id, hash, size, raw_size FROM hashes WHERE refs = 0 AND NOT EXISTS (SELECT 1 FROM "index" i WHERE i.hash_id = hashes.id)',
+   ['hashes_unreferenced', 'index_by_hash'], ['SCAN']),
+]
+
+# The disk usage counters in the statistics table: the apparent size of all
+# regular files, the uncompressed and stored size and the number of distinct
+# data blocks, the stored size of data blocks that are no longer referenced
+# (they're deleted by the next garbage collection) and the stored size of
+# inline data. See compute_usage().
+USAGE_COUNTERS = ['apparent_bytes', 'unique_bytes', 'stored_bytes', 'blocks', 'garbage_bytes', 'inline_bytes']
+
+# SQLite settings that dedupfs.py exposes as --sqlite-* command line options
+# and that have to be applied to every connection. The page size is a
+# property of the database file instead, it's fixed when the file is created
+# (see dedupfs.py) and recorded in the options table.
+TUNABLE_PRAGMAS = ['cache_size', 'mmap_size', 'temp_store', 'journal_mode']
+TEMP_STORE_CHOICES = ['default', 'file', 'memory']
+JOURNAL_MODE_CHOICES = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+
+def name_hash(name): # {{{1
+  """
+  Hash a directory entry name to a signed 64 bit integer. This has to stay
+  stable because the hashes are stored in the tree table.
+  """
+  return struct.unpack('<q', hashlib.md5(str(name)).digest()[:8])[0]
+
+def supports_without_rowid(): # {{{1
+  """
+  WITHOUT ROWID tables were introduced in SQLite 3.8.2.
+  """
+  return sqlite3.sqlite_version_info >= (3, 8, 2)
+
+def schema(): # {{{1
+  """
+  Get the SQL script that creates the current layout, degraded to regular
+  rowid tables on SQLite versions that don't support WITHOUT ROWID.
+  """
+  if supports_without_rowid():
+    return SCHEMA
+  return SCHEMA.replace(' WITHOUT ROWID', '')
+
+def indexes(): # {{{1
+  """
+  Get the SQL script that creates the secondary indexes, using full indexes
+  instead of partial ones on SQLite versions older than 3.8.0.
+  """
+  if sqlite3.sqlite_version_info >= (3, 8, 0):
+    return INDEXES
+  return re.sub(r' WHERE \w+ = 0;', ';', INDEXES)
+
+def tune(conn, settings): # {{{1
+  """
+  Apply the per connection SQLite settings in the given dictionary (whose
+  keys are the names in TUNABLE_PRAGMAS, None means SQLite's default) and
+  return a list of (name, requested, effective) tuples for settings that
+  SQLite didn't accept as given.
+  """
+  rejected = []
+  for name in TUNABLE_PRAGMAS:
+    value = settings.get(name)
+    if value is not None:
+      conn.execute('PRAGMA %s = %s' % (name, value))
+      effective = conn.execute('PRAGMA %s' % name).fetchone()[0]
+      if name == 'temp_store':
+        effective = TEMP_STORE_CHOICES[effective]
+      if str(effective).lower() != str(value).lower():
+        rejected.append((name, value, effective))
+  return rejected
+
+def can_upgrade(version): # {{{1
+  """
+  Check whether a database using the given layout version can be upgraded
+  to the current layout in place.
+  """
+  versions = [v for v, names, statements in UPGRADES]
+  return version >= MIN_SCHEMA_VERSION and not [v for v in xrange(version + 1, SCHEMA_VERSION + 1) if v not in versions]
+
+def upgrade(conn): # {{{1
+  """
+  Upgrade the database behind the given connection to the current layout in
+  place when possible. Returns the previous layout version, or None when no
+  upgrade was needed (or possible).
+  """
+  version = get_schema_version(conn)
+  if version >= SCHEMA_VERSION or not can_upgrade(version):
+    return None
+  conn.create_function('dedupfs_name_hash', 1, name_hash)
+  conn.execute('BEGIN')
+  for target, names, statements in UPGRADES:
+    if target > version:
+      for name in names:
+        if '.' in name:
+          conn.execute(add_column(conn, *name.split('.')))
+        else:
+          conn.execute(create_table(name))
+      for statement in statements:
+        conn.execute(statement)
+  conn.execute("UPDATE options SET value = ? WHERE name = 'schema_version'", (SCHEMA_VERSION,))
+  conn.execute('COMMIT')
+  return version
+
+def create_table(table): # {{{1
+  """
+  Get the statement that creates the given table of the current layout.
+  """
+  return re.search(r'CREATE TABLE IF NOT EXISTS %s \(.*;' % table, schema()).group(0)
+
+def add_column(conn, table, column): # {{{1
+  """
+  Get the statement that adds the given column of the current layout to the
+  given table of an older layout (see COLUMN_DEFAULTS).
+  """
+  definition = re.search(r'[(,] ?%s ([^,()]*)' % column, create_table(table)).group(1)
+  query = COLUMN_DEFAULTS.get('%s.%s' % (table, column))
+  if query:
+    value = "DEFAULT '%s'" % str(conn.execute(query).fetchone()[0]).replace("'", "''")
+    if 'DEFAULT' in definition:
+      definition = re.sub(r"DEFAULT ('[^']*'|\S+)", value, definition)
+    else:
+      definition += ' ' + value
+  return 'ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition)
+
+def get_schema_version(conn, database='main'): # {{{1
+  """
+  Get the layout version of the metadata store attached as `database'.
+  """
+  query = "SELECT value FROM %s.options WHERE name = 'schema_version'" % database
+  row = conn.execute(query).fetchone()
+  return row and int(row[0]) or 1
+
+def compute_usage(conn): # {{{1
+  """
+  Compute the disk usage counters (see USAGE_COUNTERS) from scratch. This
+  scans the inodes and hashes tables so it's slow on big metadata stores.
+  """
+  usage = {}
+  usage['apparent_bytes'] = conn.execute('SELECT COALESCE(SUM(size), 0) FROM inodes WHERE nlinks > 0 AND (mode & %i) = %i' % (0170000, stat.S_IFREG)).fetchone()[0]
+  row = conn.execute('SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(size), 0) FROM hashes').fetchone()
+  usage['blocks'], usage['unique_bytes'], usage['stored_bytes'] = row
+  usage['garbage_bytes'] = conn.execute('SELECT COALESCE(SUM(size), 0) FROM hashes WHERE refs = 0').fetchone()[0]
+  usage['inline_bytes'] = conn.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM inline_data').fetchone()[0]
+  return usage
+
+def explain(conn, query): # {{{1
+  """
+  Get the query plan of the given query as a list of strings.
+  """
+  args = (None,) * query.count('?')
+  return [str(row[-1]) for row in conn.execute('EXPLAIN QUERY PLAN ' + query, args)]
+
+def check_query_plans(conn): # {{{1
+  """
+  Check the plans of the hot queries against the database behind the given
+  connection. Returns a list of (description, plan) tuples for every query
+  whose plan doesn't use the expected indexes.
+  """
+  problems = []
+  for description, query, required, forbidden in QUERY_PLANS:
+    plan = explain(conn, query)
+    text = '\n'.join(plan)
+    if [f for f in required if f not in text] or \
+       [f for f in forbidden if [l for l in plan if l.startswith(f) or (' ' + f) in l]]:
+      problems.append((description, plan))
+  return problems
+
+# vim: ts=2 sw=2 et
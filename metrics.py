@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+"""
+The Metrics class in this Python module is a registry of counters, gauges
+and latency histograms used to instrument DedupFS. Latencies are measured
+using a monotonic clock and collected in histograms with power of two
+buckets, so recording a measurement costs a couple of dictionary lookups and
+additions. A disabled registry hands out the original functions from wrap()
+and ignores measurements, which makes the instrumentation (almost) free.
+"""
+
+import inspect
+import math
+import time
+
+# Histogram bucket N counts latencies below 2 ** N microseconds, the last
+# bucket counts everything slower than about half an hour.
+NBUCKETS = 32
+
+def get_monotonic_clock(): # {{{1
+  """
+  Get a function that returns the number of seconds since some unspecified
+  point in time according to the CLOCK_MONOTONIC clock, which (unlike
+  time.time()) never jumps when the system time is changed. Falls back to
+  time.time() when clock_gettime() isn't available through ctypes.
+  """
+  try:
+    import ctypes, ctypes.util
+    class timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    # PyDLL() doesn't release the GIL during calls, which makes it safe to
+    # share a single timespec structure between threads.
+    library = ctypes.PyDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+    clock_gettime = library.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    clock_gettime.restype = ctypes.c_int
+    value = timespec()
+    reference = ctypes.byref(value)
+    CLOCK_MONOTONIC = 1
+    if clock_gettime(CLOCK_MONOTONIC, reference) != 0:
+      return time.time
+    def monotonic():
+      clock_gettime(CLOCK_MONOTONIC, reference)
+      return value.tv_sec + value.tv_nsec * 1e-9
+    return monotonic
+  except Exception:
+    return time.time
+
+monotonic = get_monotonic_clock()
+
+class Histogram(object): # {{{1
+
+  __slots__ = ('count', 'total', 'maximum', 'buckets')
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.maximum = 0.0
+    self.buckets = [0] * NBUCKETS
+
+  def add(self, seconds):
+    self.count += 1
+    self.total += seconds
+    if seconds > self.maximum:
+      self.maximum = seconds
+    # frexp() returns the binary exponent, i.e. the bucket number.
+    bucket = math.frexp(seconds * 1e6)[1]
+    self.buckets[min(max(bucket, 0), NBUCKETS - 1)] += 1
+
+  def percentile(self, percentage):
+    """
+    Get an upper bound (in seconds) of the given percentile of latencies.
+    """
+    threshold = self.count * percentage / 100.0
+    seen = 0
+    for bucket, count in enumerate(self.buckets):
+      seen += count
+      if count and seen >= threshold:
+        return min(2 ** bucket / 1e6, self.maximum)
+    return self.maximum
+
+  def summary(self):
+    return dict(count=self.count, total=self.total, max=self.maximum,
+        mean=self.count and self.total / self.count or 0.0,
+        p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+class Metrics: # {{{1
+
+  def __init__(self, enabled=True, clock=monotonic): # {{{2
+    self.enabled = enabled
+    self.clock = clock
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+    self.started_at = clock()
+
+  def count(self, name, amount=1): # {{{2
+    if self.enabled:
+      self.counters[name] = self.counters.get(name, 0) + amount
+
+  def gauge(self, name, function): # {{{2
+    """
+    Register a function that returns the current value of a gauge. Gauges
+    are evaluated only when a snapshot is taken.
+    """
+    self.gauges[name] = function
+
+  def start(self): # {{{2
+    """
+    Get the start time of a measurement that's recorded using stop().
+    """
+    if self.enabled:
+      return self.clock()
+
+  def stop(self, name, start_time): # {{{2
+    """
+    Record the time elapsed since start_time in the histogram `name'.
+    """
+    if start_time is not None:
+      histogram = self.histograms.get(name)
+      if histogram is None:
+        histogram = self.histograms[name] = Histogram()
+      histogram.add(self.clock() - start_time)
+
+  def wrap(self, name, function): # {{{2
+    """
+    Get a function that records the latency of calls to the given function
+    in the histogram `name', or the function itself when disabled. Calls to
+    generator functions are timed until the generator is exhausted.
+    """
+    if not self.enabled:
+      return function
+    clock, stop = self.clock, self.stop
+    if inspect.isgeneratorfunction(getattr(function, 'im_func', function)):
+      def wrapper(*args, **kw):
+        start_time = clock()
+        try:
+          for item in function(*args, **kw):
+            yield item
+        finally:
+          stop(name, start_time)
+    else:
+      def wrapper(*args, **kw):
+        start_time = clock()
+        try:
+          return function(*args, **kw)
+        finally:
+          stop(name, start_time)
+    wrapper.__name__ = getattr(function, '__name__', name)
+    wrapper.__doc__ = getattr(function, '__doc__', None)
+    return wrapper
+
+  def total(self, name): # {{{2
+    """
+    Get the cumulative time recorded in the histogram `name'.
+    """
+    histogram = self.histograms.get(name)
+    return histogram and histogram.total or 0.0
+
+  def uptime(self): # {{{2
+    return self.clock() - self.started_at
+
+  def snapshot(self): # {{{2
+    """
+    Get the current values of all metrics as a dictionary of plain values.
+    """
+    gauges = {}
+    for name, function in self.gauges.items():
+      gauges[name] = function()
+    histograms = {}
+    for name, histogram in self.histograms.items():
+      histograms[name] = histogram.summary()
+    return dict(enabled=self.enabled, uptime=self.uptime(), counters=dict(self.counters),
+        gauges=gauges, histograms=histograms)
+
+# vim: ts=2 sw=2 et
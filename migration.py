@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+"""
+The Migration class in this Python module copies the contents of a DedupFS
+metadata store (and optionally its data store) into a new store that uses
+the current layout. Rows are streamed in large batches using INSERT ...
+SELECT between attached databases and every batch is committed together with
+a checkpoint, so an interrupted migration can simply be restarted.
+"""
+
+import os
+import sqlite3
+import time
+
+from my_formats import format_size, format_timespan
+import metastore
+
+# The tables that are copied, in order, with the integer column used to
+# split them into batches and the columns of the target table. Source
+# expressions default to the target columns, older layouts that don't have
+# all of the columns yet are converted using the expressions of the first
+# (version, expressions) pair whose version is newer than the source layout
+# (None means the table doesn't exist in those layouts). Data blocks of older
+# layouts were all stored using the compression method in the options table.
+DEFAULT_METHOD = "COALESCE((SELECT value FROM source.options WHERE name = 'compression_method'), 'none')"
+TABLES = [
+  ('strings', 'id', 'id, value', []),
+  ('tree', 'id', 'id, parent_id, name, inode, name_hash', [
+    (3, 'id, parent_id, name, inode, (SELECT dedupfs_name_hash(s.value) FROM source.strings s WHERE s.id = tree.name)')]),
+  ('inodes', 'inode', 'inode, nlinks, mode, uid, gid, rdev, size, atime, mtime, ctime', []),
+  ('links', 'inode', 'inode, target', []),
+  ('hashes', 'id', 'id, hash, size, raw_size, refs, method', [
+    (5, 'id, hash, 0, 0, 0, ' + DEFAULT_METHOD),
+    (6, 'id, hash, size, raw_size, refs, ' + DEFAULT_METHOD)]),
+  ('index', 'inode', 'inode, block_nr, hash_id', []),
+  ('inline_data', 'inode', 'inode, method, data', [(4, None)]),
+  ('dictionaries', 'id', 'id, data, samples, created', [(7, None)]),
+]
+
+class Migration: # {{{1
+
+  def __init__(self, source_file, target_file, logger, batch_size=50000, report_interval=10): # {{{2
+    self.source_file = source_file
+    self.target_file = target_file
+    self.logger = logger
+    self.batch_size = batch_size
+    self.report_interval = report_interval
+
+  def run(self, source_blocks=None, target_blocks=None): # {{{2
+    """
+    Copy the metadata store and, when both key/value stores are given, the
+    data blocks referenced by it. Returns False when the target exists but
+    wasn't created by a migration from the same source.
+    """
+    self.conn = sqlite3.connect(self.target_file, isolation_level=None)
+    self.conn.text_factory = str
+    try:
+      self.conn.execute('ATTACH DATABASE ? AS source', (self.source_file,))
+      if not self.__prepare_target():
+        return False
+      self.source_version = metastore.get_schema_version(self.conn, 'source')
+      self.logger.info("Migrating %r (layout version %i) to %r (layout version %i).",
+          self.source_file, self.source_version, self.target_file, metastore.SCHEMA_VERSION)
+      self.conn.create_function('dedupfs_name_hash', 1, metastore.name_hash)
+      for table, key, columns, upgrades in TABLES:
+        expressions = columns
+        for version, upgrade in upgrades:
+          if self.source_version < version:
+            expressions = upgrade
+            break
+        if expressions:
+          self.__copy_table(table, key, columns, expressions)
+      if source_blocks is not None and target_blocks is not None:
+        self.__copy_blocks(source_blocks, target_blocks)
+      self.__finish()
+      return True
+    finally:
+      self.conn.close()
+
+  def __prepare_target(self): # {{{2
+    # The tables are created in the same transaction that records the source
+    # of the migration, so a target without that record is either empty or
+    # wasn't created by a migration.
+    if self.__fetchval("SELECT COUNT(*) FROM main.sqlite_master WHERE type = 'table'") == 0:
+      self.conn.execute('BEGIN')
+      try:
+        for statement in metastore.schema().split(';'):
+          if statement.strip():
+            self.conn.execute(statement)
+        self.conn.execute("""INSERT INTO main.options (name, value) SELECT name, value FROM source.options
+                             WHERE name != 'schema_version' AND name NOT LIKE 'migration_%'""")
+        self.__set_option('migration_source', os.path.realpath(self.source_file))
+        # The disk usage counters of older layouts are computed on first mount.
+        if metastore.get_schema_version(self.conn, 'source') >= 5:
+          self.conn.execute('INSERT INTO main.statistics (name, value) SELECT name, value FROM source.statistics')
+        self.conn.execute('COMMIT')
+      except:
+        self.conn.execute('ROLLBACK')
+        raise
+      return True
+    source = self.__get_option('migration_source')
+    if source == os.path.realpath(self.source_file):
+      self.logger.info("Resuming interrupted migration into %r.", self.target_file)
+      return True
+    self.logger.critical("Error: %r already exists and isn't an unfinished migration of %r!", self.target_file, self.source_file)
+    return False
+
+  def __copy_table(self, table, key, columns, expressions): # {{{2
+    checkpoint = 'migration_%s' % table
+    first, last = self.conn.execute('SELECT MIN(%s), MAX(%s) FROM source."%s"' % (key, key, table)).fetchone()
+    if first is None:
+      return
+    lower = self.__get_option(checkpoint)
+    if lower is None:
+      lower = first - 1
+    lower = int(lower)
+    progress = Progress(self.logger, "Copying %s" % table, first - 1, last, self.report_interval)
+    find_upper = 'SELECT %s FROM source."%s" WHERE %s > ? ORDER BY %s LIMIT 1 OFFSET ?' % (key, table, key, key)
+    copy_rows = 'INSERT INTO main."%s" (%s) SELECT %s FROM source."%s" WHERE %s > ? AND %s <= ?' % (table, columns, expressions, table, key, key)
+    while lower < last:
+      row = self.conn.execute(find_upper, (lower, self.batch_size - 1)).fetchone()
+      upper = row and row[0] or last
+      self.conn.execute('BEGIN')
+      count = self.conn.execute(copy_rows, (lower, upper)).rowcount
+      self.__set_option(checkpoint, upper)
+      self.conn.execute('COMMIT')
+      progress.update(upper, count)
+      lower = upper
+    progress.finish()
+
+  def __copy_blocks(self, source_blocks, target_blocks): # {{{2
+    checkpoint = 'migration_blocks'
+    lower = int(self.__get_option(checkpoint) or 0)
+    last = self.__fetchval('SELECT MAX(id) FROM hashes') or 0
+    progress = Progress(self.logger, "Copying data blocks", 0, last, self.report_interval, format_size)
+    query = 'SELECT id, hash FROM hashes WHERE id > ? ORDER BY id LIMIT ?'
+    while lower < last:
+      rows = self.conn.execute(query, (lower, self.batch_size)).fetchall()
+      if not rows:
+        break
+      nbytes = 0
+      for hash_id, digest in rows:
+        digest = str(digest)
+        if not source_blocks.has_key(digest):
+          self.logger.error("Data block #%i is missing from the source data store!", hash_id)
+          continue
+        block = source_blocks[digest]
+        target_blocks[digest] = block
+        nbytes += len(block)
+      # Make sure the blocks are on disk before the checkpoint is moved.
+      if hasattr(target_blocks, 'sync'):
+        target_blocks.sync()
+      lower = rows[-1][0]
+      self.conn.execute('BEGIN')
+      self.__set_option(checkpoint, lower)
+      self.conn.execute('COMMIT')
+      progress.update(lower, nbytes)
+    progress.finish()
+
+  def __finish(self): # {{{2
+    self.logger.info("Creating indexes ..")
+    self.conn.executescript(metastore.indexes())
+    if self.source_version < 5:
+      # Older layouts don't count the references to data blocks. The sizes
+      # of the data blocks and the disk usage counters are filled in when the
+      # new store is first mounted, because that needs the data store.
+      self.logger.info("Counting references to data blocks ..")
+      self.conn.execute('BEGIN')
+      self.conn.execute('UPDATE hashes SET refs = (SELECT COUNT(*) FROM "index" i WHERE i.hash_id = hashes.id)')
+      self.conn.execute('COMMIT')
+    self.conn.execute('BEGIN')
+    self.conn.execute("DELETE FROM options WHERE name LIKE 'migration_%'")
+    self.__set_option('schema_version', metastore.SCHEMA_VERSION)
+    self.conn.execute('COMMIT')
+    self.logger.info("Finished migrating %r to %r.", self.source_file, self.target_file)
+
+  def __get_option(self, name): # {{{2
+    row = self.conn.execute('SELECT value FROM main.options WHERE name = ?', (name,)).fetchone()
+    if row:
+      return row[0]
+
+  def __set_option(self, name, value): # {{{2
+    self.conn.execute('INSERT OR REPLACE INTO main.options (name, value) VALUES (?, ?)', (name, str(value)))
+
+  def __fetchval(self, query, *values): # {{{2
+    return self.conn.execute(query, values).fetchone()[0]
+
+class Progress: # {{{1
+
+  """
+  Periodically report the progress, throughput and estimated time remaining
+  of a long running operation that walks a range of integer keys.
+  """
+
+  def __init__(self, logger, label, first, last, interval, format_amount=None, verb='copied'):
+    self.logger = logger
+    self.label = label
+    self.verb = verb
+    self.first = first
+    self.last = last
+    self.interval = interval
+    self.format_amount = format_amount or (lambda n: '%i rows' % n)
+    self.amount = 0
+    self.start_time = self.last_report = time.time()
+
+  def update(self, position, amount):
+    self.amount += amount
+    time_now = time.time()
+    if time_now - self.last_report >= self.interval:
+      elapsed = time_now - self.start_time
+      fraction = float(position - self.first) / max(1, self.last - self.first)
+      remaining = fraction > 0 and elapsed / fraction - elapsed or 0
+      self.logger.info("%s: %.1f%% done, %s/s, about %s remaining.", self.label, fraction * 100,
+          self.format_amount(self.amount / max(1, elapsed)), format_timespan(remaining))
+      self.last_report = time_now
+
+  def finish(self):
+    elapsed = time.time() - self.start_time
+    self.logger.info("%s: %s %s in %s.", self.label, self.verb, self.format_amount(self.amount), format_timespan(elapsed))
+
+# vim: ts=2 sw=2 et
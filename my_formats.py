@@ -28,6 +28,14 @@ def format_size(nbytes):
       or nbytes < (1024 ** 4) and __round(nbytes, 1024 ** 3, 'GB') \
       or __round(nbytes, 1024 ** 4, 'TB')
 
+def format_latency(seconds):
+  """
+  Format the duration of a single (fast) operation as a human-readable string.
+  """
+  return seconds < 0.001 and '%i us' % round(seconds * 1e6) \
+      or seconds < 1 and '%.1f ms' % (seconds * 1e3) \
+      or '%.2f s' % seconds
+
 def __round(nbytes, divisor, suffix):
   nbytes = float(nbytes) / divisor
   if floor(nbytes) == nbytes:
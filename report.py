@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+"""
+The Report class in this Python module walks the tree of a DedupFS metadata
+store once and reports, like du(1), how much data each directory subtree
+contains and how much of it is deduplicated, followed by a histogram of the
+popularity of data blocks. Totals are aggregated on a stack of open cursors
+(one per directory level) while the tree is streamed from SQLite, so the
+memory used doesn't depend on the size of the store.
+"""
+
+import stat
+
+from my_formats import format_size
+
+# The statistics aggregated per file and per subtree: the apparent size of
+# regular files, the uncompressed size of data that's stored only once (data
+# blocks with a single reference and inline data), the uncompressed size of
+# data that's shared with other files (or with other parts of the same file),
+# the share of the stored (compressed) size attributed to the subtree (the
+# stored size of every data block is divided between its references) and the
+# number of regular files.
+COLUMNS = ['apparent', 'unique', 'shared', 'stored', 'files']
+
+class Report: # {{{1
+
+  def __init__(self, conn, output, max_depth=None, list_files=False): # {{{2
+    self.conn = conn
+    self.output = output
+    self.max_depth = max_depth
+    self.list_files = list_files
+
+  def run(self, node_id, path): # {{{2
+    """
+    Report on the subtree rooted at the given node of the tree and on the
+    data blocks of the whole store.
+    """
+    if self.conn.execute('SELECT 1 FROM hashes WHERE raw_size = 0 LIMIT 1').fetchone():
+      self.output.write("Warning: The size of some data blocks isn't known yet, mount the file system once to determine it.\n")
+    self.output.write('%12s%12s%12s%12s%10s  %s\n' % tuple(COLUMNS + ['path']))
+    totals = self.walk(node_id, path)
+    self.output.write('\n')
+    self.report_popularity()
+    return totals
+
+  def walk(self, node_id, path): # {{{2
+    """
+    Aggregate the statistics of the subtree rooted at the given node. Every
+    directory is reported after its contents (like du(1) does) so that
+    nothing has to be buffered. Returns the totals of the subtree.
+    """
+    stack = [self.__enter(node_id, path, 0)]
+    while stack:
+      path, depth, children, totals = stack[-1]
+      row = children.fetchone()
+      if row is None:
+        stack.pop()
+        self.__print(totals, path, depth)
+        if stack:
+          self.__add(stack[-1][3], totals)
+        continue
+      node_id, inode, name, mode, size, nlinks = row
+      child_path = path.rstrip('/') + '/' + str(name)
+      if stat.S_ISDIR(mode):
+        stack.append(self.__enter(node_id, child_path, depth + 1))
+      elif stat.S_ISREG(mode):
+        file_totals = self.__file_totals(inode, size or 0, nlinks)
+        if self.list_files:
+          self.__print(file_totals, child_path, depth + 1)
+        self.__add(totals, file_totals)
+    return totals
+
+  def report_popularity(self): # {{{2
+    """
+    Print a histogram of the number of references to data blocks, using
+    power of two buckets. The query aggregates on the reference counts, so
+    the number of groups is bounded by the highest reference count.
+    """
+    buckets = {}
+    query = 'SELECT refs, COUNT(*), SUM(raw_size), SUM(size) FROM hashes GROUP BY refs'
+    for refs, count, raw_size, size in self.conn.execute(query):
+      if refs < 1:
+        bucket = -1
+      elif refs == 1:
+        bucket = 0
+      else:
+        bucket = len(bin(refs - 1)) - 2
+      totals = buckets.setdefault(bucket, [0, 0, 0, 0])
+      for i, value in enumerate((count, raw_size, raw_size * refs, size)):
+        totals[i] += value or 0
+    self.output.write("Popularity of data blocks:\n")
+    self.output.write('%16s%12s%12s%12s%12s\n' % ('references', 'blocks', 'unique', 'referenced', 'stored'))
+    for bucket in sorted(buckets):
+      lower, upper = 2 ** (bucket - 1) + 1, 2 ** bucket
+      if bucket < 0:
+        label = 'unused'
+      elif lower >= upper:
+        label = str(upper)
+      else:
+        label = '%i-%i' % (lower, upper)
+      count, raw_size, referenced, size = buckets[bucket]
+      self.output.write('%16s%12i%12s%12s%12s\n' % (label, count, format_size(raw_size), format_size(referenced), format_size(size)))
+
+  def __enter(self, node_id, path, depth): # {{{2
+    query = """ SELECT t.id, t.inode, s.value, i.mode, i.size, i.nlinks
+                FROM tree t, strings s, inodes i
+                WHERE t.parent_id = ? AND s.id = t.name AND i.inode = t.inode """
+    return (path, depth, self.conn.execute(query, (node_id,)), [0] * len(COLUMNS))
+
+  def __file_totals(self, inode, size, nlinks): # {{{2
+    unique, shared, stored = 0, 0, 0.0
+    query = """ SELECT h.refs > 1, SUM(h.raw_size), SUM(CAST(h.size AS REAL) / MAX(h.refs, 1))
+                FROM "index" i, hashes h WHERE i.inode = ? AND h.id = i.hash_id
+                GROUP BY h.refs > 1 """
+    for is_shared, raw_size, stored_size in self.conn.execute(query, (inode,)):
+      if is_shared:
+        shared += raw_size
+      else:
+        unique += raw_size
+      stored += stored_size
+    row = self.conn.execute('SELECT LENGTH(data) FROM inline_data WHERE inode = ?', (inode,)).fetchone()
+    if row:
+      unique += size
+      stored += row[0]
+    if nlinks > 1:
+      # The contents of hard linked files are shared between their links.
+      shared += unique
+      unique = 0
+      stored /= nlinks
+    return [size, unique, shared, stored, 1]
+
+  def __add(self, totals, values): # {{{2
+    for i, value in enumerate(values):
+      totals[i] += value
+
+  def __print(self, totals, path, depth): # {{{2
+    if self.max_depth is None or depth <= self.max_depth:
+      apparent, unique, shared, stored, files = totals
+      self.output.write('%12s%12s%12s%12s%10i  %s\n' % (format_size(apparent), format_size(unique),
+          format_size(shared), format_size(int(stored)), files, path))
+
+# vim: ts=2 sw=2 et
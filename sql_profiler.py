@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+"""
+The SQLProfiler class in this Python module measures the SQL statements
+executed by DedupFS. It wraps the sqlite3 connection (Python 2 has no trace
+callback) and aggregates the number of calls, the total and maximum time and
+the number of rows per normalized statement and calling function. Time spent
+fetching rows is attributed to the statement that produced them. Statements
+slower than a threshold are kept in a bounded slow query log. Connections
+of multiple threads can share one profiler.
+"""
+
+import re
+import sys
+import threading
+import time
+
+from lru_cache import LRUCache
+from metrics import monotonic
+
+# The number of entries kept in the slow query log (older entries are
+# discarded) and the number of distinct SQL strings whose normalized form is
+# remembered.
+SLOW_LOG_SIZE = 100
+NORMALIZED_CACHE_SIZE = 1000
+
+# Literals that are replaced by placeholders when normalizing statements:
+# quoted strings, blob literals and numbers that aren't part of a name.
+LITERALS = re.compile(r"'(?:[^']|'')*'|[xX]'[0-9a-fA-F]*'|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+
+def normalize(sql): # {{{1
+  """
+  Get the shape of an SQL statement: whitespace is collapsed and literals
+  are replaced by question marks, so that statements built using string
+  formatting are aggregated together.
+  """
+  return LITERALS.sub('?', ' '.join(sql.split()))
+
+class Statement(object): # {{{1
+
+  __slots__ = ('calls', 'total', 'maximum', 'rows')
+
+  def __init__(self):
+    self.calls = 0
+    self.total = 0.0
+    self.maximum = 0.0
+    self.rows = 0
+
+class SQLProfiler: # {{{1
+
+  def __init__(self, slow_threshold=0.1, helpers=(), clock=monotonic): # {{{2
+    # Statements executed by the helper functions with the given names are
+    # attributed to the functions that called the helpers.
+    self.slow_threshold = slow_threshold
+    self.helpers = frozenset(helpers)
+    self.clock = clock
+    self.statements = {}
+    self.slow_queries = []
+    self.normalized = LRUCache(NORMALIZED_CACHE_SIZE)
+    # Protects the aggregates, the slow query log and the cache of normalized
+    # statements. SQLite itself runs outside of the lock.
+    self.lock = threading.Lock()
+
+  def wrap(self, conn): # {{{2
+    """
+    Get a connection object that profiles the statements executed through
+    the given sqlite3 connection.
+    """
+    return ProfiledConnection(conn, self)
+
+  def begin(self, sql, caller): # {{{2
+    """
+    Get the aggregate for a statement that's about to be executed.
+    """
+    self.lock.acquire()
+    try:
+      shape = self.normalized.get(sql)
+      if shape is None:
+        shape = normalize(sql)
+        self.normalized.set(sql, shape)
+      key = (shape, caller)
+      statement = self.statements.get(key)
+      if statement is None:
+        statement = self.statements[key] = Statement()
+      statement.calls += 1
+      return statement
+    finally:
+      self.lock.release()
+
+  def record(self, cursor, elapsed, rows=0): # {{{2
+    """
+    Attribute the time spent executing a statement or fetching its rows.
+    """
+    statement = cursor.statement
+    cursor.elapsed += elapsed
+    self.lock.acquire()
+    try:
+      statement.total += elapsed
+      statement.rows += rows
+      if cursor.elapsed > statement.maximum:
+        statement.maximum = cursor.elapsed
+      if cursor.elapsed >= self.slow_threshold:
+        if cursor.slow_entry is None:
+          cursor.slow_entry = dict(time=time.time(), caller=cursor.caller,
+              statement=' '.join(cursor.sql.split()), parameters=repr(cursor.parameters)[:200])
+          self.slow_queries.append(cursor.slow_entry)
+          del self.slow_queries[:-SLOW_LOG_SIZE]
+        cursor.slow_entry['seconds'] = cursor.elapsed
+        cursor.slow_entry['rows'] = cursor.rows
+    finally:
+      self.lock.release()
+
+  def top(self, count=None): # {{{2
+    """
+    Get a list of (statement, caller, aggregate) tuples ordered by the total
+    time spent on them, slowest first.
+    """
+    self.lock.acquire()
+    try:
+      items = [(s.total, sql, caller, s) for (sql, caller), s in self.statements.items()]
+    finally:
+      self.lock.release()
+    items.sort(reverse=True)
+    return [(sql, caller, s) for total, sql, caller, s in items[:count]]
+
+  def snapshot(self): # {{{2
+    """
+    Get the aggregates and the slow query log as a dictionary of plain values.
+    """
+    statements = []
+    for sql, caller, s in self.top():
+      statements.append(dict(statement=sql, caller=caller, calls=s.calls, total=s.total,
+          max=s.maximum, mean=s.total / max(1, s.calls), rows=s.rows))
+    self.lock.acquire()
+    try:
+      slow_queries = [dict(q) for q in reversed(self.slow_queries)]
+    finally:
+      self.lock.release()
+    return dict(slow_threshold=self.slow_threshold, statements=statements, slow_queries=slow_queries)
+
+class ProfiledConnection: # {{{1
+
+  def __init__(self, conn, profiler):
+    self.__dict__['conn'] = conn
+    self.__dict__['profiler'] = profiler
+
+  def __getattr__(self, name):
+    return getattr(self.conn, name)
+
+  def __setattr__(self, name, value):
+    setattr(self.conn, name, value)
+
+  def execute(self, sql, parameters=()):
+    return self.__run('execute', sql, parameters)
+
+  def executemany(self, sql, parameters):
+    return self.__run('executemany', sql, parameters)
+
+  def executescript(self, sql):
+    return self.__run('executescript', sql)
+
+  def __run(self, method, sql, *arguments):
+    profiler = self.profiler
+    frame = sys._getframe(2)
+    while frame.f_code.co_name in profiler.helpers and frame.f_back:
+      frame = frame.f_back
+    caller = frame.f_code.co_name
+    cursor = ProfiledCursor(profiler, profiler.begin(sql, caller), sql, arguments and arguments[0], caller)
+    start_time = profiler.clock()
+    cursor.cursor = getattr(self.conn, method)(sql, *arguments)
+    rowcount = method != 'executescript' and cursor.cursor.rowcount or 0
+    cursor.rows = max(0, rowcount)
+    profiler.record(cursor, profiler.clock() - start_time, cursor.rows)
+    return cursor
+
+class ProfiledCursor(object): # {{{1
+
+  """
+  Wraps the cursor of a statement to attribute the time spent fetching rows
+  (and the number of rows) to the statement.
+  """
+
+  __slots__ = ('profiler', 'statement', 'sql', 'parameters', 'caller', 'cursor', 'elapsed', 'rows', 'slow_entry')
+
+  def __init__(self, profiler, statement, sql, parameters, caller):
+    self.profiler = profiler
+    self.statement = statement
+    self.sql = sql
+    self.parameters = parameters
+    self.caller = caller
+    self.cursor = None
+    self.elapsed = 0.0
+    self.rows = 0
+    self.slow_entry = None
+
+  def __getattr__(self, name):
+    return getattr(self.cursor, name)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    row = self.fetchone()
+    if row is None:
+      raise StopIteration
+    return row
+
+  def fetchone(self):
+    start_time = self.profiler.clock()
+    row = self.cursor.fetchone()
+    self.__record(start_time, row is not None and 1 or 0)
+    return row
+
+  def fetchmany(self, *args):
+    start_time = self.profiler.clock()
+    rows = self.cursor.fetchmany(*args)
+    self.__record(start_time, len(rows))
+    return rows
+
+  def fetchall(self):
+    start_time = self.profiler.clock()
+    rows = self.cursor.fetchall()
+    self.__record(start_time, len(rows))
+    return rows
+
+  def __record(self, start_time, rows):
+    self.rows += rows
+    self.profiler.record(self, self.profiler.clock() - start_time, rows)
+
+# vim: ts=2 sw=2 et
@@ -198,7 +198,18 @@ if ! cmp -s "$TESTDATA" "$WRITE_FILE"; then
   FAIL "$0:$LINENO: Failed to verify $WRITE_FILE of $NBYTES bytes!"
 fi
 
-# Test 16: Verify that garbage collection of unused data blocks works. {{{1
+# Test 16: Verify that the statistics control file contains a JSON snapshot. {{{1
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+STATSFILE="$MOUNTPOINT/.dedupfs/stats"
+python -c 'import json, sys; json.load(open(sys.argv[1]))["histograms"]' "$STATSFILE" || FAIL "$0:$LINENO: Failed to parse $STATSFILE as JSON!"
+if ls -a "$MOUNTPOINT" | grep -q '^\.dedupfs$'; then
+  FAIL "$0:$LINENO: The control directory shouldn't be listed in the root directory!"
+fi
+
+# Test 17: Verify that garbage collection of unused data blocks works. {{{1
 
 FEEDBACK $TESTNO
 TESTNO=$[$TESTNO + 1]
@@ -212,7 +223,7 @@ DO_UNMOUNT
 REDUCED_SIZE=`ls -l "$DATASTORE" | awk '{print $5}'`
 [ $REDUCED_SIZE -lt $HALF_SIZE ] || FAIL "$0:$LINENO: Failed to verify effectiveness of data block garbage collection! (Full size of data store: $FULL_SIZE, reduced size: $REDUCED_SIZE)"
 
-# Test 17: Verify that garbage collection of interned path segments works. {{{1
+# Test 18: Verify that garbage collection of interned path segments works. {{{1
 
 DO_MOUNT --nosync
 SEGMENTGCDIR="$MOUNTPOINT/gc-of-segments-test"
@@ -234,6 +245,255 @@ REDUCED_SIZE=`ls -l "$METASTORE" | awk '{print $5}'`
 [ $REDUCED_SIZE -lt $HALF_SIZE ] || FAIL "$0:$LINENO: Failed to verify effectiveness of interned string garbage collection! (Full size of metadata store: $FULL_SIZE, reduced size: $REDUCED_SIZE)"
 echo -ne "\r"
 
+# Tests 19-23: Test the replace semantics of rename(). {{{1
+
+EXPECT_RENAME_ERROR () {
+  # Use rename() directly because mv(1) checks some of the cases itself.
+  python -c 'import errno, os, sys
+try:
+  os.rename(sys.argv[1], sys.argv[2])
+except OSError, e:
+  sys.exit(e.errno != getattr(errno, sys.argv[3]))
+sys.exit(1)' "$1" "$2" "$3" || FAIL "$0:$4: Expected renaming $1 to $2 to fail with $3!"
+}
+
+DO_MOUNT
+RENAMEDIR="$MOUNTPOINT/rename-tests"
+mkdir "$RENAMEDIR"
+
+# Test 19: Check that rename() replaces an existing file. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+echo first > "$RENAMEDIR/file1"
+echo second > "$RENAMEDIR/file2"
+mv -f "$RENAMEDIR/file1" "$RENAMEDIR/file2" || FAIL "$0:$LINENO: Failed to rename $RENAMEDIR/file1 over an existing file!"
+[ ! -e "$RENAMEDIR/file1" ] || FAIL "$0:$LINENO: $RENAMEDIR/file1 still exists after renaming it!"
+[ "`cat "$RENAMEDIR/file2"`" = first ] || FAIL "$0:$LINENO: $RENAMEDIR/file2 wasn't replaced by the renamed file!"
+CHECK_NLINK "$RENAMEDIR/file2" 1 $LINENO
+
+# Test 20: Check that rename() replaces an empty directory. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+mkdir -p "$RENAMEDIR/dir1/subdir" "$RENAMEDIR/dir2"
+CHECK_NLINK "$RENAMEDIR" 4 $LINENO
+mv -T "$RENAMEDIR/dir1" "$RENAMEDIR/dir2" || FAIL "$0:$LINENO: Failed to rename $RENAMEDIR/dir1 over an empty directory!"
+[ ! -e "$RENAMEDIR/dir1" ] || FAIL "$0:$LINENO: $RENAMEDIR/dir1 still exists after renaming it!"
+[ -d "$RENAMEDIR/dir2/subdir" ] || FAIL "$0:$LINENO: $RENAMEDIR/dir2 wasn't replaced by the renamed directory!"
+CHECK_NLINK "$RENAMEDIR" 3 $LINENO
+CHECK_NLINK "$RENAMEDIR/dir2" 3 $LINENO
+
+# Test 21: Check the errors reported by rename(). {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+mkdir "$RENAMEDIR/full"
+touch "$RENAMEDIR/full/file"
+EXPECT_RENAME_ERROR "$RENAMEDIR/dir2" "$RENAMEDIR/dir2/subdir/dir2" EINVAL $LINENO
+EXPECT_RENAME_ERROR "$RENAMEDIR/dir2" "$RENAMEDIR/file2" ENOTDIR $LINENO
+EXPECT_RENAME_ERROR "$RENAMEDIR/file2" "$RENAMEDIR/dir2" EISDIR $LINENO
+EXPECT_RENAME_ERROR "$RENAMEDIR/dir2" "$RENAMEDIR/full" ENOTEMPTY $LINENO
+[ -d "$RENAMEDIR/dir2/subdir" -a -f "$RENAMEDIR/file2" -a -f "$RENAMEDIR/full/file" ] || FAIL "$0:$LINENO: A failed rename() changed the file system!"
+
+# Test 22: Check that renaming a file onto a hard link of itself keeps both names. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+link "$RENAMEDIR/file2" "$RENAMEDIR/file3"
+python -c 'import os, sys; os.rename(sys.argv[1], sys.argv[2])' "$RENAMEDIR/file2" "$RENAMEDIR/file3" || FAIL "$0:$LINENO: Failed to rename $RENAMEDIR/file2 onto a hard link of itself!"
+[ -f "$RENAMEDIR/file2" -a -f "$RENAMEDIR/file3" ] || FAIL "$0:$LINENO: Renaming a file onto a hard link of itself removed one of the names!"
+CHECK_NLINK "$RENAMEDIR/file3" 2 $LINENO
+
+# Test 23: Check that moving a directory to another parent updates `..' and the link counts. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+mkdir -p "$RENAMEDIR/source/moved" "$RENAMEDIR/target"
+CHECK_NLINK "$RENAMEDIR/source" 3 $LINENO
+CHECK_NLINK "$RENAMEDIR/target" 2 $LINENO
+mv "$RENAMEDIR/source/moved" "$RENAMEDIR/target/" || FAIL "$0:$LINENO: Failed to move $RENAMEDIR/source/moved to another directory!"
+# Remount so that the link counts come from the metadata store.
+DO_UNMOUNT
+DO_MOUNT
+CHECK_NLINK "$RENAMEDIR/source" 2 $LINENO
+CHECK_NLINK "$RENAMEDIR/target" 3 $LINENO
+CHECK_NLINK "$RENAMEDIR/target/moved" 2 $LINENO
+[ "`stat -c %i "$RENAMEDIR/target/moved/.."`" = "`stat -c %i "$RENAMEDIR/target"`" ] || FAIL "$0:$LINENO: The \`..' entry of a moved directory doesn't refer to its new parent!"
+rm -R "$RENAMEDIR"
+DO_UNMOUNT
+
+# Tests 24-25: Test the offline import and export commands. {{{1
+
+OFFLINE () {
+  # Run an offline command against the two temporary databases.
+  python dedupfs.py "$@" "--metastore=$METASTORE" "--datastore=$DATASTORE"
+}
+
+LIST_TREE () {
+  # List the modes, types, link counts (of everything but directories) and
+  # symbolic link targets of the files below the given directory.
+  (cd "$1" && find . \( -type d -printf '%m %y %p\n' \) -o \( -type l -printf '%y %p -> %l\n' \) -o -printf '%m %y %n %p\n' | sort)
+}
+
+IMPORTSRC="$ROOTDIR/import-source"
+EXPORTDIR="$ROOTDIR/export-target"
+mkdir -p "$IMPORTSRC/subdir/private"
+head -c $[1024 * 300] /dev/urandom > "$IMPORTSRC/large"
+cp "$IMPORTSRC/large" "$IMPORTSRC/subdir/duplicate"
+echo small > "$IMPORTSRC/subdir/small"
+touch "$IMPORTSRC/empty"
+link "$IMPORTSRC/subdir/small" "$IMPORTSRC/hardlink"
+ln -s subdir/small "$IMPORTSRC/symlink"
+chmod 0751 "$IMPORTSRC/large"
+chmod 0600 "$IMPORTSRC/subdir/small"
+chmod 0700 "$IMPORTSRC/subdir/private"
+
+# Test 24: Check that a tree survives a round trip through import and export. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+OFFLINE import "$IMPORTSRC" /imported || FAIL "$0:$LINENO: Failed to import $IMPORTSRC!"
+OFFLINE export /imported "$EXPORTDIR" || FAIL "$0:$LINENO: Failed to export /imported to $EXPORTDIR!"
+diff -r "$IMPORTSRC" "$EXPORTDIR" || FAIL "$0:$LINENO: The exported tree doesn't match the imported tree!"
+[ "`LIST_TREE "$IMPORTSRC"`" = "`LIST_TREE "$EXPORTDIR"`" ] || FAIL "$0:$LINENO: The modes, link counts or symbolic links of the exported tree don't match the imported tree!"
+[ "`stat -c %i "$EXPORTDIR/hardlink"`" = "`stat -c %i "$EXPORTDIR/subdir/small"`" ] || FAIL "$0:$LINENO: The exported hard links don't refer to the same file!"
+
+# Test 25: Check that an exported tar archive contains the imported tree. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+OFFLINE export /imported - | tar tf - > "$ROOTDIR/export.lst"
+[ "${PIPESTATUS[0]} ${PIPESTATUS[1]}" = "0 0" ] || FAIL "$0:$LINENO: Failed to export /imported as a tar archive!"
+EXPECTED=`cd "$IMPORTSRC" && find . | sed 's|^\.|imported|' | sort`
+[ "`sed 's|/$||' "$ROOTDIR/export.lst" | sort`" = "$EXPECTED" ] || FAIL "$0:$LINENO: The exported tar archive doesn't contain the imported tree!"
+
+# Tests 26-27: Test the clone command and control file. {{{1
+
+QUERY () {
+  # Print the first value returned by a query on the metadata store.
+  python -c 'import sqlite3, sys; print sqlite3.connect(sys.argv[1]).execute(sys.argv[2]).fetchone()[0]' "$METASTORE" "$1"
+}
+
+# Test 26: Check that the clone command copies a tree with densely numbered rows. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+MAX_INODE=`QUERY 'SELECT MAX(inode) FROM inodes'`
+MAX_NODE=`QUERY 'SELECT MAX(id) FROM tree'`
+OFFLINE clone /imported /cloned-offline || FAIL "$0:$LINENO: Failed to clone /imported to /cloned-offline!"
+INODES=`find "$IMPORTSRC" -printf '%i\n' | sort -u | wc -l`
+ENTRIES=`find "$IMPORTSRC" | wc -l`
+[ $[`QUERY 'SELECT MAX(inode) FROM inodes'` - $MAX_INODE] -eq $INODES ] || FAIL "$0:$LINENO: The clone didn't add $INODES inodes after the highest inode!"
+[ $[`QUERY 'SELECT MAX(id) FROM tree'` - $MAX_NODE] -eq $ENTRIES ] || FAIL "$0:$LINENO: The clone didn't add $ENTRIES directory entries after the highest id!"
+OFFLINE export /cloned-offline "$ROOTDIR/clone-export" || FAIL "$0:$LINENO: Failed to export /cloned-offline!"
+diff -r "$IMPORTSRC" "$ROOTDIR/clone-export" || FAIL "$0:$LINENO: The cloned tree doesn't match the imported tree!"
+[ "`LIST_TREE "$IMPORTSRC"`" = "`LIST_TREE "$ROOTDIR/clone-export"`" ] || FAIL "$0:$LINENO: The modes, link counts or symbolic links of the cloned tree don't match the imported tree!"
+CHECK_NLINK "$ROOTDIR/clone-export/hardlink" 2 $LINENO
+OFFLINE fsck 2>/dev/null || FAIL "$0:$LINENO: fsck found problems (e.g. wrong reference counts) after cloning!"
+
+# Test 27: Check that writing to the clone control file clones a tree. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+DO_MOUNT
+echo /imported /cloned-online > "$MOUNTPOINT/.dedupfs/clone" || FAIL "$0:$LINENO: Failed to clone /imported through the control file!"
+diff -r "$IMPORTSRC" "$MOUNTPOINT/cloned-online" || FAIL "$0:$LINENO: The cloned tree doesn't match the imported tree!"
+[ "`LIST_TREE "$IMPORTSRC"`" = "`LIST_TREE "$MOUNTPOINT/cloned-online"`" ] || FAIL "$0:$LINENO: The modes, link counts or symbolic links of the cloned tree don't match the imported tree!"
+CHECK_NLINK "$MOUNTPOINT/cloned-online/hardlink" 2 $LINENO
+CHECK_NLINK "$MOUNTPOINT/cloned-online/subdir" 3 $LINENO
+CHECK_NLINK "$MOUNTPOINT/imported/hardlink" 2 $LINENO
+echo changed > "$MOUNTPOINT/cloned-online/hardlink"
+[ "`cat "$MOUNTPOINT/cloned-online/subdir/small"`" = changed ] || FAIL "$0:$LINENO: The cloned hard links don't refer to the same file!"
+cmp -s "$IMPORTSRC/subdir/small" "$MOUNTPOINT/imported/subdir/small" || FAIL "$0:$LINENO: Changing the clone changed the original!"
+rm -R "$MOUNTPOINT/cloned-online"
+DO_UNMOUNT
+OFFLINE fsck 2>/dev/null || FAIL "$0:$LINENO: fsck found problems after cloning through the control file!"
+
+# Tests 28-29: Test the collapse command. {{{1
+
+COLLAPSESRC="$ROOTDIR/collapse-source"
+mkdir -p "$COLLAPSESRC/first/subdir"
+head -c $[1024 * 300] /dev/urandom > "$COLLAPSESRC/first/large"
+echo small > "$COLLAPSESRC/first/subdir/small"
+cp -a "$COLLAPSESRC/first" "$COLLAPSESRC/second"
+OFFLINE import "$COLLAPSESRC" /collapse || FAIL "$0:$LINENO: Failed to import $COLLAPSESRC!"
+
+CHECK_COLLAPSED () {
+  # Check whether the files in the two exported copies are hard links.
+  for FILE in large subdir/small; do
+    if [ "`stat -c %i "$1/first/$FILE"`" = "`stat -c %i "$1/second/$FILE"`" ]; then
+      [ $2 = yes ] || FAIL "$0:$3: The copies of $FILE in $1 are hard links!"
+      CHECK_NLINK "$1/first/$FILE" 2 $3
+    else
+      [ $2 = no ] || FAIL "$0:$3: The copies of $FILE in $1 aren't hard links!"
+      CHECK_NLINK "$1/first/$FILE" 1 $3
+    fi
+  done
+}
+
+# Test 28: Check that collapse --dry-run doesn't change anything. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+INODES=`QUERY 'SELECT COUNT(*) FROM inodes'`
+COLLAPSE_OUTPUT="`OFFLINE collapse --dry-run /collapse 2>&1`" || FAIL "$0:$LINENO: collapse --dry-run failed!"
+echo "$COLLAPSE_OUTPUT" | grep -q 'Would turn 2 files' || FAIL "$0:$LINENO: collapse --dry-run didn't report the duplicate files!"
+[ `QUERY 'SELECT COUNT(*) FROM inodes'` -eq $INODES ] || FAIL "$0:$LINENO: collapse --dry-run changed the inodes!"
+OFFLINE export /collapse "$ROOTDIR/collapse-dry-run" || FAIL "$0:$LINENO: Failed to export /collapse!"
+CHECK_COLLAPSED "$ROOTDIR/collapse-dry-run" no $LINENO
+
+# Test 29: Check that collapse turns identical subtrees into hard links. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+OFFLINE collapse /collapse || FAIL "$0:$LINENO: collapse failed!"
+OFFLINE export /collapse "$ROOTDIR/collapse-export" || FAIL "$0:$LINENO: Failed to export /collapse!"
+diff -r "$COLLAPSESRC" "$ROOTDIR/collapse-export" || FAIL "$0:$LINENO: The collapsed tree doesn't match the imported tree!"
+CHECK_COLLAPSED "$ROOTDIR/collapse-export" yes $LINENO
+OFFLINE fsck 2>/dev/null || FAIL "$0:$LINENO: fsck found problems after collapsing!"
+
+# Tests 30-31: Test the offline fsck command. {{{1
+
+# Test 30: Check that fsck finds and repairs a wrong link count. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+OFFLINE fsck 2>/dev/null || FAIL "$0:$LINENO: fsck found problems in a consistent file system!"
+python -c 'import sqlite3, sys
+conn = sqlite3.connect(sys.argv[1])
+conn.execute("UPDATE inodes SET nlinks = nlinks + 5 WHERE inode = (SELECT MAX(inode) FROM inodes WHERE nlinks > 0)")
+conn.commit()' "$METASTORE" || FAIL "$0:$LINENO: Failed to corrupt a link count in $METASTORE!"
+FSCK_OUTPUT="`OFFLINE fsck 2>&1`" && FAIL "$0:$LINENO: fsck didn't fail on a wrong link count!"
+echo "$FSCK_OUTPUT" | grep -q 'Inodes with the wrong link count: 1' || FAIL "$0:$LINENO: fsck didn't report the wrong link count!"
+OFFLINE fsck --repair 2>/dev/null || FAIL "$0:$LINENO: fsck --repair didn't repair the wrong link count!"
+OFFLINE fsck 2>/dev/null || FAIL "$0:$LINENO: fsck still finds problems after fsck --repair!"
+
+# Test 31: Check that fsck reports data blocks missing from the data store. {{{2
+
+FEEDBACK $TESTNO
+TESTNO=$[$TESTNO + 1]
+
+python -c 'import anydbm, sys
+blocks = anydbm.open(sys.argv[1], "w")
+del blocks[blocks.keys()[0]]
+blocks.close()' "$DATASTORE" || FAIL "$0:$LINENO: Failed to delete a data block from $DATASTORE!"
+FSCK_OUTPUT="`OFFLINE fsck --repair 2>&1`" && FAIL "$0:$LINENO: fsck didn't fail on a missing data block!"
+echo "$FSCK_OUTPUT" | grep -q 'Data blocks missing from the data store: 1' || FAIL "$0:$LINENO: fsck didn't report the missing data block!"
+echo "$FSCK_OUTPUT" | grep -q 'Files containing these blocks:' || FAIL "$0:$LINENO: fsck didn't report the files affected by the missing data block!"
+
 # Finalization. {{{1
 
 CLEANUP
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+"""
+The ThreadPool class in this Python module runs function calls in a fixed
+number of worker threads. It's used to hash and compress data blocks in
+parallel: hashlib, zlib, bz2 and the LZO binding in lzo/ release the global
+interpreter lock while they process large strings, so this does use multiple
+CPU cores.
+"""
+
+import Queue
+import sys
+import threading
+
+class Job(object): # {{{1
+
+  __slots__ = ('function', 'args', 'value', 'error', 'done')
+
+  def __init__(self, function, args):
+    self.function = function
+    self.args = args
+    self.value = None
+    self.error = None
+    self.done = threading.Event()
+
+  def run(self):
+    try:
+      self.value = self.function(*self.args)
+    except Exception:
+      self.error = sys.exc_info()
+    self.done.set()
+
+  def result(self):
+    """
+    Wait for the job to finish and get the return value of the function,
+    re-raising any exception it raised.
+    """
+    self.done.wait()
+    if self.error:
+      raise self.error[0], self.error[1], self.error[2]
+    return self.value
+
+class ThreadPool: # {{{1
+
+  def __init__(self, size): # {{{2
+    self.queue = Queue.Queue()
+    self.threads = []
+    for i in xrange(max(1, size)):
+      thread = threading.Thread(target=self.__work)
+      thread.setDaemon(True)
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, function, *args): # {{{2
+    """
+    Schedule a call to the given function and get a Job whose result()
+    method returns the result of the call.
+    """
+    job = Job(function, args)
+    self.queue.put(job)
+    return job
+
+  def close(self): # {{{2
+    """
+    Stop the worker threads after the scheduled jobs have finished.
+    """
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+
+  def __work(self): # {{{2
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      job.run()
+
+# vim: ts=2 sw=2 et